@@ -0,0 +1,314 @@
+import os
+import time
+import threading
+import logging
+from process_supervisor import process_supervisor
+from ffmpeg_service import ffmpeg_service
+from stats_collector import stats_collector
+from event_bus import event_bus
+from config import VIDEO_PRESETS, DEFAULT_VIDEO_PRESET, ADMISSION_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+# Weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+
+def host_capacity():
+    """CPU cores available to this process, honouring cgroup quotas"""
+    if ADMISSION_SETTINGS['capacity']:
+        return ADMISSION_SETTINGS['capacity']
+    
+    if hasattr(os, 'sched_getaffinity'):
+        cores = float(len(os.sched_getaffinity(0)))
+    else:
+        cores = float(os.cpu_count() or 1)
+    
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cores = min(cores, int(quota) / int(period))
+    except (OSError, ValueError):
+        pass
+    return cores
+
+def process_cpu_seconds(pid):
+    """User + system CPU time of a process, or None where /proc is missing"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+def host_cpu_seconds():
+    """Busy CPU time of the whole host, or None where /proc is missing"""
+    try:
+        with open('/proc/stat') as f:
+            fields = [int(value) for value in f.readline().split()[1:]]
+        # user nice system idle iowait irq softirq steal
+        return (sum(fields[:8]) - fields[3] - fields[4]) / CLOCK_TICKS
+    except (OSError, IndexError, ValueError):
+        return None
+
+def candidate_presets():
+    """DEFAULT_VIDEO_PRESET, then each faster preset down to fastest_preset"""
+    names = list(VIDEO_PRESETS)
+    fastest = names.index(ADMISSION_SETTINGS['fastest_preset'])
+    default = names.index(DEFAULT_VIDEO_PRESET)
+    return [names[index] for index in range(default, fastest - 1, -1)]
+
+class AdmissionController:
+    """CPU-aware admission of encodes.
+    
+    Each channel is costed in cores from its ladder and preset. A start is
+    admitted at the slowest candidate preset that fits the headroom left
+    by running channels and non-encoder load; otherwise it is queued or
+    refused. Running channels are measured (process CPU time divided by
+    ffmpeg's reported speed) and the ratio of measured to estimated cost
+    calibrates estimates for later channels. A channel on a pooled encoder
+    is measured as its encoder plus its stream-copy packager.
+    """
+    
+    def __init__(self):
+        self.placements = {}
+        self.queue = []
+        self.calibration = 1.0
+        self.external_load = 0.0
+        self.cpu_samples = {}
+        self.host_sample = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.app = None
+        self.launcher = None
+    
+    def start(self, app, launcher):
+        """Start the sampler; launcher(stream_id, input_url) starts queued channels"""
+        with self.lock:
+            self.app = app
+            self.launcher = launcher
+            if self.thread and self.thread.is_alive():
+                return
+            
+            self.thread = threading.Thread(target=self._sample_loop, name='admission-control')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def estimate_cost(self, ladder, preset, passthrough=None):
+        """Estimated cores to encode a ladder in realtime, before calibration"""
+        cost = ADMISSION_SETTINGS['base_cost']
+        copy_video = bool(passthrough and passthrough.get('video'))
+        
+        for index, rendition in enumerate(ladder):
+            if index == 0 and copy_video:
+                continue
+            pixels = rendition['width'] * rendition['height'] * ADMISSION_SETTINGS['frame_rate']
+            cost += pixels / ADMISSION_SETTINGS['pixels_per_core'] * VIDEO_PRESETS[preset]['cost']
+        return cost
+    
+    def _headroom(self):
+        capacity = host_capacity() * (1 - ADMISSION_SETTINGS['reserve'])
+        committed = sum(placement['cost'] for placement in self.placements.values())
+        return capacity - committed - self.external_load
+    
+    def admit(self, stream_id, ladder, passthrough=None, input_url=None, queueable=True):
+        """Reserve capacity for a channel.
+        
+        Returns {'action': 'start', 'preset': ...} with capacity reserved,
+        or {'action': 'queue'} / {'action': 'reject'} with the shortfall.
+        """
+        with self.lock:
+            self.placements.pop(stream_id, None)
+            headroom = self._headroom()
+            
+            # Queued channels go first; only pushed inputs, which cannot
+            # wait, may overtake them
+            waiting = queueable and self.queue and self.queue[0]['stream_id'] != stream_id
+            
+            for preset in candidate_presets():
+                estimate = self.estimate_cost(ladder, preset, passthrough)
+                cost = estimate * self.calibration
+                if cost <= headroom and not waiting:
+                    self.placements[stream_id] = {
+                        'preset': preset,
+                        'estimate': estimate,
+                        'cost': cost,
+                        'measured': None,
+                        'speed': None,
+                        'resolutions': [rendition['resolution'] for rendition in ladder],
+                        'passthrough': bool(passthrough and passthrough.get('video')),
+                        'admitted_at': time.time()
+                    }
+                    self._dequeue(stream_id)
+                    if preset != DEFAULT_VIDEO_PRESET:
+                        logger.info(f"Stream {stream_id} admitted at preset {preset} ({cost:.2f} cores)")
+                    return {'action': 'start', 'preset': preset, 'cost': cost, 'headroom': headroom}
+            
+            shortfall = cost - headroom
+            if queueable and ADMISSION_SETTINGS['when_full'] == 'queue':
+                if not any(entry['stream_id'] == stream_id for entry in self.queue):
+                    self.queue.append({
+                        'stream_id': stream_id,
+                        'input_url': input_url,
+                        'cost': cost,
+                        'queued_at': time.time()
+                    })
+                if waiting:
+                    logger.warning(f"Stream {stream_id} queued behind {len(self.queue) - 1} waiting streams")
+                else:
+                    logger.warning(f"Stream {stream_id} queued: needs {cost:.2f} cores, {headroom:.2f} free")
+                return {'action': 'queue', 'cost': cost, 'headroom': headroom, 'shortfall': shortfall}
+            
+            logger.warning(f"Stream {stream_id} refused: needs {cost:.2f} cores, {headroom:.2f} free")
+            return {'action': 'reject', 'cost': cost, 'headroom': headroom, 'shortfall': shortfall}
+    
+    def release(self, stream_id):
+        """Free a channel's capacity and drop it from the queue"""
+        with self.lock:
+            released = self.placements.pop(stream_id, None) is not None
+            queued = self._dequeue(stream_id)
+            self.cpu_samples.pop(stream_id, None)
+        return released or queued
+    
+    def placement(self, stream_id):
+        """A copy of a channel's placement, or None"""
+        with self.lock:
+            placement = self.placements.get(stream_id)
+            return dict(placement) if placement else None
+    
+    def is_queued(self, stream_id):
+        with self.lock:
+            return any(entry['stream_id'] == stream_id for entry in self.queue)
+    
+    def _dequeue(self, stream_id):
+        before = len(self.queue)
+        self.queue = [entry for entry in self.queue if entry['stream_id'] != stream_id]
+        return len(self.queue) != before
+    
+    def _sample_loop(self):
+        while True:
+            time.sleep(ADMISSION_SETTINGS['sample_interval'])
+            try:
+                self.sample()
+                self._start_queued()
+            except Exception as e:
+                logger.error(f"Error in admission control: {e}")
+    
+    def sample(self):
+        """Measure running channels and non-encoder load"""
+        now = time.monotonic()
+        encoder_load = 0.0
+        
+        with self.lock:
+            for stream_id, placement in list(self.placements.items()):
+                info = process_supervisor.get_info(stream_id)
+                admitted_for = time.time() - placement['admitted_at']
+                if info is None and admitted_for >= ADMISSION_SETTINGS['warmup']:
+                    # Exited for good without going through stop_stream
+                    del self.placements[stream_id]
+                    self.cpu_samples.pop(stream_id, None)
+                    continue
+                if not info or not info['running']:
+                    continue
+                
+                # A pooled channel's packager only copies; its encoder runs
+                # under its own supervisor key
+                rates = [self._cpu_rate(stream_id, key, now) for key in ffmpeg_service.process_keys(stream_id)]
+                encoder_load += sum(rate for rate in rates if rate is not None)
+                cpu_rate = None if None in rates else sum(rates)
+                
+                if admitted_for >= ADMISSION_SETTINGS['warmup']:
+                    self._update_cost(placement, cpu_rate, stats_collector.latest(stream_id))
+            
+            busy = host_cpu_seconds()
+            if busy is not None:
+                if self.host_sample:
+                    elapsed = now - self.host_sample[0]
+                    host_load = (busy - self.host_sample[1]) / elapsed if elapsed > 0 else 0.0
+                    external = max(0.0, host_load - encoder_load)
+                    self.external_load += SMOOTHING * (external - self.external_load)
+                self.host_sample = (now, busy)
+    
+    def _cpu_rate(self, stream_id, key, now):
+        """Cores used by a channel's supervised process since the previous sample"""
+        info = process_supervisor.get_info(key)
+        if not info or not info['running']:
+            return None
+        pid = info['pid']
+        seconds = process_cpu_seconds(pid)
+        if seconds is None:
+            return None
+        
+        samples = self.cpu_samples.setdefault(stream_id, {})
+        previous = samples.get(key)
+        samples[key] = (pid, now, seconds)
+        if not previous or previous[0] != pid or now <= previous[1]:
+            return None
+        return max(0.0, (seconds - previous[2]) / (now - previous[1]))
+    
+    def _update_cost(self, placement, cpu_rate, sample):
+        """Fold a measurement into a channel's cost and the calibration"""
+        speed = sample['speed'] if sample else 0.0
+        placement['speed'] = speed or None
+        
+        # Below realtime a channel needs 1/speed more CPU than it gets
+        slowdown = 1.0 / speed if 0 < speed < 1 else 1.0
+        if cpu_rate is not None:
+            measured = cpu_rate * slowdown
+        elif slowdown > 1:
+            measured = placement['cost'] * slowdown
+        else:
+            return
+        
+        placement['measured'] = measured
+        placement['cost'] += SMOOTHING * (measured - placement['cost'])
+        self.calibration += SMOOTHING * (measured / placement['estimate'] - self.calibration)
+    
+    def _start_queued(self):
+        """Start the oldest queued channel once it fits"""
+        with self.lock:
+            expired = [entry for entry in self.queue
+                       if time.time() - entry['queued_at'] > ADMISSION_SETTINGS['queue_timeout']]
+            for entry in expired:
+                self._dequeue(entry['stream_id'])
+                logger.warning(f"Stream {entry['stream_id']} gave up waiting for encoder capacity")
+            
+            entry = self.queue[0] if self.queue and self.queue[0]['cost'] <= self._headroom() else None
+        
+        if expired:
+            self._mark_expired([entry['stream_id'] for entry in expired])
+        if entry:
+            with self.app.app_context():
+                self.launcher(entry['stream_id'], entry['input_url'])
+    
+    def _mark_expired(self, stream_ids):
+        # Imported here so the controller can be used without the Flask app
+        from models import Stream, db
+        
+        with self.app.app_context():
+            for stream in Stream.query.filter(Stream.id.in_(stream_ids), Stream.status == 'queued'):
+                stream.status = 'error'
+                event_bus.publish_status(stream.id, 'error')
+            db.session.commit()
+    
+    def get_status(self):
+        """Capacity, headroom, placements and queue"""
+        with self.lock:
+            capacity = host_capacity()
+            return {
+                'capacity': capacity,
+                'reserve': capacity * ADMISSION_SETTINGS['reserve'],
+                'external_load': round(self.external_load, 3),
+                'committed': round(sum(placement['cost'] for placement in self.placements.values()), 3),
+                'headroom': round(self._headroom(), 3),
+                'calibration': round(self.calibration, 3),
+                'placements': [dict(placement, stream_id=stream_id)
+                               for stream_id, placement in self.placements.items()],
+                'queue': [{key: value for key, value in entry.items() if key != 'input_url'}
+                          for entry in self.queue]
+            }
+
+# Global admission controller instance
+admission_controller = AdmissionController()
@@ -6,7 +6,7 @@ from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 
 class Base(DeclarativeBase):
     pass
@@ -25,22 +25,44 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 
-# Stream configuration
-app.config["HLS_OUTPUT_DIR"] = os.path.join(os.getcwd(), "static", "streams", "hls")
-app.config["DASH_OUTPUT_DIR"] = os.path.join(os.getcwd(), "static", "streams", "dash")
+# Stream configuration; MEDIA_ROOT may point at a directory shared with
+# encoder workers (mounted at the same path on every node)
+app.config["MEDIA_ROOT"] = os.environ.get("MEDIA_ROOT", os.path.join(os.getcwd(), "static", "streams"))
+app.config["HLS_OUTPUT_DIR"] = os.path.join(app.config["MEDIA_ROOT"], "hls")
+app.config["DASH_OUTPUT_DIR"] = os.path.join(app.config["MEDIA_ROOT"], "dash")
+app.config["CMAF_OUTPUT_DIR"] = os.path.join(app.config["MEDIA_ROOT"], "cmaf")
 app.config["RECORDINGS_DIR"] = os.path.join(os.getcwd(), "static", "recordings")
 
 # Create directories if they don't exist
 os.makedirs(app.config["HLS_OUTPUT_DIR"], exist_ok=True)
 os.makedirs(app.config["DASH_OUTPUT_DIR"], exist_ok=True)
+os.makedirs(app.config["CMAF_OUTPUT_DIR"], exist_ok=True)
 os.makedirs(app.config["RECORDINGS_DIR"], exist_ok=True)
 
 # initialize the app with the extension
 db.init_app(app)
 
+from metrics import instrument_database
+instrument_database()
+
 with app.app_context():
     # Import models and routes
     import models
     import routes
     
     db.create_all()
+    models.ensure_schema()
+    
+    from stream_registry import stream_registry
+    stream_registry.warm()
+    
+    # Cluster peers start encoders for each other, so they must authenticate
+    from cluster import require_token
+    require_token()
+    
+    # Workers write into the coordinator's MEDIA_ROOT, which prunes it
+    from config import CLUSTER_SETTINGS
+    if CLUSTER_SETTINGS['mode'] != 'worker':
+        from stream_manager import stream_manager
+        from segment_storage import segment_storage
+        segment_storage.start(app, stream_manager.live_stream_ids)
@@ -0,0 +1,129 @@
+"""Benchmark CPU cost of the ABR ladder encoder against the previous command.
+
+Encodes a local lavfi test source and reports CPU-seconds spent per minute of
+output for three strategies:
+
+  legacy          one libx264 encode fed to a tee muxer (the previous
+                  command; every output receives the same rendition)
+  per-rendition   one ffmpeg process per rendition, i.e. one decode each
+  ladder          FFmpegService._build_ffmpeg_command (decode once, split/scale)
+
+Usage:
+    python benchmarks/ladder_cpu.py --duration 20 --qualities 1080p 720p 480p 360p
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import FFMPEG_PATH, QUALITY_PROFILES, VIDEO_PRESETS, DEFAULT_VIDEO_PRESET
+from ffmpeg_service import FFmpegService
+
+
+def lavfi_input(duration, size, rate):
+    """Input arguments for a synthetic video + audio source"""
+    return [
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={rate}',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration)
+    ]
+
+
+def output_configs(workdir, qualities):
+    configs = []
+    for quality in qualities:
+        configs.append({
+            'type': 'hls',
+            'resolution': quality,
+            'output_path': os.path.join(workdir, f'bench_{quality}.m3u8'),
+            'latency_mode': 'tutorial'
+        })
+    return configs
+
+
+def legacy_command(source, configs):
+    """The previous single-encode tee command"""
+    preset = VIDEO_PRESETS[DEFAULT_VIDEO_PRESET]['preset']
+    cmd = [FFMPEG_PATH, '-y'] + source + ['-map', '0:v', '-map', '1:a']
+    cmd.extend(['-c:v', 'libx264', '-preset', preset, '-c:a', 'aac', '-flags', '+global_header', '-f', 'tee'])
+    outputs = [f"[select=\\'v:0,a\\':f=hls:hls_time=3]{config['output_path']}" for config in configs]
+    cmd.append('|'.join(outputs))
+    return [cmd]
+
+
+def per_rendition_commands(source, configs):
+    """One process per rendition, each decoding the input itself"""
+    preset = VIDEO_PRESETS[DEFAULT_VIDEO_PRESET]['preset']
+    commands = []
+    for config in configs:
+        quality = QUALITY_PROFILES[config['resolution']]
+        commands.append([FFMPEG_PATH, '-y'] + source + [
+            '-map', '0:v', '-map', '1:a',
+            '-vf', f"scale={quality['width']}:{quality['height']}",
+            '-c:v', 'libx264', '-preset', preset, '-b:v', f"{quality['bitrate']}k",
+            '-c:a', 'aac', '-f', 'hls', '-hls_time', '3', config['output_path']
+        ])
+    return commands
+
+
+def ladder_command(source, configs):
+    """The ladder command built by FFmpegService"""
+    cmd = FFmpegService()._build_ffmpeg_command('placeholder', configs)
+    # Swap the single input for the synthetic sources and route audio from
+    # the second input
+    index = cmd.index('-i')
+    cmd = cmd[:1] + ['-y'] + cmd[1:index] + source + cmd[index + 2:]
+    cmd[cmd.index('0:a?')] = '1:a'
+    return [cmd]
+
+
+def run(commands):
+    """Run commands concurrently and return (wall, cpu) seconds"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+
+    processes = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                 for cmd in commands]
+    for process in processes:
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode(errors='replace')[-2000:])
+
+    wall = time.monotonic() - started
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=20, help='seconds of output per run')
+    parser.add_argument('--size', default='1920x1080', help='source resolution')
+    parser.add_argument('--rate', type=int, default=30, help='source frame rate')
+    parser.add_argument('--qualities', nargs='+', default=['1080p', '720p', '480p', '360p'])
+    args = parser.parse_args()
+
+    source = lavfi_input(args.duration, args.size, args.rate)
+    strategies = [
+        ('legacy', legacy_command),
+        ('per-rendition', per_rendition_commands),
+        ('ladder', ladder_command),
+    ]
+
+    print(f"{len(args.qualities)} renditions, {args.duration:g}s of {args.size}@{args.rate} per run")
+    print(f"{'strategy':<15} {'wall s':>8} {'cpu s':>8} {'cpu s / min output':>20}")
+
+    for name, build in strategies:
+        with tempfile.TemporaryDirectory() as workdir:
+            configs = output_configs(workdir, args.qualities)
+            wall, cpu = run(build(source, configs))
+        print(f"{name:<15} {wall:>8.2f} {cpu:>8.2f} {cpu / args.duration * 60:>20.2f}")
+
+
+if __name__ == '__main__':
+    main()
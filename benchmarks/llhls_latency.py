@@ -0,0 +1,114 @@
+"""Benchmark LL-HLS part availability latency.
+
+Runs the low_latency CMAF command from FFmpegService against a real-time
+(-re) lavfi source, so a frame with media timestamp t is captured at
+launch + t. The LL-HLS part tracker follows the package and records when
+each part becomes servable. Reports:
+
+  time to first playable part     launch -> first independent part available
+  time to first full segment      launch -> first closed segment
+  part latency                    capture time of a part's last frame ->
+                                  part available (median / p95 / max)
+
+Usage:
+    python benchmarks/llhls_latency.py --duration 20
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import LL_HLS_SETTINGS
+from ffmpeg_service import FFmpegService
+from llhls import RenditionTracker
+
+
+def build_command(workdir, duration, size, rate):
+    service = FFmpegService()
+    configs = [{
+        'type': 'cmaf',
+        'resolution': '720p',
+        'output_path': os.path.join(workdir, 'bench.mpd'),
+        'latency_mode': 'low',
+        'll_playlist_url': '/bench/ll'
+    }]
+    service._prepare_output_dirs(configs)
+    cmd = service._build_ffmpeg_command('placeholder', configs)
+    
+    source = [
+        '-re', '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate={rate}',
+        '-re', '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', str(duration)
+    ]
+    index = cmd.index('-i')
+    cmd = cmd[:1] + ['-y'] + cmd[1:index] + source + cmd[index + 2:]
+    cmd[cmd.index('0:a?')] = '1:a'
+    return cmd
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--duration', type=float, default=20, help='seconds of live input')
+    parser.add_argument('--size', default='1280x720', help='source resolution')
+    parser.add_argument('--rate', type=int, default=30, help='source frame rate')
+    args = parser.parse_args()
+    
+    settings = LL_HLS_SETTINGS['low_latency']
+    
+    with tempfile.TemporaryDirectory() as workdir:
+        cmd = build_command(workdir, args.duration, args.size, args.rate)
+        tracker = RenditionTracker(workdir, 0, settings['part_duration'], settings['playlist_segments'])
+        
+        launched = time.monotonic()
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        
+        first_part = first_segment = None
+        seen = set()
+        media_time = 0.0
+        latencies = []
+        
+        while process.poll() is None:
+            tracker.poll()
+            now = time.monotonic()
+            
+            for segment in tracker.segments + [tracker.current]:
+                for index, part in enumerate(segment['parts']):
+                    if (segment['msn'], index) in seen:
+                        continue
+                    seen.add((segment['msn'], index))
+                    
+                    media_time += part['duration']
+                    latencies.append(now - (launched + media_time))
+                    if first_part is None and part['independent']:
+                        first_part = now - launched
+            
+            if first_segment is None and tracker.segments:
+                first_segment = now - launched
+            
+            time.sleep(0.005)
+    
+    if not latencies:
+        print("No parts were produced; is ffmpeg available?")
+        return
+    
+    print(f"part target {settings['part_duration']}s, {len(latencies)} parts over {args.duration:g}s")
+    print(f"time to first playable part   {first_part:.3f}s")
+    if first_segment is not None:
+        print(f"time to first full segment    {first_segment:.3f}s")
+    print(f"part latency median           {statistics.median(latencies):.3f}s")
+    print(f"part latency p95              {percentile(latencies, 0.95):.3f}s")
+    print(f"part latency max              {max(latencies):.3f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Load test the stream media origin against plain static file serving.
+
+A writer publishes a synthetic live rendition into a temporary MEDIA_ROOT
+(a --segment-kb segment every --segment-time seconds plus a rewritten
+playlist). The app runs in a separate process on the threaded development
+server; --viewers client threads then loop for --duration seconds
+fetching the playlist and its newest segment, the way players at the live
+edge do. Each mode gets its own run:
+
+  baseline    send_from_directory, the generic Flask static handler
+              /static/streams was served by before
+  origin      /static/streams through media_origin (LRU, single-flight,
+              Cache-Control)
+
+Reports requests/sec and p50 / p99 latency per mode, and the origin's
+cache hits, misses and coalesced misses.
+
+Usage:
+    python benchmarks/origin_load.py --viewers 200 --duration 20
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PLAYLIST = 'hls/bench.m3u8'
+WINDOW = 6
+
+
+def serve(media_root, port):
+    os.environ['MEDIA_ROOT'] = media_root
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(media_root, 'bench.db')}"
+    os.chdir(media_root)
+
+    import logging
+    from flask import send_from_directory
+    from werkzeug.serving import make_server
+    from app import app
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.add_url_rule('/bench/baseline/<path:filename>', 'bench_baseline',
+                     lambda filename: send_from_directory(media_root, filename))
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def publish(media_root, segment_time, segment_kb, stop):
+    """Write segments and a sliding playlist like the HLS muxer does"""
+    directory = os.path.join(media_root, 'hls')
+    os.makedirs(directory, exist_ok=True)
+    payload = os.urandom(segment_kb * 1024)
+    sequence = 0
+
+    while not stop.is_set():
+        with open(os.path.join(directory, f'bench_{sequence}.m4s'), 'wb') as f:
+            f.write(payload)
+
+        first = max(0, sequence - WINDOW + 1)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', f'#EXT-X-TARGETDURATION:{segment_time}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first}']
+        for index in range(first, sequence + 1):
+            lines += [f'#EXTINF:{segment_time:.3f},', f'bench_{index}.m4s']
+        temporary = os.path.join(directory, 'bench.m3u8.tmp')
+        with open(temporary, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(temporary, os.path.join(directory, 'bench.m3u8'))
+
+        if sequence >= WINDOW * 2:
+            try:
+                os.remove(os.path.join(directory, f'bench_{sequence - WINDOW * 2}.m4s'))
+            except OSError:
+                pass
+        sequence += 1
+        stop.wait(segment_time)
+
+
+def fetch(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        body = response.read()
+        return response.status, body
+    finally:
+        connection.close()
+
+
+def viewer(port, prefix, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        status, body = fetch(port, f'{prefix}/{PLAYLIST}')
+        latencies.append(time.perf_counter() - started)
+        if status != 200:
+            errors.append(status)
+            continue
+
+        segment = [line for line in body.decode().splitlines() if line.endswith('.m4s')][-1]
+        started = time.perf_counter()
+        status, _ = fetch(port, f'{prefix}/hls/{segment}')
+        latencies.append(time.perf_counter() - started)
+        if status != 200:
+            errors.append(status)
+
+
+def run(port, prefix, viewers, duration):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=viewer, args=(port, prefix, deadline, latencies, errors))
+               for _ in range(viewers)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return len(latencies), len(latencies) / elapsed, statistics.median(ordered), p99, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--viewers', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--segment-time', type=int, default=2)
+    parser.add_argument('--segment-kb', type=int, default=1024, help='segment size (1 MiB ~ 4 Mbit/s at 2s)')
+    parser.add_argument('--port', type=int, default=5390)
+    args = parser.parse_args()
+
+    media_root = tempfile.mkdtemp(prefix='origin-bench-')
+    stop = threading.Event()
+    writer = threading.Thread(target=publish, args=(media_root, args.segment_time, args.segment_kb, stop))
+    writer.daemon = True
+    writer.start()
+
+    server = multiprocessing.Process(target=serve, args=(media_root, args.port))
+    server.daemon = True
+    server.start()
+    for _ in range(100):
+        try:
+            fetch(args.port, f'/bench/baseline/{PLAYLIST}')
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    print(f"{args.viewers} viewers, {args.segment_kb} KiB segments every {args.segment_time}s, "
+          f"{args.duration:.0f}s per mode ({media_root})")
+    print(f"{'mode':<10} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    try:
+        for mode, prefix in (('baseline', '/bench/baseline'), ('origin', '/static/streams')):
+            requests, rate, p50, p99, errors = run(args.port, prefix, args.viewers, args.duration)
+            print(f"{mode:<10} {requests:>9} {rate:>9.0f} {p50 * 1000:>9.2f} {p99 * 1000:>9.2f} {errors:>7}")
+
+        _, body = fetch(args.port, '/origin/stats')
+        print(f"origin cache: {json.loads(body)}")
+    finally:
+        stop.set()
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
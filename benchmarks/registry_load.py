@@ -0,0 +1,141 @@
+"""Load test control-plane lookups with and without the stream registry.
+
+Seeds --streams RTMP streams (marked running, with their default outputs)
+into a temporary database and serves the app in a separate process on the
+threaded development server. --clients threads then loop for --duration
+seconds over two endpoints, one endpoint at a time:
+
+  /stream/<id>/status   status polls of random streams
+  /rtmp/publish         publish callbacks for running streams' keys, the
+                        path nginx-rtmp hits on every (re)connect
+
+Each mode gets its own server process:
+
+  database    REGISTRY_TTL=0, every lookup reads the database
+  registry    lookups answered from the warmed in-memory registry
+
+Reports requests/sec and p50 / p99 latency per mode and endpoint.
+
+Usage:
+    python benchmarks/registry_load.py --clients 32 --duration 10
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def serve(directory, port, streams, ttl):
+    os.environ['MEDIA_ROOT'] = directory
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ['REGISTRY_TTL'] = str(ttl)
+    os.chdir(directory)
+
+    import logging
+    from werkzeug.serving import make_server
+    from app import app, db
+    from models import Stream
+    from stream_manager import stream_manager
+    from stream_registry import stream_registry
+
+    logging.getLogger().setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    with app.app_context():
+        if not Stream.query.count():
+            for index in range(streams):
+                stream_manager.create_stream(f'Bench {index}', f'rtmp://localhost:1935/live/bench{index}', 'rtmp',
+                                             qualities=['720p', '480p'])
+            Stream.query.update({'status': 'running'})
+            db.session.commit()
+        stream_registry.warm()
+
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def request(port, method, path, body=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'} if body else {}
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def client(port, endpoint, streams, deadline, latencies, errors):
+    while time.monotonic() < deadline:
+        index = random.randrange(streams)
+        started = time.perf_counter()
+        if endpoint == 'status':
+            status = request(port, 'GET', f'/stream/{index + 1}/status')
+        else:
+            status = request(port, 'POST', '/rtmp/publish', urlencode({'name': f'bench{index}'}))
+        latencies.append(time.perf_counter() - started)
+        if status != 200:
+            errors.append(status)
+
+
+def run(port, endpoint, streams, clients, duration):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=client, args=(port, endpoint, streams, deadline, latencies, errors))
+               for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    ordered = sorted(latencies)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    return len(latencies), len(latencies) / elapsed, statistics.median(ordered), p99, len(errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--streams', type=int, default=200)
+    parser.add_argument('--port', type=int, default=5391)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='registry-bench-')
+    print(f"{args.clients} clients, {args.streams} streams, {args.duration:.0f}s per run ({directory})")
+    print(f"{'mode':<10} {'endpoint':<9} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+
+    for mode, ttl in (('database', 0), ('registry', 3600)):
+        server = multiprocessing.Process(target=serve, args=(directory, args.port, args.streams, ttl))
+        server.daemon = True
+        server.start()
+        for _ in range(300):
+            try:
+                request(args.port, 'GET', '/stream/1/status')
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        try:
+            for endpoint in ('status', 'publish'):
+                requests, rate, p50, p99, errors = run(args.port, endpoint, args.streams, args.clients, args.duration)
+                print(f"{mode:<10} {endpoint:<9} {requests:>9} {rate:>9.0f} {p50 * 1000:>9.2f} "
+                      f"{p99 * 1000:>9.2f} {errors:>7}")
+        finally:
+            server.terminate()
+            server.join()
+
+
+if __name__ == '__main__':
+    main()
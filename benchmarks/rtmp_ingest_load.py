@@ -0,0 +1,148 @@
+"""Load-test the native RTMP ingest server.
+
+Starts RTMPServer on a local port with its transcoder hand-off replaced by a
+byte-counting sink, so only the ingest path (handshake, chunk reassembly,
+AMF0 commands, FLV tag muxing) is measured. N ffmpeg publishers push a
+looped, pre-encoded FLV clip in real time. Reports:
+
+  sessions         publishers that reached NetStream.Publish.Start
+  ingest           media bytes handed to sinks per second
+  server cpu       CPU-seconds used by this process per wall second
+  loop lag         extra delay of a 10 ms timer on the ingest loop
+                   (median / p95 / max)
+
+Usage:
+    python benchmarks/rtmp_ingest_load.py --publishers 50 --duration 30
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: F401  (initialises models before rtmp_server imports them)
+from config import FFMPEG_PATH
+from rtmp_server import RTMPServer
+
+
+class CountingSink:
+    def __init__(self, counters):
+        self.counters = counters
+
+    async def write(self, tag_type, timestamp, payload):
+        self.counters['bytes'] += len(payload)
+
+    def close(self):
+        pass
+
+
+class BenchmarkServer(RTMPServer):
+    """RTMPServer that counts media instead of starting transcoders"""
+
+    def __init__(self, port):
+        super().__init__(port=port, host='127.0.0.1')
+        self.counters = {'bytes': 0, 'published': 0}
+
+    async def open_sink(self, stream_key, client_ip):
+        self.counters['published'] += 1
+        return CountingSink(self.counters)
+
+    async def close_sink(self, stream_key):
+        pass
+
+
+async def measure_lag(samples, interval=0.01):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(time.monotonic() - started - interval)
+
+
+def encode_clip(path, bitrate):
+    subprocess.run([
+        FFMPEG_PATH, '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', '10', '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', f'{bitrate}k',
+        '-g', '60', '-c:a', 'aac', '-f', 'flv', path
+    ], check=True)
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--publishers', type=int, default=50, help='concurrent RTMP publishers')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure')
+    parser.add_argument('--bitrate', type=int, default=3000, help='clip video bitrate (kbps)')
+    parser.add_argument('--port', type=int, default=19350)
+    args = parser.parse_args()
+
+    server = BenchmarkServer(args.port)
+    if not server.start_server():
+        print("RTMP server failed to start")
+        return
+
+    lag = []
+    lag_task = asyncio.run_coroutine_threadsafe(measure_lag(lag), server.loop)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        clip = os.path.join(workdir, 'clip.flv')
+        encode_clip(clip, args.bitrate)
+
+        publishers = [
+            subprocess.Popen([
+                FFMPEG_PATH, '-v', 'error', '-re', '-stream_loop', '-1', '-i', clip,
+                '-c', 'copy', '-f', 'flv', f'rtmp://127.0.0.1:{args.port}/live/load{index}'
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for index in range(args.publishers)
+        ]
+
+        # Let every publisher connect before measuring
+        time.sleep(3)
+        lag.clear()
+        bytes_before = server.counters['bytes']
+        cpu_before = cpu_seconds()
+        started = time.monotonic()
+
+        time.sleep(args.duration)
+
+        wall = time.monotonic() - started
+        cpu = cpu_seconds() - cpu_before
+        ingested = server.counters['bytes'] - bytes_before
+        sessions = len(server.sessions)
+
+        for process in publishers:
+            process.terminate()
+        for process in publishers:
+            process.wait()
+
+    lag_task.cancel()
+    server.stop_server()
+
+    print(f"{args.publishers} publishers at {args.bitrate} kbps, {wall:.1f}s measured")
+    print(f"sessions          {sessions} connected, {server.counters['published']} published")
+    print(f"ingest            {ingested * 8 / wall / 1e6:.1f} Mbit/s")
+    print(f"server cpu        {cpu / wall:.3f} s/s ({cpu / wall / max(sessions, 1) * 1000:.2f} ms/s per session)")
+    if lag:
+        print(f"loop lag median   {statistics.median(lag) * 1000:.2f} ms")
+        print(f"loop lag p95      {percentile(lag, 0.95) * 1000:.2f} ms")
+        print(f"loop lag max      {max(lag) * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Measure stream startup latency with and without the encoder pool.
+
+Serves the app with its native RTMP server in a separate process, with
+--streams RTMP streams (CMAF packaging, --qualities at --latency) created
+up front. For each stream an ffmpeg publisher pushes a pre-encoded FLV clip
+in real time; the time is taken from the server entering the publish
+handler (the one /rtmp/publish calls) to the first segment listed in the
+stream's media playlist being served by the origin. Publishes are one at
+a time, --interval seconds apart, so the pool is refilled between them.
+
+Each mode gets its own server process and database:
+
+  cold      ENCODER_POOL empty, every publish spawns a full encoder
+  pool      ENCODER_POOL="<qualities>/<latency>/1", publishes attach to
+            the pre-spawned encoder and start a stream-copy packager
+
+Reports p50 / p95 / max startup latency per mode.
+
+Usage:
+    python benchmarks/startup_latency.py --streams 10 --qualities 720p+480p
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import queue
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def serve(directory, port, rtmp_port, streams, qualities, latency, pool, published):
+    os.environ['MEDIA_ROOT'] = os.path.join(directory, 'media')
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    os.environ['PACKAGING_MODE'] = 'cmaf'
+    os.environ['ENCODER_POOL'] = f"{'+'.join(qualities)}/{latency}/1" if pool else ''
+    os.chdir(directory)
+
+    import logging
+    from werkzeug.serving import make_server
+    from app import app
+    from stream_manager import stream_manager
+    from rtmp_server import rtmp_server
+
+    logging.getLogger().setLevel(logging.ERROR)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    rtmp_server.host = '127.0.0.1'
+    rtmp_server.port = rtmp_port
+
+    with app.app_context():
+        for index in range(streams):
+            stream_manager.create_stream(f'Startup {index}', rtmp_server.input_url(f'startup{index}'), 'rtmp',
+                                         qualities=qualities, latency_mode=latency)
+
+    handle_stream_publish = rtmp_server.handle_stream_publish
+
+    def timed_publish(stream_key, client_ip=None, native=False):
+        published.put((stream_key, time.time()))
+        return handle_stream_publish(stream_key, client_ip, native)
+
+    rtmp_server.handle_stream_publish = timed_publish
+    rtmp_server.start_server()
+    make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def first_segment(port, stream_id, deadline):
+    """Time at which the origin first serves a segment of the stream, or None"""
+    package = f'/static/streams/cmaf/stream_{stream_id}'
+    while time.time() < deadline:
+        status, body = get(port, f'{package}/media_0.m3u8')
+        if status == 200:
+            segments = [line for line in body.decode().splitlines() if line and not line.startswith('#')]
+            if segments and get(port, f'{package}/{segments[0]}')[0] == 200:
+                return time.time()
+        time.sleep(0.02)
+    return None
+
+
+def encode_clip(path, height):
+    from config import FFMPEG_PATH
+    subprocess.run([
+        FFMPEG_PATH, '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size={height * 16 // 9}x{height}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+        '-t', '30', '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', '3000k',
+        '-g', '30', '-c:a', 'aac', '-f', 'flv', path
+    ], check=True)
+
+
+def run(args, directory, clip, pool):
+    from config import FFMPEG_PATH
+
+    # Servers are spawned, not forked, so they import config after
+    # setting ENCODER_POOL
+    context = multiprocessing.get_context('spawn')
+    published = context.Queue()
+    server = context.Process(target=serve, args=(directory, args.port, args.rtmp_port, args.streams,
+                                                 args.qualities.split('+'), args.latency, pool, published))
+    server.daemon = True
+    server.start()
+    for _ in range(300):
+        try:
+            get(args.port, '/stream/1/status')
+            break
+        except OSError:
+            time.sleep(0.1)
+
+    latencies, failures = [], 0
+    try:
+        time.sleep(args.interval)
+        for index in range(args.streams):
+            publisher = subprocess.Popen([
+                FFMPEG_PATH, '-v', 'error', '-re', '-i', clip, '-c', 'copy', '-f', 'flv',
+                f'rtmp://127.0.0.1:{args.rtmp_port}/live/startup{index}'
+            ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                _, published_at = published.get(timeout=args.timeout)
+                served_at = first_segment(args.port, index + 1, published_at + args.timeout)
+                if served_at is None:
+                    failures += 1
+                else:
+                    latencies.append(served_at - published_at)
+            except queue.Empty:
+                failures += 1
+            finally:
+                publisher.terminate()
+                publisher.wait()
+            time.sleep(args.interval)
+    finally:
+        server.terminate()
+        server.join()
+    return latencies, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--streams', type=int, default=10, help='publishes per mode')
+    parser.add_argument('--qualities', default='720p', help='ladder, e.g. 1080p+720p+480p')
+    parser.add_argument('--latency', default='low', help='Stream.latency_mode of the streams')
+    parser.add_argument('--interval', type=float, default=3, help='seconds between publishes')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a first segment')
+    parser.add_argument('--port', type=int, default=5392)
+    parser.add_argument('--rtmp-port', type=int, default=19351)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='startup-bench-')
+    clip = os.path.join(workdir, 'clip.flv')
+    encode_clip(clip, max(int(quality.rstrip('p')) for quality in args.qualities.split('+')))
+
+    print(f"{args.streams} publishes per mode, ladder {args.qualities} at {args.latency} latency ({workdir})")
+    print(f"{'mode':<6} {'started':>8} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'failed':>7}")
+    for mode in ('cold', 'pool'):
+        directory = os.path.join(workdir, mode)
+        os.makedirs(directory)
+        latencies, failures = run(args, directory, clip, mode == 'pool')
+        if not latencies:
+            print(f"{mode:<6} {0:>8} {'-':>9} {'-':>9} {'-':>9} {failures:>7}")
+            continue
+
+        ordered = sorted(latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        print(f"{mode:<6} {len(latencies):>8} {statistics.median(ordered) * 1000:>9.0f} "
+              f"{p95 * 1000:>9.0f} {ordered[-1] * 1000:>9.0f} {failures:>7}")
+
+
+if __name__ == '__main__':
+    main()
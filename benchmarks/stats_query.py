@@ -0,0 +1,132 @@
+"""Benchmark StreamStats query latency with indexes, rollups and retention.
+
+Seeds a throwaway SQLite database with --rows raw StreamStats rows spread
+over --streams streams at the 5s persist interval (10M rows over 100
+streams is ~5.8 days each), then reports median / p95 latency of:
+
+  latest, no index     the previous ORDER BY timestamp DESC LIMIT 100
+                       without the (stream_id, timestamp) index
+  latest, indexed      the same query with the index
+  raw range Nh         indexed raw-row range scans before compaction
+  api range Nh         StatsCompactor.query_range after the compactor has
+                       built the rollups and pruned raw rows past 24h
+
+Usage:
+    python benchmarks/stats_query.py --rows 10000000 --streams 100
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKDIR = tempfile.mkdtemp(prefix='stats-bench-')
+DATABASE = os.path.join(WORKDIR, 'stats.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DATABASE}'
+os.chdir(WORKDIR)
+
+from app import app
+from models import Stream, db
+from config import STATS_SETTINGS
+from stats_retention import stats_compactor
+
+INDEX = 'ix_stream_stats_stream_timestamp'
+INTERVAL = STATS_SETTINGS['persist_interval']
+
+
+def seed(streams, rows, now):
+    with app.app_context():
+        db.session.add_all([Stream(name=f'bench {index}', input_url='rtmp://bench', input_type='rtmp')
+                            for index in range(streams)])
+        db.session.commit()
+        stream_ids = [stream.id for stream in Stream.query.all()]
+
+    connection = sqlite3.connect(DATABASE)
+    connection.execute(f'DROP INDEX IF EXISTS {INDEX}')
+    per_stream = rows // streams
+    start = now - timedelta(seconds=per_stream * INTERVAL)
+
+    def generate():
+        # Interleave streams in time order, as live collection would
+        for step in range(per_stream):
+            timestamp = (start + timedelta(seconds=step * INTERVAL)).strftime('%Y-%m-%d %H:%M:%S.%f')
+            for stream_id in stream_ids:
+                yield (stream_id, timestamp, random.randint(0, 500), random.uniform(2000, 3000),
+                       random.uniform(29, 30), random.uniform(0, 1), 1.0, 0, 0, step * INTERVAL)
+
+    connection.executemany(
+        'INSERT INTO stream_stats (stream_id, timestamp, viewers, bitrate, frame_rate, packet_loss, '
+        'speed, dropped_frames, duplicate_frames, out_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        generate()
+    )
+    connection.commit()
+    return connection, stream_ids
+
+
+def measure(name, runs, query):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        query()
+        timings.append(time.perf_counter() - started)
+    ordered = sorted(timings)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    print(f"{name:<22} {statistics.median(timings) * 1000:>10.2f} {p95 * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--streams', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=50, help='queries per measurement')
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    started = time.monotonic()
+    connection, stream_ids = seed(args.streams, args.rows, now)
+    print(f"seeded {args.rows} rows for {args.streams} streams in {time.monotonic() - started:.1f}s ({DATABASE})")
+
+    latest = ('SELECT * FROM stream_stats WHERE stream_id = ? ORDER BY timestamp DESC LIMIT 100')
+    print(f"{'query':<22} {'median ms':>10} {'p95 ms':>10}")
+    measure('latest, no index', min(args.runs, 5),
+            lambda: connection.execute(latest, (random.choice(stream_ids),)).fetchall())
+
+    started = time.monotonic()
+    with app.app_context():
+        for index in db.metadata.tables['stream_stats'].indexes:
+            index.create(db.engine, checkfirst=True)
+    print(f"built (stream_id, timestamp) index in {time.monotonic() - started:.1f}s")
+
+    measure('latest, indexed', args.runs,
+            lambda: connection.execute(latest, (random.choice(stream_ids),)).fetchall())
+
+    ranges = [('1h', 3600), ('24h', 86400), ('7d', 7 * 86400)]
+    raw_range = ('SELECT * FROM stream_stats WHERE stream_id = ? AND timestamp >= ? AND timestamp < ? '
+                 'ORDER BY timestamp')
+    for label, seconds in ranges:
+        since = (now - timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S.%f')
+        until = now.strftime('%Y-%m-%d %H:%M:%S.%f')
+        measure(f'raw range {label}', min(args.runs, 10),
+                lambda: connection.execute(raw_range, (random.choice(stream_ids), since, until)).fetchall())
+    connection.close()
+
+    with app.app_context():
+        started = time.monotonic()
+        stats_compactor.run_once(now + timedelta(minutes=1))
+        print(f"compacted and pruned in {time.monotonic() - started:.1f}s")
+
+        for label, seconds in ranges + [('30d', 30 * 86400)]:
+            since = now - timedelta(seconds=seconds)
+            resolution = stats_compactor.pick_resolution(since, now)
+            measure(f'api range {label} ({resolution or "raw"})', args.runs,
+                    lambda: stats_compactor.query_range(random.choice(stream_ids), since, now))
+
+
+if __name__ == '__main__':
+    main()
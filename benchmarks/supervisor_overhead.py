@@ -0,0 +1,139 @@
+"""Benchmark per-stream overhead of supervising ffmpeg processes.
+
+Spawns N dummy processes that print ffmpeg-style progress to stderr
+(carriage-return separated, several updates per second) and reads them for a
+fixed time with either:
+
+  threads       one reader thread per process iterating stderr in text
+                mode (the previous FFmpegService._monitor_stream)
+  supervisor    process_supervisor, one selector thread for all pipes
+
+Each configuration runs in a fresh interpreter. Reports this process's CPU
+and RSS growth per supervised stream plus its thread count.
+
+Usage:
+    python benchmarks/supervisor_overhead.py --counts 10 100 500 --duration 20
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Emits a stats line every 0.25s like "frame= 120 fps= 30 ... speed=1.00x\r"
+DUMMY = [
+    'perl', '-e',
+    '$| = 1; my $n = 0; while (1) { $n += 8; '
+    'print STDERR "frame=$n fps=30 q=23.0 size=1024kB time=00:00:04.00 bitrate=2000.0kbits/s speed=1.00x\\r"; '
+    'select(undef, undef, undef, 0.25) }'
+]
+
+
+def rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_threads(count, duration):
+    lines = [0]
+
+    def monitor(process):
+        for line in process.stderr:
+            if line.strip():
+                lines[0] += 1
+
+    processes = []
+    for _ in range(count):
+        process = subprocess.Popen(DUMMY, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   universal_newlines=True)
+        thread = threading.Thread(target=monitor, args=(process,))
+        thread.daemon = True
+        thread.start()
+        processes.append(process)
+
+    def stop():
+        for process in processes:
+            process.kill()
+            process.wait()
+
+    return lines, stop
+
+
+def run_supervisor(count, duration):
+    from process_supervisor import process_supervisor
+    lines = [0]
+
+    def on_output(key, source, line):
+        lines[0] += 1
+
+    for index in range(count):
+        process_supervisor.start(index, DUMMY, on_output=on_output)
+
+    def stop():
+        for index in range(count):
+            process_supervisor.stop(index, timeout=1)
+
+    return lines, stop
+
+
+def worker(mode, count, duration):
+    rss_before = rss_kb()
+    runner = run_threads if mode == 'threads' else run_supervisor
+    lines, stop = runner(count, duration)
+
+    # Let every process start before measuring
+    time.sleep(2)
+    cpu_before = cpu_seconds()
+    lines_before = lines[0]
+    time.sleep(duration)
+    cpu = cpu_seconds() - cpu_before
+    result = {
+        'cpu': cpu,
+        'rss_kb': rss_kb() - rss_before,
+        'threads': threading.active_count(),
+        'lines': lines[0] - lines_before
+    }
+    stop()
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--duration', type=float, default=20, help='seconds measured per run')
+    parser.add_argument('--worker', nargs=2, metavar=('MODE', 'COUNT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker[0], int(args.worker[1]), args.duration)
+        return
+
+    print(f"{'mode':<12} {'streams':>8} {'threads':>8} {'lines/s':>9} "
+          f"{'cpu ms/s/stream':>16} {'rss KiB/stream':>15}")
+    for count in args.counts:
+        for mode in ('threads', 'supervisor'):
+            output = subprocess.run(
+                [sys.executable, __file__, '--worker', mode, str(count), '--duration', str(args.duration)],
+                stdout=subprocess.PIPE, check=True, universal_newlines=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            cpu_per_stream = result['cpu'] / args.duration / count * 1000
+            print(f"{mode:<12} {count:>8} {result['threads']:>8} {result['lines'] / args.duration:>9.0f} "
+                  f"{cpu_per_stream:>16.3f} {result['rss_kb'] / count:>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
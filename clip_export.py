@@ -0,0 +1,118 @@
+import os
+import subprocess
+import threading
+import logging
+from config import FFMPEG_PATH, CLIP_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+class ClipExporter:
+    """Cuts MP4 clips out of packaged segments without re-encoding.
+    
+    Each track's covering segments (init segment first) are read through
+    ffmpeg's concat protocol and stream-copied into a fragmented MP4 on
+    stdout, which is handed to the response as it is produced. A bounded
+    number of exports run at once, below the priority of live encodes.
+    """
+    
+    def __init__(self):
+        self.slots = threading.BoundedSemaphore(CLIP_SETTINGS['workers'])
+        self.lock = threading.Lock()
+        self.active = 0
+        self.exported = 0
+        self.busy = 0
+        self.failed = 0
+    
+    def build_command(self, inputs, duration):
+        """ffmpeg command for inputs [(paths, offset)], one per track"""
+        cmd = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'error', '-nostdin']
+        for paths, offset in inputs:
+            cmd.extend(['-ss', f'{offset:.3f}', '-i', 'concat:' + '|'.join(paths)])
+        for index in range(len(inputs)):
+            cmd.extend(['-map', str(index)])
+        
+        # A pipe cannot be seeked back into, so the MP4 is fragmented
+        cmd.extend([
+            '-t', f'{duration:.3f}',
+            '-c', 'copy',
+            '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+            '-f', 'mp4',
+            'pipe:1'
+        ])
+        return cmd
+    
+    def export(self, inputs, duration):
+        """Return (status, body); body iterates over MP4 chunks on 200"""
+        if not self.slots.acquire(timeout=CLIP_SETTINGS['queue_timeout']):
+            with self.lock:
+                self.busy += 1
+            return 503, 'All clip export workers are busy'
+        
+        try:
+            process = subprocess.Popen(self.build_command(inputs, duration),
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            self.slots.release()
+            logger.error(f"Could not start clip export: {e}")
+            return 500, 'Clip export failed'
+        
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, CLIP_SETTINGS['nice'])
+        except (AttributeError, OSError):
+            pass
+        
+        with self.lock:
+            self.active += 1
+        
+        # Wait for the first bytes so a failed cut is an error, not an empty 200
+        chunks = self._stream(process)
+        first = next(chunks, None)
+        if first is None:
+            return 500, 'Clip export failed'
+        return 200, self._prepend(first, chunks)
+    
+    def _stream(self, process):
+        succeeded = False
+        try:
+            while True:
+                chunk = process.stdout.read(CLIP_SETTINGS['chunk_size'])
+                if not chunk:
+                    break
+                yield chunk
+            succeeded = process.wait() == 0
+            if not succeeded:
+                logger.error(f"Clip export failed: {process.stderr.read().decode(errors='replace').strip()}")
+        finally:
+            # Also reached when the client disconnects mid-download
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            process.stderr.close()
+            self.slots.release()
+            with self.lock:
+                self.active -= 1
+                if succeeded:
+                    self.exported += 1
+                else:
+                    self.failed += 1
+    
+    def _prepend(self, first, chunks):
+        try:
+            yield first
+            yield from chunks
+        finally:
+            chunks.close()
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                'workers': CLIP_SETTINGS['workers'],
+                'active': self.active,
+                'exported': self.exported,
+                'busy': self.busy,
+                'failed': self.failed
+            }
+
+# Global clip exporter instance
+clip_exporter = ClipExporter()
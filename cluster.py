@@ -0,0 +1,322 @@
+import hmac
+import json
+import os
+import time
+import socket
+import threading
+import logging
+import urllib.request
+from ffmpeg_service import ffmpeg_service
+from admission_control import admission_controller
+from event_bus import event_bus
+from config import CLUSTER_SETTINGS, ADMISSION_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+TOKEN_HEADER = 'X-Cluster-Token'
+
+def call_node(base_url, path, payload=None):
+    """POST (or GET without payload) JSON to another node; None on failure"""
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    request = urllib.request.Request(base_url.rstrip('/') + path, data=data)
+    request.add_header('Content-Type', 'application/json')
+    if CLUSTER_SETTINGS['token']:
+        request.add_header(TOKEN_HEADER, CLUSTER_SETTINGS['token'])
+    
+    try:
+        with urllib.request.urlopen(request, timeout=CLUSTER_SETTINGS['request_timeout']) as response:
+            return json.loads(response.read() or b'{}')
+    except Exception as e:
+        logger.warning(f"Cluster request {base_url}{path} failed: {e}")
+        return None
+
+def authorized(headers):
+    """Whether a request carries the shared cluster token; never true without one"""
+    token = CLUSTER_SETTINGS['token']
+    if not token:
+        return False
+    return hmac.compare_digest(headers.get(TOKEN_HEADER, '').encode('utf-8'), token.encode('utf-8'))
+
+def require_token():
+    """Refuse to run as a coordinator or worker without CLUSTER_TOKEN"""
+    if CLUSTER_SETTINGS['mode'] != 'standalone' and not CLUSTER_SETTINGS['token']:
+        raise RuntimeError(f"CLUSTER_MODE={CLUSTER_SETTINGS['mode']} requires CLUSTER_TOKEN to be set")
+
+def outputs_within(output_configs, root):
+    """Whether every file the output configs write resolves under root"""
+    root = os.path.realpath(root)
+    for config in output_configs:
+        for key in ('output_path', 'master_path'):
+            path = config.get(key)
+            if path is None:
+                continue
+            if os.path.commonpath([root, os.path.realpath(path)]) != root:
+                return False
+    return True
+
+class Coordinator:
+    """Assigns streams to encoder workers and moves them when one dies.
+    
+    Workers announce themselves with heartbeats carrying their capacity,
+    the streams they run and the events those streams raised, which are
+    republished on this node's event bus for its SSE clients. A stream goes to the live worker with the
+    most headroom that admits it. Streams on a worker that stops sending
+    heartbeats, or that no longer reports them, are started elsewhere;
+    streams no worker accepts wait as pending and are retried.
+    """
+    
+    def __init__(self):
+        self.workers = {}
+        self.assignments = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.app = None
+        self.launcher = None
+    
+    def start(self, app, launcher):
+        """Start the monitor; launcher(stream_id) restarts an orphaned or pending stream"""
+        with self.lock:
+            self.app = app
+            self.launcher = launcher
+            if self.thread and self.thread.is_alive():
+                return
+            
+            self.thread = threading.Thread(target=self._monitor_loop, name='cluster-coordinator')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def heartbeat(self, payload):
+        """Record a worker heartbeat; returns streams the worker must stop"""
+        worker_id = payload['worker_id']
+        stop = []
+        with self.lock:
+            if worker_id not in self.workers:
+                logger.info(f"Worker {worker_id} joined at {payload['url']}")
+            self.workers[worker_id] = {
+                'url': payload['url'],
+                'capacity': payload.get('capacity', 0),
+                'headroom': payload.get('headroom', 0),
+                'streams': set(payload.get('streams', [])),
+                'last_seen': time.monotonic()
+            }
+            
+            for stream_id in payload.get('streams', []):
+                assignment = self.assignments.get(stream_id)
+                if assignment is None and stream_id not in self.pending:
+                    # Still running from before a coordinator restart
+                    self.assignments[stream_id] = {'worker_id': worker_id, 'assigned_at': time.monotonic()}
+                elif assignment is None or assignment['worker_id'] != worker_id:
+                    # Reassigned while this worker was unreachable
+                    stop.append(stream_id)
+        
+        for event, stream_id, data in payload.get('events', []):
+            if stream_id not in stop:
+                event_bus.publish(event, stream_id, data)
+        
+        if stop:
+            logger.warning(f"Worker {worker_id} still runs reassigned streams {stop}, stopping them")
+        return stop
+    
+    def _live_workers(self):
+        cutoff = time.monotonic() - CLUSTER_SETTINGS['heartbeat_timeout']
+        return {worker_id: worker for worker_id, worker in self.workers.items() if worker['last_seen'] >= cutoff}
+    
+    def assign(self, stream_id, payload):
+        """Start a stream on the worker with the most headroom that admits it.
+        
+        Returns the worker id, or None when no worker started it. The
+        stream is left pending unless every worker failed to start it.
+        """
+        with self.lock:
+            candidates = sorted(self._live_workers().items(), key=lambda item: -item[1]['headroom'])
+        
+        failures = 0
+        for worker_id, worker in candidates:
+            result = call_node(worker['url'], f'/worker/streams/{stream_id}/start', payload)
+            if result and result.get('action') == 'failed':
+                failures += 1
+            if not result or result.get('action') != 'start':
+                continue
+            
+            with self.lock:
+                self.assignments[stream_id] = {'worker_id': worker_id, 'assigned_at': time.monotonic()}
+                self.pending.pop(stream_id, None)
+                # Count the new stream against the worker until its next heartbeat
+                worker['headroom'] -= result.get('cost', 0)
+                worker['streams'].add(stream_id)
+            logger.info(f"Stream {stream_id} assigned to worker {worker_id}")
+            return worker_id
+        
+        if candidates and failures == len(candidates):
+            with self.lock:
+                self.pending.pop(stream_id, None)
+            logger.error(f"Every worker failed to start stream {stream_id}")
+            return None
+        
+        with self.lock:
+            self.pending.setdefault(stream_id, time.monotonic())
+        logger.warning(f"No worker could take stream {stream_id}, waiting for capacity")
+        return None
+    
+    def release(self, stream_id):
+        """Stop a stream on its worker; False if it was not assigned"""
+        with self.lock:
+            assignment = self.assignments.pop(stream_id, None)
+            pending = self.pending.pop(stream_id, None) is not None
+            worker = self.workers.get(assignment['worker_id']) if assignment else None
+            if worker:
+                worker['streams'].discard(stream_id)
+        
+        if worker:
+            call_node(worker['url'], f'/worker/streams/{stream_id}/stop', {})
+        return assignment is not None or pending
+    
+    def worker_for(self, stream_id):
+        assignment = self.assignments.get(stream_id)
+        return assignment['worker_id'] if assignment else None
+    
+    def is_pending(self, stream_id):
+        return stream_id in self.pending
+    
+    def is_assigned(self, stream_id):
+        return stream_id in self.assignments
+    
+    def update_destinations(self, stream_id, destinations):
+        """Swap a remote stream's relays; None if its encoder has no fan-out"""
+        with self.lock:
+            assignment = self.assignments.get(stream_id)
+            worker = self.workers.get(assignment['worker_id']) if assignment else None
+        if not worker:
+            return False
+        
+        result = call_node(worker['url'], f'/worker/streams/{stream_id}/destinations',
+                           {'destinations': destinations})
+        return result.get('result') if result else False
+    
+    def _monitor_loop(self):
+        while True:
+            time.sleep(CLUSTER_SETTINGS['heartbeat_interval'])
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Error monitoring workers: {e}")
+    
+    def check(self):
+        """Reassign streams of dead workers and retry pending streams"""
+        now = time.monotonic()
+        with self.lock:
+            live = self._live_workers()
+            for worker_id in set(self.workers) - set(live):
+                logger.warning(f"Worker {worker_id} missed its heartbeats, reassigning its streams")
+                del self.workers[worker_id]
+            
+            orphaned = []
+            for stream_id, assignment in list(self.assignments.items()):
+                worker = live.get(assignment['worker_id'])
+                settled = now - assignment['assigned_at'] >= CLUSTER_SETTINGS['heartbeat_timeout']
+                # A worker that restarted comes back without its streams
+                if worker is None or (settled and stream_id not in worker['streams']):
+                    del self.assignments[stream_id]
+                    orphaned.append(stream_id)
+            
+            expired = [stream_id for stream_id, since in self.pending.items()
+                       if now - since > ADMISSION_SETTINGS['queue_timeout']]
+            for stream_id in expired:
+                del self.pending[stream_id]
+            retry = [stream_id for stream_id in self.pending if stream_id not in orphaned]
+        
+        if expired:
+            logger.warning(f"Streams {expired} gave up waiting for a worker")
+        if not (orphaned or retry or expired):
+            return
+        
+        with self.app.app_context():
+            for stream_id in orphaned + retry:
+                self.launcher(stream_id)
+            if expired:
+                self._mark_expired(expired)
+    
+    def _mark_expired(self, stream_ids):
+        # Imported here so workers can use this module without the models
+        from models import Stream, db
+        
+        for stream in Stream.query.filter(Stream.id.in_(stream_ids), Stream.status == 'queued'):
+            stream.status = 'error'
+            stream.worker_id = None
+            event_bus.publish_status(stream.id, 'error')
+        db.session.commit()
+    
+    def get_status(self):
+        """Workers, assignments and pending streams"""
+        now = time.monotonic()
+        with self.lock:
+            live = self._live_workers()
+            return {
+                'workers': [{
+                    'worker_id': worker_id,
+                    'url': worker['url'],
+                    'alive': worker_id in live,
+                    'capacity': worker['capacity'],
+                    'headroom': worker['headroom'],
+                    'streams': sorted(worker['streams']),
+                    'last_seen': round(now - worker['last_seen'], 1)
+                } for worker_id, worker in self.workers.items()],
+                'assignments': {stream_id: assignment['worker_id']
+                                for stream_id, assignment in self.assignments.items()},
+                'pending': sorted(self.pending)
+            }
+
+class WorkerAgent:
+    """Runs encodes for a coordinator and reports capacity in heartbeats"""
+    
+    def __init__(self):
+        self.worker_id = None
+        self.url = None
+        self.thread = None
+        self.stop_encoder = None
+        self.event_position = 0
+    
+    def start(self, stop_encoder, port=None):
+        """Start sending heartbeats (idempotent).
+        
+        stop_encoder(stream_id) stops streams the coordinator moved away.
+        """
+        if self.thread and self.thread.is_alive():
+            return
+        
+        self.stop_encoder = stop_encoder
+        
+        self.url = CLUSTER_SETTINGS['worker_url'] or f"http://{socket.gethostname()}:{port}"
+        self.worker_id = CLUSTER_SETTINGS['worker_id'] or self.url.split('://', 1)[-1]
+        self.thread = threading.Thread(target=self._heartbeat_loop, name='cluster-heartbeat')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info(f"Worker {self.worker_id} reporting to {CLUSTER_SETTINGS['coordinator_url']}")
+    
+    def _heartbeat_loop(self):
+        while True:
+            try:
+                admission_controller.sample()
+                status = admission_controller.get_status()
+                position, events = event_bus.events_since(self.event_position)
+                response = call_node(CLUSTER_SETTINGS['coordinator_url'], '/cluster/heartbeat', {
+                    'worker_id': self.worker_id,
+                    'url': self.url,
+                    'capacity': status['capacity'],
+                    'headroom': status['headroom'],
+                    'streams': ffmpeg_service.list_active_streams(),
+                    'events': events
+                })
+                # Events are sent again with the next heartbeat if this one failed
+                if response is not None:
+                    self.event_position = position
+                for stream_id in (response or {}).get('stop', []):
+                    self.stop_encoder(stream_id)
+            except Exception as e:
+                logger.error(f"Error sending heartbeat: {e}")
+            time.sleep(CLUSTER_SETTINGS['heartbeat_interval'])
+
+# Global cluster instances; which one is used depends on CLUSTER_SETTINGS['mode']
+coordinator = Coordinator()
+worker_agent = WorkerAgent()
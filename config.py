@@ -1,16 +1,19 @@
 import os
 
-# Video encoding presets
+# Video encoding presets, fastest first; cost is libx264 CPU relative to veryfast
 VIDEO_PRESETS = {
-    'ultrafast': {'preset': 'ultrafast', 'crf': 28},
-    'superfast': {'preset': 'superfast', 'crf': 26},
-    'veryfast': {'preset': 'veryfast', 'crf': 24},
-    'faster': {'preset': 'faster', 'crf': 23},
-    'fast': {'preset': 'fast', 'crf': 22},
-    'medium': {'preset': 'medium', 'crf': 21},
-    'slow': {'preset': 'slow', 'crf': 20},
+    'ultrafast': {'preset': 'ultrafast', 'crf': 28, 'cost': 0.4},
+    'superfast': {'preset': 'superfast', 'crf': 26, 'cost': 0.6},
+    'veryfast': {'preset': 'veryfast', 'crf': 24, 'cost': 1.0},
+    'faster': {'preset': 'faster', 'crf': 23, 'cost': 1.6},
+    'fast': {'preset': 'fast', 'crf': 22, 'cost': 2.0},
+    'medium': {'preset': 'medium', 'crf': 21, 'cost': 2.6},
+    'slow': {'preset': 'slow', 'crf': 20, 'cost': 4.2},
 }
 
+# Preset used for live ladder encodes
+DEFAULT_VIDEO_PRESET = 'veryfast'
+
 # Resolution and bitrate settings
 QUALITY_PROFILES = {
     '240p': {'width': 426, 'height': 240, 'bitrate': 400},
@@ -39,6 +42,23 @@ HLS_SETTINGS = {
     }
 }
 
+# Low-Latency HLS (partial segments + blocking playlist reload) per latency
+# mode; modes without an entry use regular full-segment playlists
+LL_HLS_SETTINGS = {
+    'low_latency': {
+        'part_duration': 0.2,
+        'playlist_segments': 6,
+        'part_segments': 3
+    }
+}
+
+# Stream.latency_mode values mapped to HLS_SETTINGS / DASH_SETTINGS keys
+LATENCY_MODES = {
+    'low': 'low_latency',
+    'tutorial': 'tutorial',
+    'high': 'high_quality',
+}
+
 # DASH settings
 DASH_SETTINGS = {
     'low_latency': {
@@ -58,6 +78,13 @@ DASH_SETTINGS = {
     }
 }
 
+# Audio is encoded once and shared by every rendition
+AUDIO_BITRATE = 128
+
+# Packaging mode for new streams: 'cmaf' packages each rendition once as
+# fMP4 shared by HLS and DASH, 'separate' muxes HLS and DASH independently
+PACKAGING_MODE = os.environ.get('PACKAGING_MODE', 'cmaf')
+
 # Platform-specific RTMP endpoints
 PLATFORM_ENDPOINTS = {
     'tutorial': 'rtmp://tutorial-platform.com/live/',
@@ -70,3 +97,244 @@ PLATFORM_ENDPOINTS = {
 # FFmpeg paths
 FFMPEG_PATH = os.environ.get('FFMPEG_PATH', 'ffmpeg')
 FFPROBE_PATH = os.environ.get('FFPROBE_PATH', 'ffprobe')
+
+# Restart policy for supervised FFmpeg processes that exit unexpectedly;
+# the delay doubles per consecutive failure and resets after a stable run
+PROCESS_RESTART = {
+    'initial_delay': 1,
+    'max_delay': 60,
+    'stable_after': 30
+}
+
+# Encoder stats from ffmpeg -progress: samples kept in memory per stream,
+# seconds between persisted samples per stream, and seconds between
+# batched StreamStats inserts
+STATS_SETTINGS = {
+    'ring_size': 120,
+    'persist_interval': 5,
+    'flush_interval': 10
+}
+
+# Stats retention: raw StreamStats rows are kept for 'raw' seconds and
+# rolled up into min/avg/max buckets, each level built from the previous one
+STATS_RETENTION = {
+    'raw': 24 * 3600,
+    'rollups': [
+        {'resolution': 60, 'retention': 30 * 24 * 3600},
+        {'resolution': 3600, 'retention': 365 * 24 * 3600},
+    ],
+    'compact_interval': 60,
+    'settle_time': 30,        # wait for batched stats writes before closing a bucket
+    'max_window': 6 * 3600,   # seconds of source data compacted per level per run
+    'max_points': 500         # range queries pick the finest level within this many points
+}
+
+# RTMP destinations are stream-copy relays fed from a local fan-out point;
+# a relay that falls more than high_water bytes behind skips to the next
+# keyframe instead of slowing the encoder or other destinations
+RELAY_SETTINGS = {
+    'host': '127.0.0.1',
+    'high_water': 4 * 1024 * 1024
+}
+
+# Input probing for passthrough: seconds of packets read to measure the
+# GOP, ffprobe timeout, and how long results are cached per stream key
+PROBE_SETTINGS = {
+    'gop_window': 4,
+    'timeout': 15,
+    'cache_ttl': 24 * 3600
+}
+
+# Admission control for encodes. Costs are in CPU cores: base_cost per
+# channel (decode, audio, muxing) plus encoded pixels per second divided
+# by pixels_per_core at the veryfast preset. capacity (cores) defaults to
+# the CPUs available to the process; reserve is the fraction held back.
+# A channel that does not fit even at fastest_preset is queued (pulled
+# inputs) or refused (when_full = 'reject', and always for pushed RTMP).
+ADMISSION_SETTINGS = {
+    'capacity': float(os.environ.get('ENCODE_CAPACITY', 0)) or None,
+    'reserve': 0.15,
+    'base_cost': 0.15,
+    'pixels_per_core': 35000000,
+    'frame_rate': 30,
+    'fastest_preset': 'superfast',
+    'when_full': 'queue',
+    'queue_timeout': 300,
+    'sample_interval': 5,
+    'warmup': 15              # seconds before a new encode's CPU and speed are trusted
+}
+
+# Multi-node encoding. 'standalone' runs every encode in this process; a
+# 'coordinator' assigns pulled streams to 'worker' processes (worker.py),
+# which send heartbeats with their capacity. Pushed RTMP ingest always
+# encodes on the node that accepted the connection. Nodes share
+# DATABASE_URL and MEDIA_ROOT and authenticate with CLUSTER_TOKEN, which
+# coordinator and worker modes refuse to start without.
+CLUSTER_SETTINGS = {
+    'mode': os.environ.get('CLUSTER_MODE', 'standalone'),
+    'coordinator_url': os.environ.get('COORDINATOR_URL', 'http://127.0.0.1:5000'),
+    'worker_url': os.environ.get('WORKER_URL'),
+    'worker_id': os.environ.get('WORKER_ID'),
+    'token': os.environ.get('CLUSTER_TOKEN'),
+    'heartbeat_interval': 2,
+    'heartbeat_timeout': 10,
+    'request_timeout': 10
+}
+
+# Media origin for /static/streams: playlists and segments written within
+# hot_window seconds are served from an LRU of up to cache_bytes; other
+# files are sent from disk. Segments younger than settle_time may still be
+# growing and get the short playlist max-age instead of immutable.
+ORIGIN_SETTINGS = {
+    'cache_bytes': 256 * 1024 * 1024,
+    'max_entry_bytes': 16 * 1024 * 1024,
+    'hot_window': 120,
+    'settle_time': 2,
+    'playlist_max_age': 1,
+    'segment_max_age': 365 * 24 * 3600,
+    'read_timeout': 10
+}
+
+# Live segment storage under MEDIA_ROOT (point it at tmpfs, e.g.
+# /dev/shm/streams, to keep origin I/O in RAM). The janitor removes
+# segments older than segment_ttl, trims streams over stream_budget bytes
+# oldest first (never files newer than min_age), and deletes files of
+# streams that are not live after orphan_grace seconds.
+STORAGE_SETTINGS = {
+    'stream_budget': int(os.environ.get('STREAM_STORAGE_BUDGET', 256 * 1024 * 1024)),
+    'segment_ttl': 120,
+    'min_age': 30,
+    'orphan_grace': 60,
+    'janitor_interval': 10
+}
+
+# DVR / timeshift. Streams with a dvr_window keep that many seconds of
+# segments on disk (the muxer stops deleting them and the janitor keeps
+# them up to dvr_budget bytes) and get app-served playlists built from a
+# time index of those segments: a sliding window and any start/end range.
+DVR_SETTINGS = {
+    'max_window': 6 * 3600,
+    'dvr_budget': int(os.environ.get('DVR_STORAGE_BUDGET', 8 * 1024 * 1024 * 1024)),
+    'poll_interval': 0.5,
+    'cached_playlists': 32
+}
+
+# Recording from the live packager output: the top rendition's segments
+# are appended to growing files under RECORDINGS_DIR as they are written
+# (init segment first for fMP4) and remuxed into one MP4 with -c copy when
+# the stream stops. remux_timeout bounds that remux.
+RECORDING_SETTINGS = {
+    'poll_interval': 1,
+    'copy_buffer': 1024 * 1024,
+    'remux': True,
+    'remux_timeout': 600
+}
+
+# Clip export from the DVR buffer. Covering segments are stream-copied,
+# never re-encoded, by at most `workers` ffmpeg processes at a time, each
+# run `nice` steps below live encodes. A request waits up to queue_timeout
+# seconds for a free worker.
+CLIP_SETTINGS = {
+    'workers': 2,
+    'max_duration': 600,
+    'queue_timeout': 5,
+    'nice': 10,
+    'chunk_size': 64 * 1024
+}
+
+# Server-Sent Events feed (/events). Status changes are pushed as they
+# happen and stats at most every stats_interval seconds per stream, as
+# deltas. The last `backlog` events are kept so reconnecting clients can
+# resume from Last-Event-ID; idle connections get a keepalive comment.
+EVENT_SETTINGS = {
+    'stats_interval': 2,
+    'backlog': 1000,
+    'keepalive': 15
+}
+
+# In-memory stream registry. Stream rows with their outputs and
+# destinations are read from memory; writes go to the database and
+# through to the registry when they commit. ttl bounds how stale an entry
+# can get when another process writes the same database (0 reads every
+# lookup from the database).
+REGISTRY_SETTINGS = {
+    'ttl': float(os.environ.get('REGISTRY_TTL', 30))
+}
+
+# Viewer analytics from media requests. A viewer is a session (client
+# address and user agent, or a ?session= query parameter) that fetched a
+# playlist or segment within the last window seconds; sessions are
+# counted per bucket of that window with HyperLogLog sketches of
+# 2**precision registers (about 1.04 / sqrt(2**precision) error)
+VIEWER_SETTINGS = {
+    'window': 30,
+    'bucket': 10,
+    'precision': 12
+}
+
+# Player QoE beacons. Events are aggregated per stream and rendition into
+# quantile sketches with relative_accuracy error and written as QoEStats
+# rows every flush_interval seconds; rows are kept for retention seconds
+QOE_SETTINGS = {
+    'flush_interval': 60,
+    'relative_accuracy': 0.01,
+    'max_events': 100,
+    'retention': 30 * 24 * 3600
+}
+
+# Metrics exposed at /metrics. Histograms use latency_buckets (seconds);
+# a metric folds the values of exited threads once it has max_shards
+METRICS_SETTINGS = {
+    'latency_buckets': (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    'max_shards': 256
+}
+
+# ffmpeg stderr is kept in a ring buffer of the last 'lines' lines per
+# stream instead of being logged. Warnings and errors are promoted to the
+# application log at up to promote_rate lines per second per stream
+# (bursts of promote_burst); the buffer is written to dump_dir when
+# ffmpeg exits abnormally, keeping the newest max_dumps files
+FFMPEG_LOG_SETTINGS = {
+    'lines': 500,
+    'promote_rate': 1.0,
+    'promote_burst': 20,
+    'dump_dir': os.environ.get('FFMPEG_LOG_DIR', os.path.join(os.getcwd(), 'logs', 'ffmpeg')),
+    'max_dumps': 100
+}
+
+# Stall watchdog: an encoder that writes no segment, or whose -progress
+# out_time does not advance, for stall_segments segment durations (after
+# startup_grace seconds from its start) is killed and restarted by the
+# process supervisor (native RTMP publishes, fed over a pipe, through
+# the RTMP server, which keeps the publisher connected and starts a new
+# encoder at the next keyframe). Recoveries of a stream back off from
+# initial_backoff to max_backoff seconds; after max_recoveries within
+# breaker_window seconds the breaker opens and the stream is left
+# stalled for breaker_cooldown seconds before one more attempt
+WATCHDOG_SETTINGS = {
+    'enabled': os.environ.get('STALL_WATCHDOG', '1') != '0',
+    'stall_segments': 2,
+    'startup_grace': 20,
+    'check_interval': 0.5,
+    'initial_backoff': 5,
+    'max_backoff': 120,
+    'max_recoveries': 3,
+    'breaker_window': 600,
+    'breaker_cooldown': 600
+}
+
+# Pre-warmed encoder pool for native RTMP publishes. Each profile keeps
+# idle ffmpeg encoders spawned ahead of time, reading FLV on stdin and
+# encoding one ladder at one latency mode's keyframe spacing with
+# DEFAULT_VIDEO_PRESET. A publish whose ladder matches a profile is
+# attached to an idle slot and only a stream-copy packager is started for
+# it. Profiles are qualities/latency_mode/slots, e.g.
+# ENCODER_POOL="720p/low/2,1080p+720p+480p/low/1"; empty disables the
+# pool. Pooled encoders and their packagers read their inputs with these
+# probe limits, as the input format is known
+ENCODER_POOL = {
+    'profiles': os.environ.get('ENCODER_POOL', ''),
+    'probesize': 500000,
+    'analyzeduration': 1000000,
+    'max_failures': 3
+}
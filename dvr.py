@@ -0,0 +1,349 @@
+import bisect
+import math
+import os
+import threading
+import time
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from packager import packager
+from metrics import segment_latency
+from stall_watchdog import stall_watchdog
+from config import DVR_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+def parse_program_date_time(value):
+    """Unix time of an EXT-X-PROGRAM-DATE-TIME value; UTC if it has no offset"""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+def parse_media_playlist(text):
+    """Return (media_sequence, map_uri, [(duration, uri, program_time)]) of an HLS media playlist.
+    
+    program_time is the segment's EXT-X-PROGRAM-DATE-TIME as a Unix time,
+    carried forward by segment durations after the last tag, or None.
+    """
+    sequence = 0
+    map_uri = None
+    segments = []
+    duration = None
+    program_time = None
+    
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            sequence = int(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MAP:'):
+            for attribute in line.split(':', 1)[1].split(','):
+                key, _, value = attribute.partition('=')
+                if key == 'URI':
+                    map_uri = value.strip('"')
+        elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            program_time = parse_program_date_time(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[8:].split(',', 1)[0])
+        elif line and not line.startswith('#') and duration is not None:
+            segments.append((duration, line, program_time))
+            if program_time is not None:
+                program_time += duration
+            duration = None
+    
+    return sequence, map_uri, segments
+
+def format_time(timestamp):
+    """EXT-X-PROGRAM-DATE-TIME value for a Unix time"""
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    return moment.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+class SegmentIndex:
+    """Wall-clock index of one rendition's segments over a DVR window.
+    
+    Follows the media playlist the muxer rewrites and appends each new
+    segment with its start time. Segments are kept in parallel lists,
+    oldest first, so a time lookup is a bisect on starts. Rendered
+    playlists are cached until the next segment boundary.
+    """
+    
+    def __init__(self, playlist_path, media_url, window, stream_id=None):
+        self.playlist_path = playlist_path
+        self.stream_id = stream_id
+        self.directory = os.path.dirname(playlist_path)
+        self.media_url = media_url
+        self.window = window
+        self.map_uri = None
+        self.sequences = []
+        self.starts = []
+        self.durations = []
+        self.uris = []
+        self.mtime = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def poll(self, now=None):
+        """Index segments the muxer added since the last poll; True if any"""
+        try:
+            mtime = os.stat(self.playlist_path).st_mtime_ns
+            if mtime == self.mtime:
+                return False
+            with open(self.playlist_path) as f:
+                sequence, map_uri, segments = parse_media_playlist(f.read())
+        except (OSError, ValueError):
+            return False
+        
+        now = now or time.time()
+        with self.lock:
+            self.mtime = mtime
+            self.map_uri = map_uri or self.map_uri
+            
+            # A restarted muxer numbers (and names) segments from scratch
+            if self.sequences and sequence + len(segments) <= self.sequences[-1]:
+                logger.warning(f"{self.playlist_path} restarted at sequence {sequence}, resetting DVR index")
+                self._reset()
+            
+            last = self.sequences[-1] if self.sequences else None
+            new = [(sequence + offset, duration, uri, program_time)
+                   for offset, (duration, uri, program_time) in enumerate(segments)
+                   if last is None or sequence + offset > last]
+            if not new:
+                return False
+            # The stall watchdog times segments of every stream it watches
+            if last is not None and not stall_watchdog.measures_segments(self.stream_id):
+                self._observe_latency(mtime, new)
+            
+            # Segments start at their EXT-X-PROGRAM-DATE-TIME. Without one,
+            # the newest listed segment has just been closed: chain start
+            # times from the previous segment unless the input stalled and
+            # the chain fell behind the clock.
+            batch = sum(duration for _, duration, _, _ in new)
+            start = now - batch
+            if self.starts:
+                chained = self.starts[-1] + self.durations[-1]
+                if start - chained <= 2 * max(duration for _, duration, _, _ in new):
+                    start = chained
+            
+            for sequence, duration, uri, program_time in new:
+                if program_time is not None:
+                    start = program_time
+                self.sequences.append(sequence)
+                self.starts.append(start)
+                self.durations.append(duration)
+                self.uris.append(uri)
+                start += duration
+            
+            self._trim(now - self.window)
+            self.cache.clear()
+            return True
+    
+    def _observe_latency(self, playlist_mtime, new):
+        # Delay between each segment's last write and the playlist listing it
+        for _, _, uri, _ in new:
+            try:
+                written = os.stat(os.path.join(self.directory, uri)).st_mtime_ns
+            except OSError:
+                continue
+            segment_latency.observe(max(0, playlist_mtime - written) / 1e9, (str(self.stream_id),))
+    
+    def _reset(self):
+        self.sequences, self.starts, self.durations, self.uris = [], [], [], []
+        self.cache.clear()
+    
+    def _trim(self, cutoff):
+        # Keep the segment that covers the cutoff
+        count = bisect.bisect_right(self.starts, cutoff) - 1
+        if count > 0:
+            del self.sequences[:count]
+            del self.starts[:count]
+            del self.durations[:count]
+            del self.uris[:count]
+    
+    def playlist(self, start=None, end=None):
+        """Media playlist for segments overlapping start..end, or None.
+        
+        Without a range this is the sliding DVR window. With a start and
+        no end, or an end past the live edge, it is an EVENT playlist that
+        keeps growing; a range that has fully passed is a VOD playlist.
+        """
+        with self.lock:
+            if not self.starts:
+                return None
+            
+            first, last = self._range(start, end)
+            if first >= last:
+                return None
+            
+            if start is None and end is None:
+                kind = None
+            elif end is not None and end <= self.starts[-1] + self.durations[-1]:
+                kind = 'VOD'
+            else:
+                kind = 'EVENT'
+            
+            key = (self.sequences[first], self.sequences[last - 1], kind)
+            playlist = self.cache.get(key)
+            if playlist is None:
+                playlist = self._render(first, last, kind)
+                self.cache[key] = playlist
+                if len(self.cache) > DVR_SETTINGS['cached_playlists']:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(key)
+            return playlist
+    
+    def _range(self, start, end):
+        # Index range of the segments overlapping start..end
+        first = 0 if start is None else max(0, bisect.bisect_right(self.starts, start) - 1)
+        last = len(self.starts) if end is None else bisect.bisect_left(self.starts, end)
+        return first, last
+    
+    def segments(self, start, end):
+        """(init_path, [(path, start, duration)]) of the files covering start..end"""
+        with self.lock:
+            first, last = self._range(start, end)
+            init_path = os.path.join(self.directory, self.map_uri) if self.map_uri else None
+            return init_path, [(os.path.join(self.directory, self.uris[index]), self.starts[index],
+                                self.durations[index]) for index in range(first, last)]
+    
+    def _render(self, first, last, kind):
+        target_duration = max(1, math.ceil(max(self.durations[first:last])))
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:6',
+            f'#EXT-X-TARGETDURATION:{target_duration}',
+            f'#EXT-X-MEDIA-SEQUENCE:{self.sequences[first]}'
+        ]
+        if kind:
+            lines.append(f'#EXT-X-PLAYLIST-TYPE:{kind}')
+        if self.map_uri:
+            lines.append(f'#EXT-X-MAP:URI="{self.media_url}/{self.map_uri}"')
+        
+        for index in range(first, last):
+            # Dates anchor the first segment and every gap after a stall
+            if index == first or self.starts[index] - self.starts[index - 1] - self.durations[index - 1] > 0.5:
+                lines.append(f'#EXT-X-PROGRAM-DATE-TIME:{format_time(self.starts[index])}')
+            lines.append(f'#EXTINF:{self.durations[index]:.5f},')
+            lines.append(f'{self.media_url}/{self.uris[index]}')
+        
+        if kind == 'VOD':
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+class DVRService:
+    """Timeshift playlists for streams with a DVR window.
+    
+    The muxer keeps segments on disk for the window; one background
+    thread indexes what it writes, so playlists are built from the index
+    instead of directory scans. Renditions are numbered like the master
+    playlist: video variants highest first, then the shared audio of a
+    CMAF package.
+    """
+    
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def register(self, stream_id, window, variants, audio=None):
+        """Start indexing a stream.
+        
+        variants is a list of {'resolution', 'playlist_path', 'media_url'}
+        ordered highest first; audio is the same without a resolution.
+        """
+        window = min(window, DVR_SETTINGS['max_window'])
+        indexes = [SegmentIndex(variant['playlist_path'], variant['media_url'], window, stream_id)
+                   for variant in variants]
+        if audio:
+            indexes.append(SegmentIndex(audio['playlist_path'], audio['media_url'], window, stream_id))
+        
+        with self.lock:
+            self.streams[stream_id] = {
+                'window': window,
+                'resolutions': [variant['resolution'] for variant in variants],
+                'audio': bool(audio),
+                'indexes': indexes
+            }
+            
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._index_loop, name='dvr-indexer')
+                self.thread.daemon = True
+                self.thread.start()
+        
+        logger.info(f"DVR indexing stream {stream_id} over {window}s with {len(indexes)} renditions")
+    
+    def unregister(self, stream_id):
+        with self.lock:
+            return self.streams.pop(stream_id, None) is not None
+    
+    def is_registered(self, stream_id):
+        return stream_id in self.streams
+    
+    def _index_loop(self):
+        while True:
+            with self.lock:
+                indexes = [index for stream in self.streams.values() for index in stream['indexes']]
+            
+            for index in indexes:
+                try:
+                    index.poll()
+                except Exception as e:
+                    logger.error(f"Error indexing {index.playlist_path}: {e}")
+            time.sleep(DVR_SETTINGS['poll_interval'])
+    
+    def get_master_playlist(self, stream_id, playlist_url, query=''):
+        """Master playlist pointing at the DVR media playlists, or None.
+        
+        query (e.g. '?start=...') is passed on to every media playlist.
+        """
+        stream = self.streams.get(stream_id)
+        if not stream:
+            return None
+        
+        variants = [{'resolution': resolution, 'uri': f'{playlist_url}/{position}.m3u8{query}'}
+                    for position, resolution in enumerate(stream['resolutions'])]
+        audio_uri = f"{playlist_url}/{len(variants)}.m3u8{query}" if stream['audio'] else None
+        return packager.build_master_playlist(variants, audio_uri)
+    
+    def get_playlist(self, stream_id, rendition, start=None, end=None):
+        """Return (status, body) for a DVR media playlist request"""
+        stream = self.streams.get(stream_id)
+        if not stream or rendition >= len(stream['indexes']):
+            return 404, None
+        
+        playlist = stream['indexes'][rendition].playlist(start, end)
+        if playlist is None:
+            return 404, None
+        return 200, playlist
+    
+    def get_segments(self, stream_id, start, end):
+        """Files covering start..end: the top video rendition, then the
+        shared audio when it is a separate track. None if not indexed.
+        """
+        stream = self.streams.get(stream_id)
+        if not stream:
+            return None
+        
+        tracks = [stream['indexes'][0]]
+        if stream['audio']:
+            tracks.append(stream['indexes'][-1])
+        return [index.segments(start, end) for index in tracks]
+    
+    def get_status(self, stream_id):
+        """Window, indexed range and segment count per rendition, or None"""
+        stream = self.streams.get(stream_id)
+        if not stream:
+            return None
+        
+        renditions = []
+        for index in stream['indexes']:
+            with index.lock:
+                renditions.append({
+                    'segments': len(index.starts),
+                    'start': index.starts[0] if index.starts else None,
+                    'end': index.starts[-1] + index.durations[-1] if index.starts else None
+                })
+        return {'window': stream['window'], 'renditions': renditions}
+
+# Global DVR service instance
+dvr_service = DVRService()
@@ -0,0 +1,196 @@
+import itertools
+import os
+import threading
+import time
+import logging
+from collections import deque
+from process_supervisor import process_supervisor
+from config import ENCODER_POOL
+
+logger = logging.getLogger(__name__)
+
+class PoolSlot:
+    """A pre-spawned encoder waiting for its input"""
+    
+    def __init__(self, key, profile, output):
+        self.key = key
+        self.profile = profile
+        self.output = output
+        self.process = None
+        self.spawned_at = time.monotonic()
+        self.stream_id = None
+        self.on_output = None
+        self.on_exit = None
+        self.exited = False
+        self.lines = deque(maxlen=20)
+    
+    def close_output(self):
+        """Close our copy of the read end once the consumer has it"""
+        if self.output is not None:
+            os.close(self.output)
+            self.output = None
+
+class EncoderPool:
+    """Idle encoder processes, kept per profile, handed to new streams.
+    
+    A slot's process has already been spawned and initialized and blocks
+    reading its stdin; its encoded output goes to a pipe whose read end
+    (slot.output) is given to the stream's packager. Slots are refilled in
+    the background as they are taken. The pool does not know what the
+    processes do: profiles and commands come from ffmpeg_service.
+    """
+    
+    def __init__(self):
+        self.profiles = {}
+        self.slots = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+    
+    def configure(self, profile, cmd, size):
+        """Keep size idle slots running cmd for profile"""
+        with self.lock:
+            self.profiles[profile] = {'cmd': cmd, 'size': size, 'idle': [], 'spawning': 0, 'failures': 0}
+        self.fill(profile)
+    
+    def fill(self, profile):
+        """Spawn slots until the profile has its configured number idle"""
+        while True:
+            with self.lock:
+                entry = self.profiles.get(profile)
+                if not entry or len(entry['idle']) + entry['spawning'] >= entry['size']:
+                    return
+                if entry['failures'] >= ENCODER_POOL['max_failures']:
+                    return
+                entry['spawning'] += 1
+            
+            slot = self._spawn(profile, entry['cmd'])
+            with self.lock:
+                entry['spawning'] -= 1
+                if slot is None or slot.exited:
+                    entry['failures'] += 1
+                    if slot is None:
+                        return
+                else:
+                    entry['idle'].append(slot)
+    
+    def _spawn(self, profile, cmd):
+        read_fd, write_fd = os.pipe()
+        slot = PoolSlot(f'pool-{next(self.counter)}', profile, read_fd)
+        self.slots[slot.key] = slot
+        try:
+            slot.process = process_supervisor.start(
+                slot.key,
+                cmd,
+                stdin=True,
+                stdout=write_fd,
+                on_output=self._handle_output,
+                on_exit=self._handle_exit
+            )
+            return slot
+        except Exception as e:
+            logger.error(f"Failed to spawn pooled encoder for profile {profile}: {e}")
+            self.slots.pop(slot.key, None)
+            slot.close_output()
+            return None
+        finally:
+            # The slot's process holds the write end; its exit is our EOF
+            os.close(write_fd)
+    
+    def acquire(self, profile, stream_id, on_output=None, on_exit=None):
+        """Take an idle slot of profile for stream_id, or None.
+        
+        on_output(stream_id, source, line) and on_exit(stream_id,
+        returncode) replace the pool's own handling of the slot's process.
+        """
+        slot = None
+        with self.lock:
+            entry = self.profiles.get(profile)
+            while entry and entry['idle']:
+                candidate = entry['idle'].pop(0)
+                if not candidate.exited:
+                    slot = candidate
+                    break
+            
+            if slot is None:
+                if self.profiles:
+                    self.misses += 1
+                return None
+            
+            slot.stream_id = stream_id
+            slot.on_output = on_output
+            slot.on_exit = on_exit
+            entry['failures'] = 0
+            self.hits += 1
+        
+        threading.Thread(target=self.fill, args=(profile,), name='encoder-pool-fill', daemon=True).start()
+        logger.info(f"Stream {stream_id} attached to pooled encoder {slot.key}")
+        return slot
+    
+    def release(self, slot, wait=True):
+        """Stop a slot's process; without wait it is stopped in the background"""
+        slot.close_output()
+        if not wait:
+            threading.Thread(target=process_supervisor.stop, args=(slot.key,), daemon=True).start()
+            return
+        process_supervisor.stop(slot.key, timeout=10)
+    
+    def shutdown(self):
+        """Stop every idle slot and forget the profiles"""
+        with self.lock:
+            idle = [slot for entry in self.profiles.values() for slot in entry['idle']]
+            self.profiles = {}
+        for slot in idle:
+            self.release(slot)
+    
+    def _handle_output(self, key, source, line):
+        slot = self.slots.get(key)
+        if slot is None:
+            return
+        if slot.on_output:
+            slot.on_output(slot.stream_id, source, line)
+        else:
+            slot.lines.append(line)
+    
+    def _handle_exit(self, key, returncode, restarting):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return
+        
+        with self.lock:
+            slot.exited = True
+            entry = self.profiles.get(slot.profile)
+            idle = entry is not None and slot in entry['idle']
+            if idle:
+                entry['idle'].remove(slot)
+                entry['failures'] += 1
+        
+        if slot.stream_id is not None:
+            if slot.on_exit:
+                slot.on_exit(slot.stream_id, returncode)
+            return
+        
+        slot.close_output()
+        if idle:
+            last = slot.lines[-1] if slot.lines else 'no output'
+            logger.warning(f"Idle pooled encoder {key} exited with code {returncode}: {last}")
+            if entry['failures'] >= ENCODER_POOL['max_failures']:
+                logger.error(f"Pooled encoders of profile {slot.profile} keep exiting, not refilling")
+            threading.Thread(target=self.fill, args=(slot.profile,), name='encoder-pool-fill', daemon=True).start()
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'profiles': [{
+                    'profile': list(profile),
+                    'size': entry['size'],
+                    'idle': len(entry['idle']),
+                    'failures': entry['failures']
+                } for profile, entry in self.profiles.items()]
+            }
+
+# Global encoder pool instance
+encoder_pool = EncoderPool()
@@ -0,0 +1,121 @@
+import json
+import time
+import threading
+import logging
+from collections import deque
+from datetime import datetime
+from config import EVENT_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+STATS_FIELDS = ('frame_rate', 'bitrate', 'speed', 'dropped_frames', 'duplicate_frames', 'out_time', 'viewers')
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+class EventBus:
+    """In-process pub/sub of stream status and stats for the SSE feed.
+    
+    publish() serializes an event into its SSE frame once and appends it
+    to a shared backlog; every subscriber reads the same bytes from there,
+    so fan-out costs nothing per subscriber at publish time. Subscribers
+    that fall further behind than the backlog skip ahead. The latest
+    status frame of each stream is kept for clients that just connected.
+    
+    The bus lives in one process: run the app as a single process (one
+    gunicorn gthread worker, a thread per open feed) for every client to see
+    every event. Cluster workers forward their events to the
+    coordinator's bus in their heartbeats.
+    """
+    
+    def __init__(self):
+        self.backlog = deque(maxlen=EVENT_SETTINGS['backlog'])
+        self.sequence = 0
+        self.status = {}
+        self.stats = {}
+        self.condition = threading.Condition()
+    
+    def publish(self, event, stream_id, data):
+        """Send an event to every subscriber following stream_id"""
+        payload = json.dumps(dict(data, stream_id=stream_id), default=_default, separators=(',', ':'))
+        with self.condition:
+            self.sequence += 1
+            frame = f"id: {self.sequence}\nevent: {event}\ndata: {payload}\n\n".encode('utf-8')
+            self.backlog.append((self.sequence, stream_id, frame, event, payload))
+            if event == 'status':
+                self.status[stream_id] = frame
+            self.condition.notify_all()
+    
+    def publish_status(self, stream_id, status, **details):
+        self.publish('status', stream_id, dict(details, status=status))
+        if status != 'running':
+            self.stats.pop(stream_id, None)
+    
+    def publish_stats(self, stream_id, sample):
+        """Send the fields of a stats sample that changed, at most every stats_interval"""
+        now = time.monotonic()
+        last = self.stats.get(stream_id)
+        if last and now - last['published_at'] < EVENT_SETTINGS['stats_interval']:
+            return
+        
+        values = {field: sample[field] for field in STATS_FIELDS if field in sample}
+        previous = last['values'] if last else {}
+        changed = {field: value for field, value in values.items() if previous.get(field) != value}
+        self.stats[stream_id] = {'published_at': now, 'values': values}
+        if changed:
+            self.publish('stats', stream_id, dict(changed, timestamp=sample['timestamp']))
+    
+    def subscribe(self, stream_ids=None, last_event_id=None):
+        """Yield SSE frames for stream_ids (all streams when None).
+        
+        A new client first gets the current status of its streams; one
+        resuming with last_event_id gets the events it missed instead,
+        as far as the backlog reaches.
+        """
+        with self.condition:
+            if last_event_id is None or last_event_id > self.sequence:
+                position = self.sequence
+                initial = [frame for stream_id, frame in self.status.items()
+                           if stream_ids is None or stream_id in stream_ids]
+            else:
+                position = last_event_id
+                initial = []
+        
+        # Lets EventSource reconnect after 3s instead of its default
+        yield b'retry: 3000\n\n'
+        for frame in initial:
+            yield frame
+        
+        while True:
+            with self.condition:
+                if self.sequence <= position:
+                    self.condition.wait(EVENT_SETTINGS['keepalive'])
+                # Sequences are contiguous, so the unseen events are the newest ones
+                missed = min(self.sequence - position, len(self.backlog))
+                frames = [self.backlog[-index] for index in range(missed, 0, -1)]
+            
+            if not frames:
+                yield b': keepalive\n\n'
+                continue
+            
+            position = frames[-1][0]
+            for _, stream_id, frame, _, _ in frames:
+                if stream_ids is None or stream_id in stream_ids:
+                    yield frame
+    
+    def events_since(self, position):
+        """(sequence, [(event, stream_id, data)]) published after position, as far as the backlog reaches"""
+        with self.condition:
+            missed = min(max(0, self.sequence - position), len(self.backlog))
+            events = [self.backlog[-index] for index in range(missed, 0, -1)]
+            sequence = self.sequence
+        return sequence, [(event, stream_id, json.loads(payload)) for _, stream_id, _, event, payload in events]
+    
+    def get_stats(self):
+        with self.condition:
+            return {'sequence': self.sequence, 'backlog': len(self.backlog), 'streams': len(self.status)}
+
+# Global event bus instance
+event_bus = EventBus()
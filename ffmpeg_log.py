@@ -0,0 +1,151 @@
+import os
+import re
+import threading
+import time
+import logging
+from collections import deque
+from datetime import datetime
+from metrics import metrics
+from config import FFMPEG_LOG_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# -loglevel level+... tags every line, e.g. "[h264 @ 0x5581] [warning] ..."
+LEVEL_TAG = re.compile(r'\[(panic|fatal|error|warning|info|verbose|debug|trace)\] ')
+
+# Untagged lines (ffmpeg builds without the level flag) that read like problems
+ERROR_WORDS = re.compile(r'\b(error|failed|invalid|could not|cannot|unable)\b', re.IGNORECASE)
+
+LEVELS = {
+    'panic': logging.CRITICAL,
+    'fatal': logging.CRITICAL,
+    'error': logging.ERROR,
+    'warning': logging.WARNING,
+    'info': logging.INFO,
+    'verbose': logging.DEBUG,
+    'debug': logging.DEBUG,
+    'trace': logging.DEBUG
+}
+
+log_lines = metrics.counter('stropen_ffmpeg_log_lines_total', 'ffmpeg stderr lines by level', ('level',))
+
+def classify(line):
+    """Logging level of an ffmpeg stderr line"""
+    match = LEVEL_TAG.search(line)
+    if match:
+        return LEVELS[match.group(1)]
+    return logging.WARNING if ERROR_WORDS.search(line) else logging.INFO
+
+class StreamLog:
+    """Recent ffmpeg output of one stream and its promotion budget"""
+    
+    def __init__(self):
+        self.lines = deque(maxlen=FFMPEG_LOG_SETTINGS['lines'])
+        self.tokens = FFMPEG_LOG_SETTINGS['promote_burst']
+        self.refilled_at = time.monotonic()
+        self.suppressed = 0
+        self.counts = dict.fromkeys(('warning', 'error'), 0)
+
+class FFmpegLogBuffer:
+    """Bounded in-memory ffmpeg logs per stream.
+    
+    Every stderr line goes into the stream's ring buffer, which the logs
+    API reads. Only warnings and errors reach the application log, through
+    a token bucket per stream, so a stream repeating the same warning every
+    frame costs a bounded number of log records. The buffer is written to
+    a file when ffmpeg exits abnormally.
+    """
+    
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+    
+    def _stream_log(self, stream_id):
+        log = self.streams.get(stream_id)
+        if log is None:
+            with self.lock:
+                log = self.streams.setdefault(stream_id, StreamLog())
+        return log
+    
+    def append(self, stream_id, line):
+        """Record one stderr line, promoting it if it is a warning or error"""
+        line = line.rstrip()
+        level = classify(line)
+        log = self._stream_log(stream_id)
+        log.lines.append((time.time(), level, line))
+        log_lines.inc((logging.getLevelName(level).lower(),))
+        
+        if level < logging.WARNING:
+            return
+        log.counts['error' if level >= logging.ERROR else 'warning'] += 1
+        
+        now = time.monotonic()
+        log.tokens = min(FFMPEG_LOG_SETTINGS['promote_burst'],
+                         log.tokens + (now - log.refilled_at) * FFMPEG_LOG_SETTINGS['promote_rate'])
+        log.refilled_at = now
+        if log.tokens < 1:
+            log.suppressed += 1
+            return
+        
+        log.tokens -= 1
+        if log.suppressed:
+            line += f" ({log.suppressed} earlier warnings/errors not logged, see /stream/{stream_id}/logs)"
+            log.suppressed = 0
+        logger.log(level, f"Stream {stream_id} ffmpeg: {line}")
+    
+    def mark(self, stream_id, message):
+        """Add a line of our own, e.g. where a process exited"""
+        self._stream_log(stream_id).lines.append((time.time(), logging.INFO, f'--- {message} ---'))
+    
+    def reset(self, stream_id):
+        with self.lock:
+            self.streams[stream_id] = StreamLog()
+    
+    def get_lines(self, stream_id, level=logging.DEBUG, limit=None):
+        """Buffered lines at or above level, oldest first, or None"""
+        log = self.streams.get(stream_id)
+        if log is None:
+            return None
+        
+        lines = [{'time': datetime.utcfromtimestamp(timestamp).isoformat(),
+                  'level': logging.getLevelName(line_level).lower(),
+                  'line': line}
+                 for timestamp, line_level, line in list(log.lines) if line_level >= level]
+        return lines[-limit:] if limit else lines
+    
+    def get_counts(self, stream_id):
+        log = self.streams.get(stream_id)
+        return dict(log.counts) if log else None
+    
+    def dump(self, stream_id, returncode):
+        """Write a stream's buffer to dump_dir; return the file path or None"""
+        log = self.streams.get(stream_id)
+        if log is None or not log.lines:
+            return None
+        
+        directory = FFMPEG_LOG_SETTINGS['dump_dir']
+        path = os.path.join(directory, f"stream_{stream_id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S_%f')}.log")
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(f"# ffmpeg of stream {stream_id} exited with code {returncode}\n")
+                for timestamp, level, line in list(log.lines):
+                    f.write(f"{datetime.utcfromtimestamp(timestamp).isoformat()} "
+                            f"{logging.getLevelName(level)} {line}\n")
+            self._prune_dumps(directory)
+        except OSError as e:
+            logger.error(f"Could not write ffmpeg log of stream {stream_id}: {e}")
+            return None
+        return path
+    
+    def _prune_dumps(self, directory):
+        dumps = sorted((entry for entry in os.scandir(directory) if entry.name.endswith('.log')),
+                       key=lambda entry: entry.stat().st_mtime)
+        for entry in dumps[:-FFMPEG_LOG_SETTINGS['max_dumps']]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+# Global ffmpeg log buffer instance
+ffmpeg_logs = FFmpegLogBuffer()
@@ -1,57 +1,100 @@
-import subprocess
-import threading
 import logging
+import math
 import os
 import json
 from datetime import datetime
-from config import VIDEO_PRESETS, QUALITY_PROFILES, HLS_SETTINGS, DASH_SETTINGS, FFMPEG_PATH
+from packager import packager
+from process_supervisor import process_supervisor
+from stats_collector import stats_collector
+from event_bus import event_bus
+from ffmpeg_log import ffmpeg_logs
+from stall_watchdog import stall_watchdog
+from encoder_pool import encoder_pool
+from config import (VIDEO_PRESETS, QUALITY_PROFILES, HLS_SETTINGS, DASH_SETTINGS, FFMPEG_PATH,
+                    DEFAULT_VIDEO_PRESET, LATENCY_MODES, AUDIO_BITRATE, LL_HLS_SETTINGS, PACKAGING_MODE,
+                    ENCODER_POOL)
 
 logger = logging.getLogger(__name__)
 
+# Input URL for streams fed as FLV over the process's stdin (native RTMP ingest)
+PIPE_INPUT = 'pipe:0'
+
 class FFmpegService:
     def __init__(self):
         self.active_streams = {}
         self.processes = {}
+        # Restarts a piped encoder together with its feeder; set by the RTMP server
+        self.pipe_restarter = None
     
-    def start_stream(self, stream_id, input_url, output_configs):
-        """Start FFmpeg process for a stream with multiple outputs"""
+    def start_stream(self, stream_id, input_url, output_configs, passthrough=None, preset=None):
+        """Start FFmpeg process for a stream with multiple outputs.
+        
+        passthrough ({'video': bool, 'audio': bool}) stream-copies the
+        input into the top rendition instead of re-encoding it. preset is a
+        VIDEO_PRESETS key and defaults to DEFAULT_VIDEO_PRESET.
+        """
         if stream_id in self.active_streams:
             logger.warning(f"Stream {stream_id} is already running")
             return False
         
         try:
+            # Packagers write into per-stream directories
+            self._prepare_output_dirs(output_configs)
+            
+            # Piped publishes take a pooled encoder of their ladder when one
+            # is idle, leaving only a stream-copy packager to start
+            slot = None
+            if input_url == PIPE_INPUT and not (passthrough and (passthrough.get('video') or passthrough.get('audio'))):
+                slot = encoder_pool.acquire(
+                    self._pool_profile(output_configs, preset),
+                    stream_id,
+                    on_output=self._handle_process_output,
+                    on_exit=self._handle_slot_exit
+                )
+            
             # Build FFmpeg command
-            cmd = self._build_ffmpeg_command(input_url, output_configs)
+            if slot:
+                cmd = self._build_packager_command(output_configs)
+            else:
+                cmd = self._build_ffmpeg_command(input_url, output_configs, passthrough, preset)
             logger.info(f"Starting stream {stream_id} with command: {' '.join(cmd)}")
+            ffmpeg_logs.reset(stream_id)
             
-            # Start process
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
-            
-            self.processes[stream_id] = process
+            # Start process; its pipes are read by the shared supervisor
+            # thread, and streams with a reconnectable input are restarted
+            # if ffmpeg exits on its own
             self.active_streams[stream_id] = {
-                'process': process,
                 'start_time': datetime.utcnow(),
                 'input_url': input_url,
-                'output_configs': output_configs
+                'output_configs': output_configs,
+                'passthrough': passthrough,
+                'preset': preset or DEFAULT_VIDEO_PRESET,
+                'slot': slot,
+                # Supervisor key of the pooled encoder doing the stream's encoding
+                'encoder': slot.key if slot else None
             }
-            
-            # Start monitoring thread
-            monitor_thread = threading.Thread(
-                target=self._monitor_stream,
-                args=(stream_id, process)
+            stall_watchdog.watch(stream_id, *self._watched_outputs(output_configs),
+                                 restart=self.pipe_restarter if input_url == PIPE_INPUT else None)
+            process_supervisor.start(
+                stream_id,
+                cmd,
+                stdin=slot.output if slot else input_url == PIPE_INPUT,
+                on_start=self._handle_process_start,
+                on_output=self._handle_process_output,
+                on_exit=self._handle_process_exit,
+                restart=input_url != PIPE_INPUT
             )
-            monitor_thread.daemon = True
-            monitor_thread.start()
+            if slot:
+                slot.close_output()
             
             return True
             
         except Exception as e:
             logger.error(f"Error starting stream {stream_id}: {e}")
+            self.active_streams.pop(stream_id, None)
+            stall_watchdog.unwatch(stream_id)
+            if slot:
+                encoder_pool.release(slot)
             return False
     
     def stop_stream(self, stream_id):
@@ -61,127 +104,488 @@ class FFmpegService:
             return False
         
         try:
-            process = self.processes[stream_id]
-            process.terminate()
-            process.wait(timeout=10)
+            self.active_streams[stream_id]['stopping'] = True
             
-            del self.active_streams[stream_id]
-            del self.processes[stream_id]
+            # A pooled encoder is stopped first so the packager gets its last frames
+            if self.active_streams[stream_id].get('slot'):
+                encoder_pool.release(self.active_streams[stream_id]['slot'])
+            process_supervisor.stop(stream_id, timeout=10)
+            stall_watchdog.unwatch(stream_id)
+            
+            self.active_streams.pop(stream_id, None)
+            self.processes.pop(stream_id, None)
             
             logger.info(f"Stream {stream_id} stopped")
             return True
             
-        except subprocess.TimeoutExpired:
-            logger.warning(f"Force killing stream {stream_id}")
-            if stream_id in self.processes:
-                process = self.processes[stream_id]
-                process.kill()
-            return True
         except Exception as e:
             logger.error(f"Error stopping stream {stream_id}: {e}")
             return False
     
-    def _build_ffmpeg_command(self, input_url, output_configs):
-        """Build FFmpeg command with multiple outputs"""
-        cmd = [FFMPEG_PATH, '-i', input_url]
+    def _build_ffmpeg_command(self, input_url, output_configs, passthrough=None, preset=None):
+        """Build a single-decode ABR ladder command.
+
+        The input is decoded once and split/scaled in one filter graph. Each
+        distinct resolution is encoded once and the tee muxer shares that
+        rendition with every HLS, DASH and RTMP output that asks for it.
+        With passthrough video the top rendition is the input stream copied
+        and only lower rungs are scaled and encoded.
+        """
+        # Level tags let ffmpeg_log tell warnings and errors from chatter
+        cmd = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'level+info']
+        if input_url == PIPE_INPUT:
+            cmd.extend(['-f', 'flv'])
+        cmd.extend(['-i', input_url])
+        
+        # Machine-readable progress on stdout replaces the stderr stats line
+        cmd.extend(['-progress', 'pipe:1', '-nostats'])
+        
+        ladder = self._build_ladder(output_configs)
+        if not ladder:
+            return cmd
+        
+        cmd.extend(self._build_encode_args(ladder, self._ladder_keyframe_interval(output_configs),
+                                           passthrough, preset))
+        cmd.extend(self._build_tee_args(ladder))
+        return cmd
+    
+    def _build_slot_command(self, ladder, keyframe_interval):
+        """Build a pooled encoder: FLV on stdin, the encoded ladder as NUT on stdout"""
+        cmd = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'level+info',
+               '-f', 'flv', '-probesize', str(ENCODER_POOL['probesize']),
+               '-analyzeduration', str(ENCODER_POOL['analyzeduration']), '-i', PIPE_INPUT, '-nostats']
+        cmd.extend(self._build_encode_args(ladder, keyframe_interval))
+        cmd.extend(['-flags', '+global_header', '-flush_packets', '1', '-f', 'nut', 'pipe:1'])
+        return cmd
+    
+    def _build_packager_command(self, output_configs):
+        """Build the stream-copy packager fed by a pooled encoder.
+        
+        The encoder's output streams are in ladder order followed by the
+        audio, as in a single-process command, so the tee outputs select
+        the same indices.
+        """
+        cmd = [FFMPEG_PATH, '-hide_banner', '-loglevel', 'level+info',
+               '-f', 'nut', '-probesize', str(ENCODER_POOL['probesize']),
+               '-analyzeduration', str(ENCODER_POOL['analyzeduration']), '-i', PIPE_INPUT,
+               '-progress', 'pipe:1', '-nostats', '-map', '0', '-c', 'copy']
+        cmd.extend(self._build_tee_args(self._build_ladder(output_configs)))
+        return cmd
+    
+    def _pool_profile(self, output_configs, preset=None):
+        """Encoder pool key: the ladder's resolutions, keyframe interval and preset"""
+        ladder = self._build_ladder(output_configs)
+        return (tuple(rendition['resolution'] for rendition in ladder),
+                self._ladder_keyframe_interval(output_configs),
+                preset or DEFAULT_VIDEO_PRESET)
+    
+    def start_pool(self):
+        """Spawn the pooled encoders configured in ENCODER_POOL['profiles']"""
+        output_types = ('cmaf',) if PACKAGING_MODE == 'cmaf' else ('hls', 'dash')
+        
+        for spec in filter(None, ENCODER_POOL['profiles'].split(',')):
+            try:
+                qualities, latency_mode, slots = spec.strip().split('/')
+                configs = [{'type': output_type, 'resolution': quality, 'latency_mode': latency_mode}
+                           for quality in qualities.split('+') for output_type in output_types]
+                if any(config['resolution'] not in QUALITY_PROFILES for config in configs):
+                    raise ValueError(f"unknown quality in {qualities}")
+                
+                profile = self._pool_profile(configs)
+                cmd = self._build_slot_command(self._build_ladder(configs), profile[1])
+                encoder_pool.configure(profile, cmd, int(slots))
+                logger.info(f"Encoder pool keeps {slots} encoder(s) for {qualities} at {latency_mode} latency")
+            except ValueError as e:
+                logger.error(f"Invalid encoder pool profile {spec!r}: {e}")
+    
+    def stop_pool(self):
+        encoder_pool.shutdown()
+    
+    def _build_encode_args(self, ladder, keyframe_interval, passthrough=None, preset=None):
+        """Filter graph, stream maps and encoder options of a ladder"""
+        cmd = []
+        copy_video = bool(passthrough and passthrough.get('video'))
+        copy_audio = bool(passthrough and passthrough.get('audio'))
+        first_encoded = 1 if copy_video else 0
+        
+        if len(ladder) > first_encoded:
+            cmd.extend(['-filter_complex', self._build_filter_graph(ladder, first_encoded)])
         
-        # Add global options
+        # Map one video stream per rendition, then the shared audio stream
+        if copy_video:
+            cmd.extend(['-map', '0:v:0'])
+        for index in range(first_encoded, len(ladder)):
+            cmd.extend(['-map', f'[v{index}]'])
+        cmd.extend(['-map', '0:a?'])
+        
+        x264_preset = VIDEO_PRESETS[preset or DEFAULT_VIDEO_PRESET]['preset']
+        
+        # Aligned keyframes keep segment boundaries identical across
+        # renditions; next to a copied rendition they follow its keyframes
+        force_key_frames = 'source' if copy_video else f'expr:gte(t,n_forced*{keyframe_interval})'
         cmd.extend([
             '-c:v', 'libx264',
-            '-c:a', 'aac',
-            '-f', 'tee'
+            '-preset', x264_preset,
+            '-sc_threshold', '0',
+            '-force_key_frames', force_key_frames
         ])
+        if copy_video:
+            cmd.extend(['-c:v:0', 'copy'])
+        
+        for index, rendition in enumerate(ladder):
+            if index < first_encoded:
+                continue
+            bitrate = rendition['bitrate']
+            cmd.extend([
+                f'-b:v:{index}', f'{bitrate}k',
+                f'-maxrate:v:{index}', f'{bitrate}k',
+                f'-bufsize:v:{index}', f'{bitrate * 2}k'
+            ])
         
-        # Build tee output string for multiple destinations
+        if copy_audio:
+            cmd.extend(['-c:a', 'copy'])
+        else:
+            cmd.extend(['-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE}k'])
+        
+        return cmd
+    
+    def _build_tee_args(self, ladder):
+        """Tee muxer writing every output of a ladder"""
+        cmd = [
+            '-flags', '+global_header',
+            '-f', 'tee'
+        ]
+        
+        # Build tee output string, each slave selecting its rendition(s)
         outputs = []
         
+        for index, rendition in enumerate(ladder):
+            for config in rendition['outputs']:
+                if config['type'] == 'hls':
+                    outputs.append(self._build_hls_output(config, index))
+                elif config['type'] == 'rtmp':
+                    outputs.append(self._build_rtmp_output(config, index))
+                elif config['type'] == 'fanout':
+                    outputs.append(self._build_fanout_output(config, index))
+        
+        # DASH and CMAF packagers carry every rendition that shares a manifest
+        for package in self._group_packages(ladder).values():
+            config = package['config']
+            if config['type'] == 'dash':
+                outputs.append(self._build_dash_output(config, package['indices']))
+            elif config['type'] == 'cmaf':
+                outputs.append(self._build_cmaf_output(config, package['indices']))
+        
+        cmd.append('|'.join(outputs))
+        
+        return cmd
+    
+    def _build_ladder(self, output_configs):
+        """Group outputs by resolution into renditions, highest first"""
+        renditions = {}
+        
+        for config in output_configs:
+            if config['type'] not in ('hls', 'dash', 'cmaf', 'rtmp', 'fanout'):
+                continue
+            
+            resolution = config.get('resolution')
+            if resolution not in QUALITY_PROFILES:
+                logger.warning(f"Unknown resolution {resolution}, using top rendition")
+                resolution = None
+            
+            renditions.setdefault(resolution, []).append(config)
+        
+        # Outputs without a known resolution ride on the top rendition
+        unassigned = renditions.pop(None, [])
+        if not renditions and unassigned:
+            renditions['720p'] = []
+        
+        ladder = []
+        for resolution, configs in renditions.items():
+            quality = QUALITY_PROFILES[resolution]
+            ladder.append({
+                'resolution': resolution,
+                'width': quality['width'],
+                'height': quality['height'],
+                'bitrate': quality['bitrate'],
+                'outputs': configs
+            })
+        
+        ladder.sort(key=lambda rendition: rendition['height'], reverse=True)
+        if unassigned:
+            ladder[0]['outputs'].extend(unassigned)
+        
+        return ladder
+    
+    def _group_packages(self, ladder):
+        """Group DASH/CMAF outputs by manifest path into multi-rendition packages"""
+        packages = {}
+        
+        for index, rendition in enumerate(ladder):
+            for config in rendition['outputs']:
+                if config['type'] not in ('dash', 'cmaf'):
+                    continue
+                package = packages.setdefault(config['output_path'], {'config': config, 'indices': []})
+                if index not in package['indices']:
+                    package['indices'].append(index)
+        
+        return packages
+    
+    def _build_filter_graph(self, ladder, first=0):
+        """Build a filter graph that decodes once and scales per rendition.
+        
+        Renditions before first are stream-copied and get no branch.
+        """
+        renditions = list(enumerate(ladder))[first:]
+        if len(renditions) == 1:
+            index, rendition = renditions[0]
+            return f"[0:v]scale={rendition['width']}:{rendition['height']}[v{index}]"
+        
+        split_labels = ''.join(f'[s{index}]' for index, _ in renditions)
+        filters = [f'[0:v]split={len(renditions)}{split_labels}']
+        
+        for index, rendition in renditions:
+            filters.append(f"[s{index}]scale={rendition['width']}:{rendition['height']}[v{index}]")
+        
+        return ';'.join(filters)
+    
+    def _ladder_keyframe_interval(self, output_configs):
+        """Pick a keyframe interval that every segmented output can cut on.
+        
+        Segments only end on keyframes, so the interval must divide every
+        configured duration: their greatest common divisor, taken in
+        milliseconds so fractional durations work too.
+        """
+        intervals = []
+        
         for config in output_configs:
+            latency_mode = self._resolve_latency_mode(config.get('latency_mode'))
             if config['type'] == 'hls':
-                outputs.append(self._build_hls_output(config))
-            elif config['type'] == 'dash':
-                outputs.append(self._build_dash_output(config))
-            elif config['type'] == 'rtmp':
-                outputs.append(self._build_rtmp_output(config))
+                intervals.append(HLS_SETTINGS[latency_mode]['segment_time'])
+            elif config['type'] in ('dash', 'cmaf'):
+                intervals.append(DASH_SETTINGS[latency_mode]['segment_duration'])
         
-        if outputs:
-            cmd.append('|'.join(outputs))
+        if not intervals:
+            return 2
+        interval = math.gcd(*(round(duration * 1000) for duration in intervals)) / 1000
+        return int(interval) if interval.is_integer() else interval
+    
+    def _watched_outputs(self, output_configs):
+        """Segment directories of a stream and its longest segment duration"""
+        directories = set()
+        durations = []
         
-        return cmd
+        for config in output_configs:
+            latency_mode = self._resolve_latency_mode(config.get('latency_mode'))
+            if config['type'] == 'hls':
+                durations.append(HLS_SETTINGS[latency_mode]['segment_time'])
+            elif config['type'] in ('dash', 'cmaf'):
+                durations.append(DASH_SETTINGS[latency_mode]['segment_duration'])
+            else:
+                continue
+            directories.add(os.path.dirname(os.path.abspath(config['output_path'])))
+        
+        return sorted(directories), max(durations) if durations else 2
+    
+    def _resolve_latency_mode(self, latency_mode):
+        """Map a Stream.latency_mode value onto a settings key"""
+        if latency_mode in HLS_SETTINGS:
+            return latency_mode
+        return LATENCY_MODES.get(latency_mode, 'tutorial')
     
-    def _build_hls_output(self, config):
+    def _build_hls_output(self, config, rendition_index=0):
         """Build HLS output configuration"""
-        latency_mode = config.get('latency_mode', 'low_latency')
+        latency_mode = self._resolve_latency_mode(config.get('latency_mode'))
         settings = HLS_SETTINGS[latency_mode]
         
-        output = f"[select=v:0,a:0:f=hls"
+        output = f"[select=\\'v:{rendition_index},a\\':f=hls"
         output += f":hls_time={settings['segment_time']}"
         output += f":hls_list_size={settings['playlist_size']}"
         output += f":hls_flags={settings['flags']}"
         
-        # Add quality-specific settings
-        if 'resolution' in config:
-            quality = QUALITY_PROFILES[config['resolution']]
-            output += f":s={quality['width']}x{quality['height']}"
-            output += f":b:v={quality['bitrate']}k"
+        # Segments that left the live playlist stay on disk for the DVR window
+        if config.get('dvr_window'):
+            output += f":hls_delete_threshold={self._dvr_segments(config, settings['segment_time'])}"
         
         output += f"]{config['output_path']}"
         return output
     
-    def _build_dash_output(self, config):
+    def _build_dash_output(self, config, rendition_indices=(0,)):
         """Build DASH output configuration"""
-        latency_mode = config.get('latency_mode', 'low_latency')
+        latency_mode = self._resolve_latency_mode(config.get('latency_mode'))
         settings = DASH_SETTINGS[latency_mode]
         
-        output = f"[select=v:0,a:0:f=dash"
+        output = f"[select={self._select_renditions(rendition_indices)}:f=dash"
         output += f":seg_duration={settings['segment_duration']}"
         output += f":window_size={settings['window_size']}"
+        output += ":adaptation_sets=\\'id=0,streams=v id=1,streams=a\\'"
+        
+        # Streams share the DASH directory, so segments carry the stream's name
+        name = os.path.splitext(os.path.basename(config['output_path']))[0]
+        output += f":init_seg_name={name}-init-$RepresentationID$.$ext$"
+        output += f":media_seg_name={name}-chunk-$RepresentationID$-$Number%05d$.$ext$"
         
         if settings['ldash']:
             output += ":ldash=1"
         
-        # Add quality-specific settings
-        if 'resolution' in config:
-            quality = QUALITY_PROFILES[config['resolution']]
-            output += f":s={quality['width']}x{quality['height']}"
-            output += f":b:v={quality['bitrate']}k"
+        output += f"]{config['output_path']}"
+        return output
+    
+    def _build_cmaf_output(self, config, rendition_indices=(0,)):
+        """Build a CMAF output: one fMP4 package with HLS and DASH manifests"""
+        latency_mode = self._resolve_latency_mode(config.get('latency_mode'))
+        settings = DASH_SETTINGS[latency_mode]
+        
+        output = f"[select={self._select_renditions(rendition_indices)}:f=dash"
+        output += ":segment_type=mp4"
+        output += f":seg_duration={settings['segment_duration']}"
+        output += f":window_size={settings['window_size']}"
+        output += ":adaptation_sets=\\'id=0,streams=v id=1,streams=a\\'"
+        output += ":hls_playlist=1"
+        
+        if config.get('dvr_window'):
+            output += f":extra_window_size={self._dvr_segments(config, settings['segment_duration'])}"
+        
+        if settings['ldash']:
+            output += ":ldash=1:streaming=1"
+        
+        # LL-HLS parts are the fragments flushed inside each segment
+        if latency_mode in LL_HLS_SETTINGS and config.get('ll_playlist_url'):
+            output += f":frag_type=duration:frag_duration={LL_HLS_SETTINGS[latency_mode]['part_duration']}"
         
         output += f"]{config['output_path']}"
         return output
     
-    def _build_rtmp_output(self, config):
-        """Build RTMP output configuration"""
-        output = f"[select=v:0,a:0:f=flv"
+    def _dvr_segments(self, config, segment_duration):
+        """Segments to keep beyond the live playlist to cover a DVR window"""
+        return math.ceil(config['dvr_window'] / segment_duration) + 1
+    
+    def _select_renditions(self, rendition_indices):
+        """Tee select expression for the given video renditions plus audio"""
+        specifiers = [f'v:{index}' for index in rendition_indices] + ['a']
+        return f"\\'{','.join(specifiers)}\\'"
+    
+    def _write_master_playlists(self, ladder):
+        """Write one multi-variant HLS master playlist per stream package"""
+        masters = {}
         
-        # Add quality-specific settings
-        if 'resolution' in config:
-            quality = QUALITY_PROFILES[config['resolution']]
-            output += f":s={quality['width']}x{quality['height']}"
-            output += f":b:v={quality['bitrate']}k"
+        # Separate-mode HLS: one media playlist per rendition
+        for rendition in ladder:
+            for config in rendition['outputs']:
+                if config['type'] == 'hls' and config.get('master_path'):
+                    variants = masters.setdefault(config['master_path'], {'variants': [], 'audio_uri': None})['variants']
+                    variants.append({
+                        'resolution': rendition['resolution'],
+                        'uri': os.path.basename(config['output_path'])
+                    })
         
+        # CMAF: the dash muxer writes media_N.m3u8 in package stream order,
+        # video renditions first and the shared audio last
+        for package in self._group_packages(ladder).values():
+            config = package['config']
+            if config['type'] != 'cmaf' or not config.get('master_path'):
+                continue
+            
+            # LL-HLS media playlists are generated by the app, not ffmpeg
+            media_uri = 'media_{}.m3u8'
+            if config.get('ll_playlist_url'):
+                media_uri = config['ll_playlist_url'] + '/{}.m3u8'
+            
+            variants = [{
+                'resolution': ladder[index]['resolution'],
+                'uri': media_uri.format(position)
+            } for position, index in enumerate(package['indices'])]
+            masters[config['master_path']] = {
+                'variants': variants,
+                'audio_uri': media_uri.format(len(variants))
+            }
+        
+        for path, master in masters.items():
+            packager.write_master_playlist(path, master['variants'], master['audio_uri'])
+    
+    def _prepare_output_dirs(self, output_configs):
+        """Create package directories and master playlists for the outputs"""
+        for config in output_configs:
+            if config['type'] == 'cmaf':
+                package_dir = os.path.dirname(config['output_path'])
+                os.makedirs(package_dir, exist_ok=True)
+                
+                # The muxer restarts numbering at 1; stale segments from a
+                # previous run would be mistaken for new ones
+                for name in os.listdir(package_dir):
+                    if name.endswith(('.m4s', '.m4s.tmp')):
+                        os.remove(os.path.join(package_dir, name))
+        
+        self._write_master_playlists(self._build_ladder(output_configs))
+    
+    def _build_fanout_output(self, config, rendition_index=0):
+        """Publish a rendition as FLV to a local relay fan-out point.
+        
+        onfail=ignore keeps the encoder and its other outputs running if the
+        fan-out goes away.
+        """
+        output = f"[select=\\'v:{rendition_index},a\\':f=flv:onfail=ignore"
+        output += f"]{config['fanout_url']}"
+        return output
+    
+    def _build_rtmp_output(self, config, rendition_index=0):
+        """Build RTMP output configuration"""
+        output = f"[select=\\'v:{rendition_index},a\\':f=flv"
         output += f"]{config['rtmp_url']}/{config['stream_key']}"
         return output
     
-    def _monitor_stream(self, stream_id, process):
-        """Monitor FFmpeg process and log output"""
-        try:
-            for line in process.stderr:
-                if line.strip():
-                    logger.debug(f"Stream {stream_id}: {line.strip()}")
-                    
-                    # Parse FFmpeg output for statistics
-                    self._parse_ffmpeg_stats(stream_id, line)
-            
-        except Exception as e:
-            logger.error(f"Error monitoring stream {stream_id}: {e}")
-        finally:
-            if stream_id in self.active_streams:
-                del self.active_streams[stream_id]
+    def _handle_process_start(self, stream_id, process):
+        """Track the current process of a stream (also called on restart)"""
+        self.processes[stream_id] = process
+        stall_watchdog.started(stream_id)
+        if stream_id in self.active_streams:
+            # The first start is announced by stream_manager with the DB status
+            if self.active_streams[stream_id].get('process'):
+                event_bus.publish_status(stream_id, 'running')
+            self.active_streams[stream_id]['process'] = process
+    
+    def _handle_process_output(self, stream_id, source, line):
+        """Handle one line of FFmpeg output"""
+        if source == 'stdout':
+            # -progress key=value lines
+            self._parse_ffmpeg_stats(stream_id, line)
+        else:
+            ffmpeg_logs.append(stream_id, line)
+    
+    def _handle_slot_exit(self, stream_id, returncode):
+        """A stream's pooled encoder exited; its packager follows on EOF"""
+        stream_info = self.active_streams.get(stream_id)
+        ffmpeg_logs.mark(stream_id, f"encoder exited with code {returncode}")
+        if returncode != 0 and stream_info and not stream_info.get('stopping'):
+            path = ffmpeg_logs.dump(stream_id, returncode)
+            if path:
+                logger.error(f"Stream {stream_id} encoder exited with code {returncode}, recent output in {path}")
+    
+    def _handle_process_exit(self, stream_id, returncode, restarting):
+        """Forget streams whose process exited for good"""
+        stream_info = self.active_streams.get(stream_id)
+        ffmpeg_logs.mark(stream_id, f"ffmpeg exited with code {returncode}")
+        if returncode != 0 and stream_info and not stream_info.get('stopping'):
+            path = ffmpeg_logs.dump(stream_id, returncode)
+            if path:
+                logger.error(f"Stream {stream_id} ffmpeg exited with code {returncode}, recent output in {path}")
+        
+        if restarting:
+            event_bus.publish_status(stream_id, 'restarting', return_code=returncode)
+            return
+        
+        if stream_info and not stream_info.get('stopping'):
+            event_bus.publish_status(stream_id, 'error', return_code=returncode)
+            if stream_info.get('slot'):
+                # Called on the supervisor thread, which must not wait
+                encoder_pool.release(stream_info['slot'], wait=False)
+        stall_watchdog.unwatch(stream_id)
+        self.active_streams.pop(stream_id, None)
+        self.processes.pop(stream_id, None)
     
     def _parse_ffmpeg_stats(self, stream_id, line):
-        """Parse FFmpeg output for stream statistics"""
-        # This would parse FFmpeg output to extract bitrate, fps, etc.
-        # Implementation would depend on specific FFmpeg output format
-        pass
+        """Parse FFmpeg -progress output for stream statistics"""
+        stats_collector.handle_progress_line(stream_id, line)
     
     def get_stream_status(self, stream_id):
         """Get current status of a stream"""
@@ -189,16 +593,40 @@ class FFmpegService:
             return {'status': 'stopped'}
         
         stream_info = self.active_streams[stream_id]
-        process = stream_info['process']
+        info = process_supervisor.get_info(stream_id)
         
-        if process.poll() is None:
+        if info and info['running']:
             return {
-                'status': 'running',
+                'status': 'stalled' if stall_watchdog.is_stalled(stream_id) else 'running',
                 'start_time': stream_info['start_time'],
-                'uptime': (datetime.utcnow() - stream_info['start_time']).total_seconds()
+                'uptime': (datetime.utcnow() - stream_info['start_time']).total_seconds(),
+                'restarts': info['restarts'],
+                'preset': stream_info['preset'],
+                'pooled': stream_info.get('slot') is not None,
+                'watchdog': stall_watchdog.get_status(stream_id)
             }
+        elif info and info['restarting']:
+            return {'status': 'restarting', 'restarts': info['restarts']}
         else:
-            return {'status': 'error', 'return_code': process.returncode}
+            process = stream_info.get('process')
+            return {'status': 'error', 'return_code': process.returncode if process else None}
+    
+    def get_input_pipe(self, stream_id):
+        """Return the stdin pipe of a stream fed through PIPE_INPUT"""
+        stream_info = self.active_streams.get(stream_id)
+        if stream_info and stream_info.get('slot'):
+            return stream_info['slot'].process.stdin
+        process = self.processes.get(stream_id)
+        if not process:
+            return None
+        return process.stdin
+    
+    def process_keys(self, stream_id):
+        """Supervisor keys of every process working for a stream"""
+        stream_info = self.active_streams.get(stream_id)
+        if stream_info and stream_info.get('encoder'):
+            return [stream_id, stream_info['encoder']]
+        return [stream_id]
     
     def list_active_streams(self):
         """List all active streams"""
@@ -445,7 +445,7 @@ setup_supervisor() {
     # Create Supervisor configuration
     sudo tee /etc/supervisor/conf.d/streaming-panel.conf << EOF > /dev/null
 [program:streaming-panel]
-command=/opt/streaming-panel/venv/bin/gunicorn --bind 127.0.0.1:5000 --workers 4 --timeout 120 main:app
+command=/opt/streaming-panel/venv/bin/gunicorn --bind 127.0.0.1:5000 --workers 1 --worker-class gthread --threads 128 --timeout 120 main:app
 directory=/opt/streaming-panel
 user=$USER
 autostart=true
@@ -546,7 +546,7 @@ User=$USER
 Group=$USER
 WorkingDirectory=/opt/streaming-panel
 Environment=PATH=/opt/streaming-panel/venv/bin
-ExecStart=/opt/streaming-panel/venv/bin/gunicorn --bind 127.0.0.1:5000 --workers 4 --timeout 120 main:app
+ExecStart=/opt/streaming-panel/venv/bin/gunicorn --bind 127.0.0.1:5000 --workers 1 --worker-class gthread --threads 128 --timeout 120 main:app
 ExecReload=/bin/kill -s HUP \$MAINPID
 Restart=always
 RestartSec=10
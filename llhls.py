@@ -0,0 +1,470 @@
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from config import LL_HLS_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Sample flag bit marking a non-keyframe (ISO/IEC 14496-12 8.8.3.1)
+SAMPLE_IS_NON_SYNC = 0x10000
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, offset, size, header_size) for complete-header MP4 boxes"""
+    end = len(data) if end is None else end
+    offset = start
+    
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header_size = 8
+        
+        if size == 1:
+            if offset + 16 > end:
+                return
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        
+        if size < header_size:
+            return
+        
+        yield box_type.decode('latin-1'), offset, size, header_size
+        offset += size
+
+def find_box(data, path, start=0, end=None):
+    """Find a nested box by path such as ['moov', 'mvex', 'trex']"""
+    for box_type, offset, size, header_size in iter_boxes(data, start, end):
+        if box_type != path[0]:
+            continue
+        if len(path) == 1:
+            return offset + header_size, offset + size
+        return find_box(data, path[1:], offset + header_size, offset + size)
+    return None
+
+def read_init_segment(path):
+    """Read track timescale and trex defaults from an fMP4 init segment"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    mdhd = find_box(data, ['moov', 'trak', 'mdia', 'mdhd'])
+    if not mdhd:
+        return None
+    
+    version = data[mdhd[0]]
+    timescale_offset = mdhd[0] + (20 if version == 1 else 12)
+    timescale = struct.unpack_from('>I', data, timescale_offset)[0]
+    
+    defaults = {'timescale': timescale, 'sample_duration': 0, 'sample_flags': 0}
+    trex = find_box(data, ['moov', 'mvex', 'trex'])
+    if trex:
+        _, _, duration, _, flags = struct.unpack_from('>IIIII', data, trex[0] + 4)
+        defaults['sample_duration'] = duration
+        defaults['sample_flags'] = flags
+    
+    return defaults
+
+def parse_moof(data, start, end, defaults):
+    """Return (duration_in_timescale, independent) for one moof box body"""
+    traf = find_box(data, ['traf'], start, end)
+    if not traf:
+        return 0, False
+    
+    sample_duration = defaults['sample_duration']
+    sample_flags = defaults['sample_flags']
+    
+    tfhd = find_box(data, ['tfhd'], *traf)
+    if tfhd:
+        flags = struct.unpack_from('>I', data, tfhd[0])[0] & 0xFFFFFF
+        offset = tfhd[0] + 8
+        if flags & 0x01:
+            offset += 8
+        if flags & 0x02:
+            offset += 4
+        if flags & 0x08:
+            sample_duration = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        if flags & 0x10:
+            offset += 4
+        if flags & 0x20:
+            sample_flags = struct.unpack_from('>I', data, offset)[0]
+    
+    trun = find_box(data, ['trun'], *traf)
+    if not trun:
+        return 0, False
+    
+    flags = struct.unpack_from('>I', data, trun[0])[0] & 0xFFFFFF
+    sample_count = struct.unpack_from('>I', data, trun[0] + 4)[0]
+    offset = trun[0] + 8
+    first_sample_flags = None
+    
+    if flags & 0x001:
+        offset += 4
+    if flags & 0x004:
+        first_sample_flags = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+    
+    duration = 0
+    for index in range(sample_count):
+        this_duration = sample_duration
+        this_flags = sample_flags
+        if flags & 0x100:
+            this_duration = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        if flags & 0x200:
+            offset += 4
+        if flags & 0x400:
+            this_flags = struct.unpack_from('>I', data, offset)[0]
+            offset += 4
+        if flags & 0x800:
+            offset += 4
+        
+        if index == 0:
+            if first_sample_flags is not None:
+                this_flags = first_sample_flags
+            independent = not (this_flags & SAMPLE_IS_NON_SYNC)
+        duration += this_duration
+    
+    return duration, sample_count > 0 and independent
+
+class RenditionTracker:
+    """Follows the fMP4 segments of one representation as ffmpeg writes them.
+    
+    The dash muxer flushes one moof/mdat fragment per part_duration into
+    chunk-stream{N}-{msn}.m4s.tmp and renames it when the segment closes.
+    Each complete fragment becomes one LL-HLS partial segment. The tracker
+    is not thread-safe; LLHLSService polls and reads it under the stream's
+    condition.
+    """
+    
+    def __init__(self, package_dir, representation, part_target, window):
+        self.package_dir = package_dir
+        self.representation = representation
+        self.part_target = part_target
+        self.window = window
+        self.defaults = None
+        self.segments = []
+        self.current = self._new_segment(1)
+    
+    def _new_segment(self, msn):
+        return {'msn': msn, 'offset': 0, 'part_start': 0, 'parts': [], 'duration': 0.0}
+    
+    def segment_name(self, msn):
+        return f"chunk-stream{self.representation}-{msn:05d}.m4s"
+    
+    def init_name(self):
+        return f"init-stream{self.representation}.m4s"
+    
+    def segment_path(self, msn):
+        """Current on-disk path of a segment, open or closed"""
+        final_path = os.path.join(self.package_dir, self.segment_name(msn))
+        if os.path.exists(final_path):
+            return final_path
+        temp_path = f"{final_path}.tmp"
+        if os.path.exists(temp_path):
+            return temp_path
+        return None
+    
+    def poll(self):
+        """Pick up new parts and segments; return True if anything changed"""
+        if self.defaults is None:
+            init_path = os.path.join(self.package_dir, self.init_name())
+            if not os.path.exists(init_path):
+                return False
+            self.defaults = read_init_segment(init_path)
+            if self.defaults is None:
+                return False
+        
+        changed = False
+        
+        while True:
+            msn = self.current['msn']
+            final_path = os.path.join(self.package_dir, self.segment_name(msn))
+            closed = os.path.exists(final_path)
+            path = final_path if closed else f"{final_path}.tmp"
+            
+            try:
+                changed |= self._read_parts(path)
+            except FileNotFoundError:
+                # Not started yet, or renamed between the check and the read
+                if os.path.exists(final_path):
+                    continue
+                return changed
+            
+            if not closed:
+                return changed
+            
+            self.segments.append(self.current)
+            del self.segments[:-self.window]
+            self.current = self._new_segment(msn + 1)
+            changed = True
+    
+    def _read_parts(self, path):
+        """Parse fragments appended to a segment file since the last read"""
+        segment = self.current
+        
+        with open(path, 'rb') as f:
+            f.seek(segment['offset'])
+            data = f.read()
+        
+        base = segment['offset']
+        position = 0
+        changed = False
+        
+        for box_type, offset, size, header_size in iter_boxes(data):
+            if offset + size > len(data):
+                break
+            
+            if box_type == 'moof':
+                # A part is a moof plus its mdat; wait for both to be complete
+                mdat = next(iter_boxes(data, offset + size), None)
+                if not mdat or mdat[0] != 'mdat' or mdat[1] + mdat[2] > len(data):
+                    break
+                
+                duration, independent = parse_moof(data, offset + header_size, offset + size, self.defaults)
+                part_end = base + mdat[1] + mdat[2]
+                segment['parts'].append({
+                    'start': segment['part_start'],
+                    'length': part_end - segment['part_start'],
+                    'duration': duration / self.defaults['timescale'],
+                    'independent': independent
+                })
+                segment['duration'] += duration / self.defaults['timescale']
+                segment['part_start'] = part_end
+                position = mdat[1] + mdat[2]
+                changed = True
+            elif box_type != 'mdat':
+                # styp/sidx/prft prefix the next part
+                position = offset + size
+        
+        segment['offset'] = base + position
+        return changed
+    
+    def has(self, msn, part=None):
+        """Whether segment msn (or part of it) is available"""
+        if self.current['msn'] > msn:
+            return True
+        if part is None:
+            return False
+        return self.current['msn'] == msn and len(self.current['parts']) > part
+    
+    def target_duration(self):
+        """EXT-X-TARGETDURATION for the segments currently listed"""
+        durations = [segment['duration'] for segment in self.segments] or [self.part_target]
+        return max(1, math.ceil(max(durations)))
+    
+    def get_part(self, msn, part):
+        """Return the byte range of a part as (path, start, length)"""
+        segments = self.segments + [self.current]
+        for segment in segments:
+            if segment['msn'] == msn and part < len(segment['parts']):
+                path = self.segment_path(msn)
+                if path is None:
+                    return None
+                entry = segment['parts'][part]
+                return path, entry['start'], entry['length']
+        return None
+    
+    def build_playlist(self, media_url, part_url, part_segments):
+        """Render the LL-HLS media playlist for this representation"""
+        segments = self.segments
+        durations = [segment['duration'] for segment in segments] or [self.part_target]
+        target_duration = max(1, math.ceil(max(durations)))
+        first_msn = segments[0]['msn'] if segments else self.current['msn']
+        
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:9',
+            f'#EXT-X-TARGETDURATION:{target_duration}',
+            f'#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,PART-HOLD-BACK={self.part_target * 3:.3f}',
+            f'#EXT-X-PART-INF:PART-TARGET={self.part_target:.3f}',
+            f'#EXT-X-MEDIA-SEQUENCE:{first_msn}',
+            f'#EXT-X-MAP:URI="{media_url}/{self.init_name()}"'
+        ]
+        
+        # Parts are only listed for the segments closest to the live edge
+        recent = len(segments) - part_segments
+        for index, segment in enumerate(segments):
+            if index >= recent:
+                lines.extend(self._part_lines(segment, part_url))
+            lines.append(f"#EXTINF:{segment['duration']:.5f},")
+            lines.append(f"{media_url}/{self.segment_name(segment['msn'])}")
+        
+        current = self.current
+        lines.extend(self._part_lines(current, part_url))
+        lines.append(
+            f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="{part_url}/{self.representation}/'
+            f'{current["msn"]}.{len(current["parts"])}.m4s"'
+        )
+        
+        return '\n'.join(lines) + '\n'
+    
+    def _part_lines(self, segment, part_url):
+        lines = []
+        for index, part in enumerate(segment['parts']):
+            uri = f"{part_url}/{self.representation}/{segment['msn']}.{index}.m4s"
+            line = f"#EXT-X-PART:DURATION={part['duration']:.5f},URI=\"{uri}\""
+            if part['independent']:
+                line += ',INDEPENDENT=YES'
+            lines.append(line)
+        return lines
+
+class LLHLSService:
+    """Tracks LL-HLS streams and serves blocking playlist reloads.
+    
+    One background thread follows every registered representation. Blocked
+    reloads wait on a shared per-stream Condition that the tracker notifies
+    when parts land, so waiting requests do no polling of their own. Each
+    parked request holds one thread of gunicorn's gthread worker until it
+    is released.
+    """
+    
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.tracker_thread = None
+    
+    def register(self, stream_id, package_dir, representations, latency_mode, media_url, part_url):
+        """Start following a stream's CMAF package"""
+        settings = LL_HLS_SETTINGS[latency_mode]
+        
+        with self.lock:
+            self.streams[stream_id] = {
+                'condition': threading.Condition(),
+                'media_url': media_url,
+                'part_url': part_url,
+                'part_segments': settings['part_segments'],
+                'part_target': settings['part_duration'],
+                'renditions': [
+                    RenditionTracker(package_dir, representation, settings['part_duration'],
+                                     settings['playlist_segments'])
+                    for representation in range(representations)
+                ]
+            }
+            
+            if not self.tracker_thread or not self.tracker_thread.is_alive():
+                self.tracker_thread = threading.Thread(target=self._track, name='ll-hls-tracker')
+                self.tracker_thread.daemon = True
+                self.tracker_thread.start()
+        
+        logger.info(f"LL-HLS tracking stream {stream_id} with {representations} representations")
+    
+    def unregister(self, stream_id):
+        """Stop following a stream and release its waiters"""
+        with self.lock:
+            stream = self.streams.pop(stream_id, None)
+        
+        if stream:
+            with stream['condition']:
+                stream['condition'].notify_all()
+    
+    def is_registered(self, stream_id):
+        return stream_id in self.streams
+    
+    def _track(self):
+        """Poll registered representations for new parts"""
+        while True:
+            with self.lock:
+                streams = list(self.streams.values())
+            if not streams:
+                time.sleep(0.5)
+                continue
+            
+            interval = min(stream['part_target'] for stream in streams) / 4
+            for stream in streams:
+                try:
+                    # Renditions are only changed under the condition, so
+                    # playlist and part readers never see a half-moved segment
+                    with stream['condition']:
+                        changed = False
+                        for rendition in stream['renditions']:
+                            changed |= rendition.poll()
+                        if changed:
+                            stream['condition'].notify_all()
+                except Exception as e:
+                    logger.error(f"Error tracking LL-HLS parts: {e}")
+            
+            time.sleep(interval)
+    
+    def _wait_for(self, stream_id, representation, msn, part, timeout):
+        """Block until (msn, part) is available; return the stream or None"""
+        stream = self.streams.get(stream_id)
+        if not stream or representation >= len(stream['renditions']):
+            return None
+        
+        rendition = stream['renditions'][representation]
+        with stream['condition']:
+            stream['condition'].wait_for(
+                lambda: rendition.has(msn, part) or stream_id not in self.streams,
+                timeout=timeout
+            )
+            if not rendition.has(msn, part):
+                return None
+        return stream
+    
+    def get_playlist(self, stream_id, representation, msn=None, part=None):
+        """Return (status, body) for a media playlist request.
+        
+        With _HLS_msn/_HLS_part the request is held until the playlist
+        contains that segment or part, as required for blocking reloads.
+        """
+        stream = self.streams.get(stream_id)
+        if not stream or representation >= len(stream['renditions']):
+            return 404, None
+        
+        rendition = stream['renditions'][representation]
+        
+        if msn is not None:
+            with stream['condition']:
+                current_msn = rendition.current['msn']
+                target_duration = rendition.target_duration()
+            
+            # Requests more than two segments ahead are rejected (RFC 8216bis 6.2.5.2)
+            if msn > current_msn + 2:
+                return 400, None
+            
+            # Hold for at most three target durations before giving up
+            timeout = 3 * target_duration
+            if not self._wait_for(stream_id, representation, msn, part, timeout):
+                return 503, None
+        
+        with stream['condition']:
+            return 200, rendition.build_playlist(stream['media_url'], stream['part_url'],
+                                                 stream['part_segments'])
+    
+    def get_part(self, stream_id, representation, msn, part):
+        """Return part bytes, blocking until a preload-hinted part completes"""
+        stream = self.streams.get(stream_id)
+        if not stream or representation >= len(stream['renditions']):
+            return None
+        
+        rendition = stream['renditions'][representation]
+        with stream['condition']:
+            current_msn = rendition.current['msn']
+        if msn > current_msn + 1:
+            return None
+        
+        if not self._wait_for(stream_id, representation, msn, part, 3.0):
+            return None
+        
+        with stream['condition']:
+            location = rendition.get_part(msn, part)
+        if not location:
+            return None
+        
+        path, start, length = location
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                return f.read(length)
+        except FileNotFoundError:
+            # Segment closed (renamed) while reading; the final file has the
+            # same bytes
+            with open(os.path.join(rendition.package_dir, rendition.segment_name(msn)), 'rb') as f:
+                f.seek(start)
+                return f.read(length)
+
+# Global LL-HLS service instance
+ll_hls_service = LLHLSService()
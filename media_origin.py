@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+from flask import Response, request, send_file, abort
+from werkzeug.security import safe_join
+from viewer_analytics import viewer_analytics
+from config import ORIGIN_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.mpd': 'application/dash+xml'
+}
+
+SEGMENT_TYPES = {
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4',
+    '.m4v': 'video/mp4',
+    '.m4a': 'audio/mp4',
+    '.ts': 'video/mp2t',
+    '.aac': 'audio/aac',
+    '.vtt': 'text/vtt'
+}
+
+def viewer_session():
+    """Viewer session of the current media request"""
+    # Players without a session id are told apart by address and agent
+    return request.args.get('session') or (request.access_route[0] if request.access_route else None,
+                                           request.user_agent.string)
+
+class InFlight:
+    """A disk read other requests for the same file can wait on"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.data = None
+
+class MediaOrigin:
+    """Serves stream playlists and segments from MEDIA_ROOT.
+    
+    Playlists and recently written segments are kept in a byte-bounded LRU
+    keyed by path, mtime and size, so a rewritten file is a new entry and
+    never served stale. Concurrent misses for the same file share one disk
+    read. Older or large files go through send_file, which uses the
+    server's wsgi.file_wrapper (sendfile under gunicorn). Segments are
+    immutable once written and cached accordingly; playlists are not.
+    """
+    
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.size = 0
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+    
+    def serve(self, root, filename):
+        """Response for a file under root, honouring conditional and range requests"""
+        path = safe_join(root, filename)
+        if path is None:
+            abort(404)
+        
+        extension = os.path.splitext(path)[1].lower()
+        playlist = extension in PLAYLIST_TYPES
+        mimetype = PLAYLIST_TYPES.get(extension) or SEGMENT_TYPES.get(extension)
+        if mimetype is None:
+            abort(404)
+        
+        try:
+            stat = os.stat(path)
+        except OSError:
+            abort(404)
+        
+        age = time.time() - stat.st_mtime
+        if playlist or (age <= ORIGIN_SETTINGS['hot_window']
+                        and stat.st_size <= ORIGIN_SETTINGS['max_entry_bytes']):
+            data = self._read_cached((path, stat.st_mtime_ns, stat.st_size))
+            if data is None:
+                abort(404)
+            response = Response(data, mimetype=mimetype)
+            response.set_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+            response.last_modified = stat.st_mtime
+            response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+        else:
+            response = send_file(path, mimetype=mimetype, conditional=True,
+                                 etag=f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+        
+        response.headers['Cache-Control'] = self._cache_control(playlist, age)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        
+        viewer_analytics.record(filename, viewer_session(), response.content_length or 0)
+        return response
+    
+    def _cache_control(self, playlist, age):
+        if playlist:
+            return f"public, max-age={ORIGIN_SETTINGS['playlist_max_age']}"
+        # A segment may still be growing right after it appears
+        if age < ORIGIN_SETTINGS['settle_time']:
+            return f"public, max-age={ORIGIN_SETTINGS['playlist_max_age']}"
+        return f"public, max-age={ORIGIN_SETTINGS['segment_max_age']}, immutable"
+    
+    def _read_cached(self, key):
+        """File contents from the LRU, or read once for all concurrent misses"""
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data
+            
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = InFlight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            flight.done.wait(ORIGIN_SETTINGS['read_timeout'])
+            return flight.data
+        
+        try:
+            with open(key[0], 'rb') as f:
+                flight.data = f.read()
+        except OSError as e:
+            logger.warning(f"Could not read {key[0]}: {e}")
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if flight.data is not None:
+                    self._store(key, flight.data)
+            flight.done.set()
+        return flight.data
+    
+    def _store(self, key, data):
+        # An older version of the same file is a dead entry now
+        stale = self.versions.get(key[0])
+        if stale in self.entries:
+            self.size -= len(self.entries.pop(stale))
+        
+        self.entries[key] = data
+        self.versions[key[0]] = key
+        self.size += len(data)
+        while self.size > ORIGIN_SETTINGS['cache_bytes'] and len(self.entries) > 1:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            if self.versions.get(evicted_key[0]) == evicted_key:
+                del self.versions[evicted_key[0]]
+    
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced
+            }
+
+# Global media origin instance
+media_origin = MediaOrigin()
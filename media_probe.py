@@ -0,0 +1,166 @@
+import json
+import time
+import threading
+import subprocess
+import logging
+from rtmp_protocol import amf0_decode, MSG_AUDIO, MSG_VIDEO, MSG_DATA_AMF0
+from config import FFPROBE_PATH, PROBE_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# H.264 profiles every player of the ladder can decode
+PASSTHROUGH_PROFILES = ('Baseline', 'Constrained Baseline', 'Main', 'High')
+PASSTHROUGH_PIXEL_FORMATS = (None, 'yuv420p', 'yuvj420p')
+
+H264_PROFILES = {66: 'Baseline', 77: 'Main', 88: 'Extended', 100: 'High', 110: 'High 10',
+                 122: 'High 4:2:2', 244: 'High 4:4:4 Predictive'}
+
+def max_keyframe_interval(keyframe_times):
+    """Longest gap between keyframes, or None with fewer than two"""
+    keyframe_times = sorted(keyframe_times)
+    if len(keyframe_times) < 2:
+        return None
+    return max(later - earlier for earlier, later in zip(keyframe_times, keyframe_times[1:]))
+
+def same_input(cached, result):
+    """Whether a fresh probe agrees with a cached one on what passthrough uses"""
+    for field in ('video_codec', 'profile', 'width', 'height', 'audio_codec'):
+        if cached.get(field) != result.get(field):
+            return False
+    if cached.get('gop') is None or result.get('gop') is None:
+        return cached.get('gop') == result.get('gop')
+    return abs(cached['gop'] - result['gop']) <= 0.1
+
+class FlvProbe:
+    """Builds a probe result from the FLV tags of a native RTMP publish"""
+    
+    def __init__(self):
+        self.result = {'video_codec': None, 'profile': None, 'width': None, 'height': None,
+                       'pix_fmt': None, 'audio_codec': None, 'gop': None}
+        self.keyframes = []
+    
+    def feed(self, tag_type, timestamp, payload):
+        """Inspect one tag; returns True once enough has been seen"""
+        if not payload:
+            return False
+        
+        if tag_type == MSG_DATA_AMF0:
+            values = amf0_decode(payload)
+            metadata = values[1] if len(values) > 1 and isinstance(values[1], dict) else {}
+            if metadata.get('width') and metadata.get('height'):
+                self.result['width'] = int(metadata['width'])
+                self.result['height'] = int(metadata['height'])
+        
+        elif tag_type == MSG_AUDIO:
+            self.result['audio_codec'] = 'aac' if payload[0] >> 4 == 10 else 'other'
+        
+        elif tag_type == MSG_VIDEO:
+            if payload[0] & 0x0F != 7:
+                self.result['video_codec'] = 'other'
+            elif len(payload) > 7 and payload[1] == 0:
+                # AVCDecoderConfigurationRecord follows the 5 byte video header
+                self.result['video_codec'] = 'h264'
+                profile = H264_PROFILES.get(payload[6], str(payload[6]))
+                if payload[6] == 66 and payload[7] & 0x40:
+                    profile = 'Constrained Baseline'
+                self.result['profile'] = profile
+            elif payload[0] >> 4 == 1:
+                self.keyframes.append(timestamp / 1000.0)
+        
+        if self.keyframes and self.keyframes[-1] - self.keyframes[0] >= PROBE_SETTINGS['gop_window']:
+            self.result['gop'] = max_keyframe_interval(self.keyframes)
+            return True
+        return False
+
+class MediaProbe:
+    """Input probing with results cached per stream key"""
+    
+    def __init__(self):
+        self.cache = {}
+        self.lock = threading.Lock()
+    
+    def get_cached(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            self.cache.pop(key, None)
+        return None
+    
+    def store(self, key, result):
+        with self.lock:
+            self.cache[key] = (time.monotonic() + PROBE_SETTINGS['cache_ttl'], result)
+        logger.info(f"Probed {key}: {result}")
+    
+    def probe(self, input_url, cache_key=None):
+        """Probe codecs, resolution and GOP of an input with ffprobe"""
+        cache_key = cache_key or input_url
+        cached = self.get_cached(cache_key)
+        if cached:
+            return cached
+        
+        cmd = [
+            FFPROBE_PATH, '-v', 'error', '-of', 'json',
+            '-read_intervals', f"%+{PROBE_SETTINGS['gop_window']}",
+            '-show_entries',
+            'stream=index,codec_type,codec_name,profile,width,height,pix_fmt:packet=stream_index,pts_time,flags',
+            input_url
+        ]
+        
+        try:
+            completed = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                       timeout=PROBE_SETTINGS['timeout'], check=True)
+            data = json.loads(completed.stdout or b'{}')
+        except Exception as e:
+            logger.warning(f"Could not probe {input_url}: {e}")
+            return None
+        
+        result = {'video_codec': None, 'profile': None, 'width': None, 'height': None,
+                  'pix_fmt': None, 'audio_codec': None, 'gop': None}
+        video_index = None
+        
+        for stream in data.get('streams', []):
+            if stream.get('codec_type') == 'video' and video_index is None:
+                video_index = stream.get('index')
+                result.update({
+                    'video_codec': stream.get('codec_name'),
+                    'profile': stream.get('profile'),
+                    'width': stream.get('width'),
+                    'height': stream.get('height'),
+                    'pix_fmt': stream.get('pix_fmt')
+                })
+            elif stream.get('codec_type') == 'audio' and result['audio_codec'] is None:
+                result['audio_codec'] = stream.get('codec_name')
+        
+        keyframes = [float(packet['pts_time']) for packet in data.get('packets', [])
+                     if packet.get('stream_index') == video_index and 'K' in packet.get('flags', '')
+                     and packet.get('pts_time') not in (None, 'N/A')]
+        result['gop'] = max_keyframe_interval(keyframes)
+        
+        self.store(cache_key, result)
+        return result
+    
+    def passthrough_for(self, result, rendition, keyframe_interval):
+        """Which tracks can be stream-copied into the top rendition.
+        
+        Video is copied when it is H.264 in a common profile at exactly the
+        rendition's size with keyframes at least every keyframe_interval
+        seconds, so segments still cut on time. AAC audio is always copied.
+        """
+        if not result:
+            return {'video': False, 'audio': False}
+        
+        width_matches = result['width'] is not None and abs(result['width'] - rendition['width']) <= 8
+        video = (
+            result['video_codec'] == 'h264'
+            and result['profile'] in PASSTHROUGH_PROFILES
+            and result['pix_fmt'] in PASSTHROUGH_PIXEL_FORMATS
+            and result['height'] == rendition['height']
+            and width_matches
+            and result['gop'] is not None
+            and result['gop'] <= keyframe_interval + 0.1
+        )
+        return {'video': video, 'audio': result['audio_codec'] == 'aac'}
+
+# Global media probe instance
+media_probe = MediaProbe()
@@ -0,0 +1,220 @@
+import bisect
+import threading
+import time
+import logging
+from config import METRICS_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+class ShardedMetric:
+    """Base of metrics whose values are kept per thread.
+    
+    Each thread updates its own dict without locking; a scrape sums the
+    shards. Shards of threads that have exited are folded into one when
+    there are many, so per-request threads do not pile up.
+    """
+    
+    kind = None
+    
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.local = threading.local()
+        self.shards = []
+        self.retired = {}
+        self.lock = threading.Lock()
+    
+    def _shard(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                if len(self.shards) >= METRICS_SETTINGS['max_shards']:
+                    self._retire()
+                self.shards.append((threading.current_thread(), values))
+            return values
+    
+    def _retire(self):
+        """Fold shards of exited threads into one (lock held)"""
+        live = []
+        for thread, values in self.shards:
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                for labels, value in list(values.items()):
+                    self._fold(self.retired, labels, value)
+        self.shards = live
+    
+    def _snapshot(self):
+        totals = {}
+        with self.lock:
+            self._retire()
+            for labels, value in list(self.retired.items()):
+                self._fold(totals, labels, value)
+            for _, values in self.shards:
+                for labels, value in list(values.items()):
+                    self._fold(totals, labels, value)
+        return totals
+    
+    def _labels(self, labels, extra=None):
+        pairs = list(zip(self.labelnames, labels))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+class Counter(ShardedMetric):
+    """Monotonic counter"""
+    
+    kind = 'counter'
+    
+    def inc(self, labels=(), amount=1):
+        values = self._shard()
+        values[labels] = values.get(labels, 0) + amount
+    
+    def _fold(self, totals, labels, value):
+        totals[labels] = totals.get(labels, 0) + value
+    
+    def render(self):
+        return [f'{self.name}{self._labels(labels)} {value}' for labels, value in sorted(self._snapshot().items())]
+
+class Histogram(ShardedMetric):
+    """Distribution over fixed bucket bounds"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=None):
+        super().__init__(name, help_text, labelnames)
+        self.bounds = tuple(buckets or METRICS_SETTINGS['latency_buckets'])
+    
+    def observe(self, value, labels=()):
+        values = self._shard()
+        counts = values.get(labels)
+        if counts is None:
+            # Bucket counts, then +Inf, then the sum
+            counts = values[labels] = [0] * (len(self.bounds) + 2)
+        counts[bisect.bisect_left(self.bounds, value)] += 1
+        counts[-1] += value
+    
+    def time(self, labels=()):
+        return Timer(self, labels)
+    
+    def _fold(self, totals, labels, value):
+        current = totals.get(labels)
+        totals[labels] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+    
+    def render(self):
+        lines = []
+        for labels, counts in sorted(self._snapshot().items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{self._labels(labels, ("le", bound))} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {counts[-1]}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {cumulative}')
+        return lines
+
+class Timer:
+    """Context manager observing its duration in seconds"""
+    
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+    
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, self.labels)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """Metrics in Prometheus text exposition format.
+    
+    Hot paths update Counters and Histograms; values that already exist
+    elsewhere (encoder stats, cache counters) are read by collectors, which
+    run only when /metrics is scraped.
+    """
+    
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+    
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, name, help_text, labelnames=(), buckets=None):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    def register_collector(self, collector):
+        """Add collector() -> [(name, kind, help, [(labels dict, value)])]"""
+        self.collectors.append(collector)
+    
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help_text}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        
+        for collector in self.collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.error(f"Metrics collector {collector.__name__} failed: {e}")
+                continue
+            
+            for name, kind, help_text, samples in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    label_text = ','.join(f'{key}="{escape(label)}"' for key, label in labels.items())
+                    lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+# Global metrics registry instance
+metrics = MetricsRegistry()
+
+# Metrics updated on hot paths
+request_latency = metrics.histogram('stropen_http_request_duration_seconds',
+                                    'Flask request handling time', ('route', 'method', 'status'))
+query_latency = metrics.histogram('stropen_db_query_duration_seconds',
+                                  'Database statement execution time', ('statement',))
+segment_latency = metrics.histogram('stropen_segment_publish_delay_seconds',
+                                    'Time from a segment\'s last write to the playlist listing it',
+                                    ('stream',))
+process_restarts = metrics.counter('stropen_process_restarts_total',
+                                   'Supervised processes restarted after an unexpected exit', ('process',))
+supervisor_lag = metrics.histogram('stropen_supervisor_lag_seconds',
+                                   'How late the process supervisor wakes up after its scheduled time; '
+                                   'reading every process\'s pipes is delayed as much')
+
+def instrument_database():
+    """Time every statement of every engine"""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    
+    def before(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_started', []).append(time.perf_counter())
+    
+    def after(connection, cursor, statement, parameters, context, executemany):
+        started = connection.info['query_started'].pop()
+        query_latency.observe(time.perf_counter() - started, (statement.split(None, 1)[0].upper(),))
+    
+    def failed(context):
+        if context.connection is not None and context.connection.info.get('query_started'):
+            context.connection.info['query_started'].pop()
+    
+    event.listen(Engine, 'before_cursor_execute', before)
+    event.listen(Engine, 'after_cursor_execute', after)
+    event.listen(Engine, 'handle_error', failed)
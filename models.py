@@ -1,7 +1,8 @@
 from app import db
 from datetime import datetime
-from sqlalchemy import Text, JSON
+from sqlalchemy import Text, JSON, inspect, text
 import json
+import os
 
 class Stream(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -15,6 +16,7 @@ class Stream(db.Model):
     # Streaming settings
     latency_mode = db.Column(db.String(10), default='low')  # low, high
     record_enabled = db.Column(db.Boolean, default=False)
+    dvr_window = db.Column(db.Integer, default=0)  # seconds of rewind, 0 = off
     
     # Video settings
     video_codec = db.Column(db.String(20), default='h264')
@@ -25,6 +27,9 @@ class Stream(db.Model):
     # Multi-destination settings
     destinations = db.Column(Text)  # JSON string of destinations
     
+    # Encoder worker running the stream in cluster mode
+    worker_id = db.Column(db.String(100))
+    
     def get_destinations(self):
         if self.destinations:
             return json.loads(self.destinations)
@@ -36,12 +41,25 @@ class Stream(db.Model):
 class StreamOutput(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     stream_id = db.Column(db.Integer, db.ForeignKey('stream.id'), nullable=False)
-    format_type = db.Column(db.String(10), nullable=False)  # hls, dash
+    format_type = db.Column(db.String(10), nullable=False)  # hls, dash, cmaf
     resolution = db.Column(db.String(20), nullable=False)  # 720p, 1080p, etc
     bitrate = db.Column(db.Integer, nullable=False)
     output_path = db.Column(db.String(500), nullable=False)
     
     stream = db.relationship('Stream', backref=db.backref('outputs', lazy=True))
+    
+    def get_manifests(self):
+        """Manifest paths for this output, keyed by format.
+
+        A CMAF output is packaged once and described by both an HLS playlist
+        and a DASH manifest that reference the same fMP4 segments.
+        """
+        if self.format_type == 'cmaf':
+            return {
+                'hls': f"{os.path.splitext(self.output_path)[0]}.m3u8",
+                'dash': self.output_path
+            }
+        return {self.format_type: self.output_path}
 
 class StreamStats(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -51,8 +69,60 @@ class StreamStats(db.Model):
     bitrate = db.Column(db.Float, default=0.0)
     frame_rate = db.Column(db.Float, default=0.0)
     packet_loss = db.Column(db.Float, default=0.0)
+    speed = db.Column(db.Float, default=0.0)  # encode speed relative to real time
+    dropped_frames = db.Column(db.Integer, default=0)
+    duplicate_frames = db.Column(db.Integer, default=0)
+    out_time = db.Column(db.Float, default=0.0)  # seconds of output encoded
     
     stream = db.relationship('Stream', backref=db.backref('stats', lazy=True))
+    
+    __table_args__ = (
+        db.Index('ix_stream_stats_stream_timestamp', 'stream_id', 'timestamp'),
+    )
+
+class StreamStatsRollup(db.Model):
+    """min/avg/max of StreamStats over fixed time buckets"""
+    id = db.Column(db.Integer, primary_key=True)
+    stream_id = db.Column(db.Integer, db.ForeignKey('stream.id'), nullable=False)
+    resolution = db.Column(db.Integer, nullable=False)  # bucket length in seconds
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    samples = db.Column(db.Integer, default=0)
+    viewers_min = db.Column(db.Float, default=0.0)
+    viewers_avg = db.Column(db.Float, default=0.0)
+    viewers_max = db.Column(db.Float, default=0.0)
+    bitrate_min = db.Column(db.Float, default=0.0)
+    bitrate_avg = db.Column(db.Float, default=0.0)
+    bitrate_max = db.Column(db.Float, default=0.0)
+    frame_rate_min = db.Column(db.Float, default=0.0)
+    frame_rate_avg = db.Column(db.Float, default=0.0)
+    frame_rate_max = db.Column(db.Float, default=0.0)
+    packet_loss_min = db.Column(db.Float, default=0.0)
+    packet_loss_avg = db.Column(db.Float, default=0.0)
+    packet_loss_max = db.Column(db.Float, default=0.0)
+    
+    __table_args__ = (
+        db.Index('ix_stream_stats_rollup_bucket', 'stream_id', 'resolution', 'bucket_start', unique=True),
+    )
+
+class QoEStats(db.Model):
+    """Player QoE beacons of one stream and rendition over a flush interval"""
+    id = db.Column(db.Integer, primary_key=True)
+    stream_id = db.Column(db.Integer, db.ForeignKey('stream.id'), nullable=False)
+    rendition = db.Column(db.String(20))  # None for all renditions
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    beacons = db.Column(db.Integer, default=0)
+    startup_p50 = db.Column(db.Float)  # milliseconds
+    startup_p95 = db.Column(db.Float)
+    rebuffer_count = db.Column(db.Integer, default=0)
+    rebuffer_duration = db.Column(db.Float, default=0.0)  # milliseconds
+    play_time = db.Column(db.Float, default=0.0)  # milliseconds
+    switches = db.Column(db.Integer, default=0)
+    dropped_frames = db.Column(db.Integer, default=0)
+    sketches = db.Column(Text)  # JSON quantile sketches, merged across rows on query
+    
+    __table_args__ = (
+        db.Index('ix_qoe_stats_stream_timestamp', 'stream_id', 'timestamp'),
+    )
 
 class StreamDestination(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -62,3 +132,25 @@ class StreamDestination(db.Model):
     stream_key = db.Column(db.String(200), nullable=False)
     enabled = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def ensure_schema():
+    """Add columns and indexes introduced after a table was first created.
+    
+    db.create_all() only creates missing tables, so existing databases get
+    new nullable columns and indexes added here.
+    """
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
@@ -0,0 +1,63 @@
+import logging
+import os
+from config import QUALITY_PROFILES, AUDIO_BITRATE
+
+logger = logging.getLogger(__name__)
+
+class Packager:
+    """Writes per-stream HLS master playlists for ladder outputs"""
+    
+    def write_master_playlist(self, path, variants, audio_uri=None):
+        """Write a multi-variant master playlist.
+        
+        variants is a list of {'resolution', 'uri'} dicts ordered highest
+        first; bandwidth and resolution come from QUALITY_PROFILES. When
+        audio_uri is given the variants reference it as a shared audio
+        rendition (CMAF packages keep audio in its own media playlist).
+        """
+        try:
+            content = self.build_master_playlist(variants, audio_uri)
+            
+            # Write atomically so players never fetch a partial playlist
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+            
+            logger.info(f"Wrote master playlist {path} with {len(variants)} variants")
+            return True
+        
+        except Exception as e:
+            logger.error(f"Error writing master playlist {path}: {e}")
+            return False
+    
+    def build_master_playlist(self, variants, audio_uri=None):
+        """Build master playlist text"""
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-INDEPENDENT-SEGMENTS']
+        
+        if audio_uri:
+            lines.append(
+                '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio",NAME="audio",'
+                f'DEFAULT=YES,AUTOSELECT=YES,URI="{audio_uri}"'
+            )
+        
+        for variant in variants:
+            quality = QUALITY_PROFILES[variant['resolution']]
+            average = (quality['bitrate'] + AUDIO_BITRATE) * 1000
+            
+            # BANDWIDTH is a peak value; leave headroom for container overhead
+            attributes = [
+                f"BANDWIDTH={int(average * 1.1)}",
+                f"AVERAGE-BANDWIDTH={average}",
+                f"RESOLUTION={quality['width']}x{quality['height']}"
+            ]
+            if audio_uri:
+                attributes.append('AUDIO="audio"')
+            
+            lines.append(f"#EXT-X-STREAM-INF:{','.join(attributes)}")
+            lines.append(variant['uri'])
+        
+        return '\n'.join(lines) + '\n'
+
+# Global packager instance
+packager = Packager()
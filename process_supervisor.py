@@ -0,0 +1,337 @@
+import os
+import time
+import selectors
+import subprocess
+import threading
+import logging
+from metrics import process_restarts, supervisor_lag
+from config import PROCESS_RESTART
+
+logger = logging.getLogger(__name__)
+
+# Longest partial line kept per pipe before it is delivered as-is
+MAX_LINE_LENGTH = 64 * 1024
+READ_SIZE = 64 * 1024
+# Seconds between the wake-ups the loop schedules to measure its own lag
+LAG_TICK = 0.5
+
+class SupervisedProcess:
+    """A child process and the state needed to read, reap and restart it"""
+    
+    def __init__(self, key, cmd, popen_kwargs, on_start, on_output, on_exit, restart):
+        self.key = key
+        self.cmd = cmd
+        self.popen_kwargs = popen_kwargs
+        self.on_start = on_start
+        self.on_output = on_output
+        self.on_exit = on_exit
+        self.restart = restart
+        self.process = None
+        self.started_at = None
+        self.open_pipes = 0
+        self.stopping = False
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = None
+
+class ProcessSupervisor:
+    """Runs every child process's pipes on a single selector thread.
+    
+    Output is split into lines (ffmpeg separates stats updates with \\r) and
+    handed to on_output(key, source, line) where source is 'stdout' or
+    'stderr'. Unexpected exits are restarted with exponential backoff when
+    the process was started with restart=True; on_exit(key, returncode,
+    restarting) is called for every exit.
+    """
+    
+    def __init__(self):
+        self.entries = {}
+        self.exiting = set()
+        self.waiting = set()
+        self.lock = threading.Lock()
+        self.selector = None
+        self.thread = None
+        self.wake_read = None
+        self.wake_write = None
+    
+    def start(self, key, cmd, stdin=False, stdout=None, on_start=None, on_output=None, on_exit=None,
+              restart=False):
+        """Spawn cmd under supervision and return its Popen object.
+        
+        stdin is a pipe when True; stdin and stdout may also be file
+        descriptors to connect the process to another one, in which case
+        the process must not be restarted.
+        """
+        self._ensure_running()
+        
+        if stdin is True:
+            stdin = subprocess.PIPE
+        elif stdin is False or stdin is None:
+            stdin = subprocess.DEVNULL
+        popen_kwargs = {
+            'stdin': stdin,
+            'stdout': subprocess.PIPE if stdout is None else stdout,
+            'stderr': subprocess.PIPE
+        }
+        entry = SupervisedProcess(key, cmd, popen_kwargs, on_start, on_output, on_exit, restart)
+        
+        with self.lock:
+            previous = self.entries.get(key)
+            if previous and not previous.stopping:
+                raise RuntimeError(f"Process {key} is already supervised")
+            self._spawn(entry)
+            self.entries[key] = entry
+        
+        self._wake()
+        return entry.process
+    
+    def stop(self, key, timeout=10):
+        """Stop a supervised process without restarting it"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry.stopping:
+                return False
+            entry.stopping = True
+            if entry in self.waiting:
+                # Already exited and waiting out its backoff
+                self.waiting.discard(entry)
+                entry.restart_at = None
+                self.exiting.add(entry)
+            process = entry.process
+        
+        self._wake()
+        if process is None or process.poll() is not None:
+            return True
+        
+        process.terminate()
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Force killing process {key}")
+            process.kill()
+            process.wait()
+        return True
+    
+    def restart(self, key):
+        """Kill a hung process so it is restarted with the usual backoff.
+        
+        Only processes started with restart=True qualify; returns False if
+        there is no running process to restart.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry or entry.stopping or not entry.restart or entry.process is None:
+                return False
+            process = entry.process
+        
+        if process.poll() is not None:
+            return False
+        logger.info(f"Killing process {key} to restart it")
+        process.kill()
+        return True
+    
+    def get_process(self, key):
+        entry = self.entries.get(key)
+        return entry.process if entry else None
+    
+    def get_info(self, key):
+        """Current state of a supervised process, or None"""
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        
+        return {
+            'pid': entry.process.pid if entry.process else None,
+            'running': entry.process is not None and entry.process.poll() is None,
+            'restarting': entry.restart_at is not None,
+            'restarts': entry.restarts,
+            'started_at': entry.started_at
+        }
+    
+    def list_keys(self):
+        return list(self.entries.keys())
+    
+    def _ensure_running(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            
+            self.selector = selectors.DefaultSelector()
+            self.wake_read, self.wake_write = os.pipe()
+            os.set_blocking(self.wake_read, False)
+            os.set_blocking(self.wake_write, False)
+            self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+            
+            self.thread = threading.Thread(target=self._run, name='process-supervisor')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def _wake(self):
+        try:
+            os.write(self.wake_write, b'\0')
+        except (BlockingIOError, OSError):
+            pass
+    
+    def _spawn(self, entry):
+        """Start entry's process and register its pipes (lock held)"""
+        entry.process = subprocess.Popen(entry.cmd, **entry.popen_kwargs)
+        entry.started_at = time.monotonic()
+        entry.restart_at = None
+        entry.open_pipes = 0
+        
+        for source in ('stdout', 'stderr'):
+            pipe = getattr(entry.process, source)
+            if pipe is None:
+                continue
+            os.set_blocking(pipe.fileno(), False)
+            self.selector.register(pipe.fileno(), selectors.EVENT_READ, (entry, source, pipe, bytearray()))
+            entry.open_pipes += 1
+        
+        if entry.on_start:
+            entry.on_start(entry.key, entry.process)
+    
+    def _run(self):
+        tick_at = time.monotonic() + LAG_TICK
+        while True:
+            try:
+                timeout = max(0, min(self._next_timeout(), tick_at - time.monotonic()))
+                events = self.selector.select(timeout)
+                
+                # A busy batch of pipes delays the wake after it
+                woke = time.monotonic()
+                if woke >= tick_at:
+                    supervisor_lag.observe(woke - tick_at)
+                    tick_at = woke + LAG_TICK
+                
+                for selector_key, _ in events:
+                    if selector_key.data is None:
+                        self._drain_wake()
+                    else:
+                        self._read(selector_key)
+                
+                if self.exiting:
+                    self._reap()
+                if self.waiting:
+                    self._restart_due()
+            except Exception as e:
+                logger.error(f"Process supervisor error: {e}")
+                time.sleep(0.1)
+    
+    def _next_timeout(self):
+        if not self.exiting and not self.waiting:
+            return 1.0
+        with self.lock:
+            # Processes whose pipes are closed are polled until they exit
+            if self.exiting:
+                return 0.1
+            if self.waiting:
+                deadline = min(entry.restart_at for entry in self.waiting)
+                return max(0, deadline - time.monotonic())
+        return 1.0
+    
+    def _drain_wake(self):
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+    
+    def _read(self, selector_key):
+        entry, source, pipe, buffer = selector_key.data
+        try:
+            data = os.read(selector_key.fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        
+        if not data:
+            if buffer:
+                self._deliver(entry, source, bytes(buffer))
+            self.selector.unregister(selector_key.fd)
+            pipe.close()
+            entry.open_pipes -= 1
+            if entry.open_pipes == 0:
+                with self.lock:
+                    self.exiting.add(entry)
+            return
+        
+        buffer += data.replace(b'\r', b'\n')
+        if b'\n' not in data and b'\r' not in data:
+            if len(buffer) > MAX_LINE_LENGTH:
+                self._deliver(entry, source, bytes(buffer))
+                buffer.clear()
+            return
+        
+        *lines, rest = buffer.split(b'\n')
+        buffer[:] = rest
+        for line in lines:
+            if line:
+                self._deliver(entry, source, line)
+    
+    def _deliver(self, entry, source, line):
+        if not entry.on_output:
+            return
+        try:
+            entry.on_output(entry.key, source, line.decode('utf-8', 'replace'))
+        except Exception as e:
+            logger.error(f"Output handler for {entry.key} failed: {e}")
+    
+    def _reap(self):
+        """Detect exits of processes whose pipes have all closed"""
+        with self.lock:
+            candidates = list(self.exiting)
+        
+        for entry in candidates:
+            returncode = entry.process.poll()
+            if returncode is None:
+                continue
+            
+            with self.lock:
+                self.exiting.discard(entry)
+                current = self.entries.get(entry.key) is entry
+                restarting = current and entry.restart and not entry.stopping
+                if restarting:
+                    self._schedule_restart(entry, returncode)
+                elif current:
+                    del self.entries[entry.key]
+                else:
+                    # Replaced by a newer process under the same key
+                    continue
+            
+            if not entry.stopping:
+                logger.warning(f"Process {entry.key} exited with code {returncode}")
+            if entry.on_exit:
+                try:
+                    entry.on_exit(entry.key, returncode, restarting)
+                except Exception as e:
+                    logger.error(f"Exit handler for {entry.key} failed: {e}")
+    
+    def _schedule_restart(self, entry, returncode):
+        """Back off before restarting (lock held)"""
+        if time.monotonic() - entry.started_at >= PROCESS_RESTART['stable_after']:
+            entry.failures = 0
+        
+        delay = min(PROCESS_RESTART['initial_delay'] * (2 ** entry.failures), PROCESS_RESTART['max_delay'])
+        entry.failures += 1
+        entry.restart_at = time.monotonic() + delay
+        self.waiting.add(entry)
+        logger.info(f"Restarting process {entry.key} in {delay}s (exit code {returncode})")
+    
+    def _restart_due(self):
+        now = time.monotonic()
+        with self.lock:
+            due = [entry for entry in self.waiting if entry.restart_at <= now]
+            
+            for entry in due:
+                self.waiting.discard(entry)
+                try:
+                    self._spawn(entry)
+                    entry.restarts += 1
+                    process_restarts.inc((str(entry.key),))
+                except Exception as e:
+                    logger.error(f"Failed to restart process {entry.key}: {e}")
+                    self._schedule_restart(entry, None)
+
+# Global process supervisor instance
+process_supervisor = ProcessSupervisor()
@@ -0,0 +1,256 @@
+import json
+import math
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+from models import QoEStats, db
+from config import QOE_SETTINGS, QUALITY_PROFILES
+
+logger = logging.getLogger(__name__)
+
+# Beacon event types and how their value aggregates
+SKETCHED_EVENTS = ('startup', 'rebuffer')  # milliseconds, kept as quantile sketches
+SUMMED_EVENTS = {'play': 'play_time', 'dropped_frames': 'dropped_frames', 'switch': 'switches'}
+
+# Longest duration a beacon may report, in milliseconds
+MAX_VALUE = 24 * 3600 * 1000
+
+GAMMA = (1 + QOE_SETTINGS['relative_accuracy']) / (1 - QOE_SETTINGS['relative_accuracy'])
+LOG_GAMMA = math.log(GAMMA)
+
+class QuantileSketch:
+    """Mergeable quantile sketch with relative error (DDSketch).
+    
+    Values are counted in logarithmic bins, so any quantile is within
+    relative_accuracy of the true value, memory grows with the value
+    range rather than the count, and two sketches merge by adding bins.
+    """
+    
+    def __init__(self, bins=None, count=0, total=0.0):
+        self.bins = bins or {}
+        self.count = count
+        self.total = total
+    
+    def add(self, value):
+        index = math.ceil(math.log(max(value, 1.0)) / LOG_GAMMA)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+    
+    def merge(self, other):
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+    
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return round(2 * GAMMA ** index / (GAMMA + 1), 1)
+    
+    def to_dict(self):
+        return {'bins': self.bins, 'count': self.count, 'total': self.total}
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls({int(index): count for index, count in data['bins'].items()}, data['count'], data['total'])
+
+class QoEAggregate:
+    """Beacon totals of one stream and rendition"""
+    
+    def __init__(self):
+        self.beacons = 0
+        self.sketches = {event: QuantileSketch() for event in SKETCHED_EVENTS}
+        self.totals = dict.fromkeys(SUMMED_EVENTS.values(), 0.0)
+    
+    def add(self, event, value):
+        if event in self.sketches:
+            self.sketches[event].add(value)
+        else:
+            self.totals[SUMMED_EVENTS[event]] += 1 if event == 'switch' else value
+    
+    def merge(self, other):
+        self.beacons += other.beacons
+        for event, sketch in other.sketches.items():
+            self.sketches[event].merge(sketch)
+        for name, value in other.totals.items():
+            self.totals[name] += value
+    
+    def summary(self):
+        startup, rebuffer = self.sketches['startup'], self.sketches['rebuffer']
+        play_time = self.totals['play_time']
+        return {
+            'beacons': self.beacons,
+            'startup_time': {f'p{int(q * 100)}': startup.quantile(q) for q in (0.5, 0.9, 0.95, 0.99)},
+            'rebuffer': {
+                'count': rebuffer.count,
+                'duration': round(rebuffer.total, 1),
+                'p50': rebuffer.quantile(0.5),
+                'p95': rebuffer.quantile(0.95)
+            },
+            'rebuffer_ratio': round(rebuffer.total / (play_time + rebuffer.total), 5) if play_time else None,
+            'play_time': round(play_time, 1),
+            'switches': int(self.totals['switches']),
+            'dropped_frames': int(self.totals['dropped_frames'])
+        }
+
+class QoECollector:
+    """Aggregates player QoE beacons per stream and rendition.
+    
+    A beacon only updates in-memory aggregates (one for the stream and one
+    per rendition); a background flusher writes each flush_interval's
+    aggregates as QoEStats rows in one bulk insert, sketches included, so
+    percentiles over any range are merged from the rows.
+    """
+    
+    def __init__(self):
+        self.aggregates = {}
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.app = None
+        self.received = 0
+        self.rejected = 0
+    
+    def start(self, app):
+        """Start the background flusher (idempotent)"""
+        if self.flush_thread and self.flush_thread.is_alive():
+            return
+        with self.lock:
+            if self.flush_thread and self.flush_thread.is_alive():
+                return
+            
+            self.app = app
+            self.flush_thread = threading.Thread(target=self._flush_loop, name='qoe-flush')
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+    
+    def ingest(self, stream_id, beacon):
+        """Aggregate a beacon {'rendition', 'events': [{'type', 'value', 'rendition'}]}.
+        
+        Returns the number of events accepted; raises ValueError if the
+        beacon is malformed. Unknown or out-of-range events are skipped.
+        """
+        events = beacon.get('events') if isinstance(beacon, dict) else None
+        if not isinstance(events, list):
+            raise ValueError('A beacon needs an events list')
+        
+        parsed = []
+        for event in events[:QOE_SETTINGS['max_events']]:
+            if not isinstance(event, dict):
+                continue
+            kind = event.get('type')
+            if kind not in SKETCHED_EVENTS and kind not in SUMMED_EVENTS:
+                continue
+            try:
+                value = float(event.get('value', 0))
+            except (TypeError, ValueError):
+                continue
+            if not 0 <= value <= MAX_VALUE:
+                continue
+            
+            # Only known renditions get an aggregate of their own
+            rendition = event.get('rendition') or beacon.get('rendition')
+            parsed.append((kind, value, rendition if rendition in QUALITY_PROFILES else None))
+        
+        with self.lock:
+            self.received += 1
+            self.rejected += len(events) - len(parsed)
+            total = self._aggregate(stream_id, None)
+            total.beacons += 1
+            for kind, value, rendition in parsed:
+                total.add(kind, value)
+                if rendition:
+                    self._aggregate(stream_id, rendition).add(kind, value)
+        return len(parsed)
+    
+    def _aggregate(self, stream_id, rendition):
+        aggregate = self.aggregates.get((stream_id, rendition))
+        if aggregate is None:
+            aggregate = self.aggregates[(stream_id, rendition)] = QoEAggregate()
+        return aggregate
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(QOE_SETTINGS['flush_interval'])
+            self.flush()
+    
+    def flush(self):
+        """Write the aggregates since the last flush as QoEStats rows"""
+        with self.lock:
+            aggregates, self.aggregates = self.aggregates, {}
+        
+        now = datetime.utcnow()
+        rows = []
+        for (stream_id, rendition), aggregate in aggregates.items():
+            startup, rebuffer = aggregate.sketches['startup'], aggregate.sketches['rebuffer']
+            rows.append({
+                'stream_id': stream_id,
+                'rendition': rendition,
+                'timestamp': now,
+                'beacons': aggregate.beacons,
+                'startup_p50': startup.quantile(0.5),
+                'startup_p95': startup.quantile(0.95),
+                'rebuffer_count': rebuffer.count,
+                'rebuffer_duration': rebuffer.total,
+                'play_time': aggregate.totals['play_time'],
+                'switches': int(aggregate.totals['switches']),
+                'dropped_frames': int(aggregate.totals['dropped_frames']),
+                'sketches': json.dumps({event: sketch.to_dict() for event, sketch in aggregate.sketches.items()})
+            })
+        
+        try:
+            with self.app.app_context():
+                if rows:
+                    db.session.execute(db.insert(QoEStats), rows)
+                QoEStats.query.filter(
+                    QoEStats.timestamp < now - timedelta(seconds=QOE_SETTINGS['retention'])
+                ).delete(synchronize_session=False)
+                db.session.commit()
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error writing {len(rows)} QoE rows: {e}")
+            return 0
+    
+    def get_summary(self, stream_id, start, end=None):
+        """Percentiles and totals since start, for the stream and per rendition.
+        
+        Merges the sketches of the stored rows in range with the
+        aggregates not flushed yet.
+        """
+        query = QoEStats.query.filter(QoEStats.stream_id == stream_id, QoEStats.timestamp >= start)
+        if end:
+            query = query.filter(QoEStats.timestamp < end)
+        
+        merged = {}
+        for row in query.with_entities(QoEStats.rendition, QoEStats.beacons, QoEStats.play_time,
+                                       QoEStats.switches, QoEStats.dropped_frames, QoEStats.sketches):
+            aggregate = QoEAggregate()
+            aggregate.beacons = row.beacons
+            aggregate.totals = {'play_time': row.play_time, 'switches': row.switches,
+                                'dropped_frames': row.dropped_frames}
+            aggregate.sketches = {event: QuantileSketch.from_dict(sketch)
+                                  for event, sketch in json.loads(row.sketches).items()}
+            merged.setdefault(row.rendition, QoEAggregate()).merge(aggregate)
+        
+        if end is None:
+            with self.lock:
+                for (aggregate_stream, rendition), aggregate in self.aggregates.items():
+                    if aggregate_stream == stream_id:
+                        merged.setdefault(rendition, QoEAggregate()).merge(aggregate)
+        
+        total = merged.pop(None, QoEAggregate())
+        return dict(total.summary(), renditions={rendition: aggregate.summary()
+                                                 for rendition, aggregate in merged.items()})
+    
+    def get_stats(self):
+        with self.lock:
+            return {'received': self.received, 'rejected_events': self.rejected, 'pending': len(self.aggregates)}
+
+# Global QoE collector instance
+qoe_collector = QoECollector()
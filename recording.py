@@ -0,0 +1,247 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+import logging
+from datetime import datetime
+from dvr import parse_media_playlist
+from config import FFMPEG_PATH, RECORDING_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+class TrackRecorder:
+    """Appends the segments of one media playlist to a growing file"""
+    
+    def __init__(self, playlist_path, output_path):
+        self.playlist_path = playlist_path
+        self.directory = os.path.dirname(playlist_path)
+        self.output_path = output_path
+        self.output = None
+        self.mtime = None
+        self.last_sequence = None
+        self.segments = 0
+        self.duration = 0.0
+        self.bytes = 0
+        self.missed = 0
+        self.restarted = False
+    
+    def poll(self):
+        """Copy segments the muxer added since the last poll"""
+        try:
+            mtime = os.stat(self.playlist_path).st_mtime_ns
+            if mtime == self.mtime:
+                return
+            with open(self.playlist_path) as f:
+                sequence, map_uri, segments = parse_media_playlist(f.read())
+        except (OSError, ValueError):
+            return
+        self.mtime = mtime
+        
+        # A restarted muxer starts a new timeline (and init segment); the
+        # caller closes this file and starts the next part
+        if self.last_sequence is not None and sequence + len(segments) <= self.last_sequence:
+            self.restarted = True
+            return
+        
+        if self.output is None:
+            self.output = open(self.output_path, 'wb')
+            if map_uri:
+                self._append(map_uri)
+        
+        # Segments that left the live playlist between two polls are gone
+        if self.last_sequence is not None and sequence > self.last_sequence + 1:
+            missed = sequence - self.last_sequence - 1
+            self.missed += missed
+            logger.warning(f"Recording of {self.playlist_path} missed {missed} segment(s) "
+                           f"({self.last_sequence + 1}-{sequence - 1}) that left the playlist between polls")
+        
+        for offset, (duration, uri, _) in enumerate(segments):
+            if self.last_sequence is not None and sequence + offset <= self.last_sequence:
+                continue
+            if self._append(uri):
+                self.segments += 1
+                self.duration += duration
+            self.last_sequence = sequence + offset
+        self.output.flush()
+    
+    def _append(self, uri):
+        path = os.path.join(self.directory, uri)
+        try:
+            with open(path, 'rb') as segment:
+                shutil.copyfileobj(segment, self.output, RECORDING_SETTINGS['copy_buffer'])
+                self.bytes += segment.tell()
+            return True
+        except OSError as e:
+            logger.warning(f"Recording lost segment {path}: {e}")
+            return False
+    
+    def close(self):
+        if self.output:
+            self.output.close()
+            self.output = None
+
+class Recorder:
+    """Records streams from the segments the packager already writes.
+    
+    The top video rendition and, for CMAF packages, the shared audio are
+    followed through their media playlists; each new segment is copied
+    onto the end of a growing file (init segment first), so the recording
+    costs disk writes but no encoding or muxing while live. On stop the
+    tracks are remuxed with -c copy into one MP4. A muxer restart closes
+    the current part and starts the next one.
+    """
+    
+    def __init__(self):
+        self.recordings = {}
+        self.lock = threading.Lock()
+        self.thread = None
+    
+    def start(self, stream_id, recordings_dir, video_playlist, audio_playlist=None):
+        """Start recording a stream's packaged output"""
+        with self.lock:
+            if stream_id in self.recordings:
+                return
+            
+            recording = {
+                'recordings_dir': recordings_dir,
+                'playlists': [video_playlist] + ([audio_playlist] if audio_playlist else []),
+                'started_at': time.time(),
+                'parts': [],
+                'lock': threading.Lock()
+            }
+            self._open_part(stream_id, recording)
+            self.recordings[stream_id] = recording
+            
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._record_loop, name='recorder')
+                self.thread.daemon = True
+                self.thread.start()
+        
+        logger.info(f"Recording stream {stream_id} to {recording['parts'][0]['name']}")
+    
+    def _open_part(self, stream_id, recording):
+        name = f"stream_{stream_id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
+        if any(part['name'] == name for part in recording['parts']):
+            name += f"_{len(recording['parts'])}"
+        
+        base = os.path.join(recording['recordings_dir'], name)
+        kinds = ['video', 'audio'][:len(recording['playlists'])]
+        recording['parts'].append({
+            'name': name,
+            'path': f'{base}.mp4',
+            'tracks': [TrackRecorder(playlist, f'{base}.{kind}.part')
+                       for kind, playlist in zip(kinds, recording['playlists'])]
+        })
+    
+    def _record_loop(self):
+        while True:
+            with self.lock:
+                streams = list(self.recordings.items())
+            
+            for stream_id, recording in streams:
+                try:
+                    with recording['lock']:
+                        self._poll(stream_id, recording)
+                except Exception as e:
+                    logger.error(f"Error recording stream {stream_id}: {e}")
+            time.sleep(RECORDING_SETTINGS['poll_interval'])
+    
+    def _poll(self, stream_id, recording):
+        part = recording['parts'][-1]
+        for track in part['tracks']:
+            track.poll()
+        
+        if any(track.restarted for track in part['tracks']):
+            logger.warning(f"Encoder of stream {stream_id} restarted, starting a new recording part")
+            self._finish_in_background(stream_id, part)
+            self._open_part(stream_id, recording)
+    
+    def stop(self, stream_id):
+        """Pick up the final segments and finish the recording in the background"""
+        with self.lock:
+            recording = self.recordings.pop(stream_id, None)
+        if not recording:
+            return False
+        
+        with recording['lock']:
+            part = recording['parts'][-1]
+            for track in part['tracks']:
+                track.poll()
+        
+        self._finish_in_background(stream_id, part)
+        return True
+    
+    def _finish_in_background(self, stream_id, part):
+        thread = threading.Thread(target=self._finish_part, args=(stream_id, part), name='recording-remux')
+        thread.daemon = True
+        thread.start()
+    
+    def _finish_part(self, stream_id, part):
+        """Close a part's tracks and remux them into one MP4"""
+        for track in part['tracks']:
+            track.close()
+        
+        inputs = [track.output_path for track in part['tracks'] if track.segments]
+        if not inputs:
+            for track in part['tracks']:
+                self._discard(track.output_path)
+            return
+        
+        if RECORDING_SETTINGS['remux'] and self._remux(inputs, part['path']):
+            for track in part['tracks']:
+                self._discard(track.output_path)
+            logger.info(f"Recorded stream {stream_id} to {part['path']}")
+            return
+        
+        # Without a remux the growing files are the recording
+        for track in part['tracks']:
+            if track.segments:
+                os.replace(track.output_path, track.output_path[:-len('.part')] + '.mp4')
+        logger.info(f"Recorded stream {stream_id} to {part['name']}.*.mp4 without remuxing")
+    
+    def _remux(self, inputs, output_path):
+        cmd = [FFMPEG_PATH, '-y', '-loglevel', 'error']
+        for path in inputs:
+            cmd.extend(['-i', path])
+        for index in range(len(inputs)):
+            cmd.extend(['-map', str(index)])
+        cmd.extend(['-c', 'copy', '-movflags', '+faststart', output_path])
+        
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           timeout=RECORDING_SETTINGS['remux_timeout'], check=True)
+            return True
+        except Exception as e:
+            logger.error(f"Could not remux recording {output_path}: {e}")
+            self._discard(output_path)
+            return False
+    
+    def _discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    
+    def is_recording(self, stream_id):
+        return stream_id in self.recordings
+    
+    def get_status(self, stream_id):
+        """Current recording of a stream, or None"""
+        recording = self.recordings.get(stream_id)
+        if not recording:
+            return None
+        
+        parts = recording['parts']
+        return {
+            'started_at': datetime.utcfromtimestamp(recording['started_at']).isoformat(),
+            'files': [part['path'] for part in parts],
+            'segments': sum(part['tracks'][0].segments for part in parts),
+            'duration': round(sum(part['tracks'][0].duration for part in parts), 3),
+            'bytes': sum(track.bytes for part in parts for track in part['tracks']),
+            'missed_segments': sum(track.missed for part in parts for track in part['tracks']),
+            'tracks': len(recording['playlists'])
+        }
+
+# Global recorder instance
+recorder = Recorder()
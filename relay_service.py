@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import threading
+import logging
+from process_supervisor import process_supervisor
+from ffmpeg_log import ffmpeg_logs
+from rtmp_protocol import flv_header, flv_tag, MSG_AUDIO, MSG_VIDEO, MSG_DATA_AMF0
+from config import FFMPEG_PATH, RELAY_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+FLV_HEADER_SIZE = 13  # header + PreviousTagSize0
+FLV_TAG_HEADER_SIZE = 11
+
+def destination_key(destination):
+    """Stable id of a destination; any change to it makes a new relay"""
+    identity = f"{destination['rtmp_url']}|{destination['stream_key']}|{destination.get('quality', '720p')}"
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:12]
+
+class RelaySubscriber:
+    """One relay's stdin, resynchronised on keyframes"""
+    
+    def __init__(self, transport):
+        self.transport = transport
+        self.synced = False
+        self.offset = 0
+        self.last_timestamp = None
+    
+    def send(self, tag_type, timestamp, payload):
+        timestamp = max(0, timestamp + self.offset)
+        self.last_timestamp = timestamp
+        self.transport.write(flv_tag(tag_type, timestamp, payload))
+
+class FanoutPoint:
+    """One encoder rendition published as FLV over local TCP.
+    
+    Keeps the latest metadata and codec configuration so relays can join
+    at any time; each subscriber starts (or restarts after lagging) on a
+    video keyframe with timestamps rebased to stay monotonic.
+    """
+    
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.metadata = None
+        self.video_config = None
+        self.audio_config = None
+        self.subscribers = {}
+    
+    async def handle_publisher(self, reader, writer):
+        try:
+            await reader.readexactly(FLV_HEADER_SIZE)
+            self._resync_all()
+            while True:
+                header = await reader.readexactly(FLV_TAG_HEADER_SIZE)
+                size = int.from_bytes(header[1:4], 'big')
+                timestamp = int.from_bytes(header[4:7], 'big') | (header[7] << 24)
+                payload = await reader.readexactly(size)
+                await reader.readexactly(4)
+                self._dispatch(header[0] & 0x1F, timestamp, payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    
+    def _dispatch(self, tag_type, timestamp, payload):
+        keyframe = False
+        if tag_type == MSG_DATA_AMF0:
+            self.metadata = payload
+        elif tag_type == MSG_VIDEO and payload:
+            # AVC sequence header, otherwise a keyframe can start a relay
+            if payload[0] & 0x0F == 7 and len(payload) > 1 and payload[1] == 0:
+                self.video_config = payload
+            else:
+                keyframe = payload[0] >> 4 == 1
+        elif tag_type == MSG_AUDIO and payload:
+            # AAC sequence header
+            if payload[0] >> 4 == 10 and len(payload) > 1 and payload[1] == 0:
+                self.audio_config = payload
+        
+        for key, subscriber in list(self.subscribers.items()):
+            if subscriber.transport.is_closing():
+                del self.subscribers[key]
+                continue
+            
+            if subscriber.transport.get_write_buffer_size() > RELAY_SETTINGS['high_water']:
+                if subscriber.synced:
+                    logger.warning(f"Relay {key} is lagging, skipping to the next keyframe")
+                subscriber.synced = False
+                continue
+            
+            if not subscriber.synced:
+                if not keyframe:
+                    continue
+                self._sync(subscriber, timestamp)
+            
+            subscriber.send(tag_type, timestamp, payload)
+    
+    def _sync(self, subscriber, timestamp):
+        """Start a subscriber at a keyframe with a continuous timeline"""
+        if subscriber.last_timestamp is None:
+            subscriber.offset = -timestamp
+        else:
+            subscriber.offset = subscriber.last_timestamp + 1 - timestamp
+        
+        for tag_type, payload in ((MSG_DATA_AMF0, self.metadata), (MSG_VIDEO, self.video_config),
+                                  (MSG_AUDIO, self.audio_config)):
+            if payload:
+                subscriber.send(tag_type, timestamp, payload)
+        subscriber.synced = True
+    
+    def _resync_all(self):
+        # A new encoder connection restarts timestamps
+        for subscriber in self.subscribers.values():
+            subscriber.synced = False
+    
+    def attach(self, key, transport):
+        previous = self.subscribers.get(key)
+        if previous:
+            previous.transport.close()
+        transport.write(flv_header())
+        self.subscribers[key] = RelaySubscriber(transport)
+
+class RelayService:
+    """RTMP simulcast through per-destination stream-copy relays.
+    
+    The encoder publishes each needed rendition once to a local fan-out
+    point; every destination is a supervised `ffmpeg -c copy` relay fed
+    from it. Destinations can be added, removed or restarted without
+    touching the encoder, and a failing destination only restarts its own
+    relay. self.relays and self.fanouts are only touched under self.lock.
+    """
+    
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.RLock()
+        self.fanouts = {}
+        self.relays = {}
+    
+    def _ensure_loop(self):
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='relay-fanout')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def _run(self, coroutine, timeout=10):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout=timeout)
+    
+    def open_fanout(self, stream_id, resolution):
+        """Listen for a rendition of the encoder and return its output URL"""
+        self._ensure_loop()
+        
+        key = (stream_id, resolution)
+        with self.lock:
+            fanout = self.fanouts.get(key)
+            if fanout is None:
+                fanout = FanoutPoint()
+                fanout.server = self._run(asyncio.start_server(
+                    fanout.handle_publisher, RELAY_SETTINGS['host'], 0
+                ))
+                fanout.port = fanout.server.sockets[0].getsockname()[1]
+                self.fanouts[key] = fanout
+        
+        return f"tcp://{RELAY_SETTINGS['host']}:{fanout.port}"
+    
+    def fanout_resolutions(self, stream_id):
+        with self.lock:
+            return [resolution for (key_stream, resolution) in self.fanouts if key_stream == stream_id]
+    
+    def start_relay(self, stream_id, destination, resolution):
+        """Start a stream-copy relay from a fan-out point to a destination"""
+        with self.lock:
+            return self._start_relay(stream_id, destination, resolution)
+    
+    def _start_relay(self, stream_id, destination, resolution):
+        fanout = self.fanouts.get((stream_id, resolution))
+        if fanout is None:
+            logger.error(f"Stream {stream_id} has no {resolution} fan-out point")
+            return False
+        
+        dest_key = destination_key(destination)
+        relay_key = f"relay:{stream_id}:{dest_key}"
+        target = f"{destination['rtmp_url']}/{destination['stream_key']}"
+        cmd = [
+            FFMPEG_PATH, '-nostats', '-loglevel', 'level+warning',
+            '-f', 'flv', '-i', 'pipe:0',
+            '-map', '0', '-c', 'copy',
+            '-f', 'flv', target
+        ]
+        
+        def on_start(key, process):
+            asyncio.run_coroutine_threadsafe(self._attach(fanout, key, process.stdin), self.loop)
+        
+        # Relay output shares the stream's ring buffer and promotion budget
+        label = destination.get('name') or dest_key
+        
+        def on_output(key, source, line):
+            ffmpeg_logs.append(stream_id, f"relay {label}: {line}")
+        
+        try:
+            process_supervisor.start(relay_key, cmd, stdin=True, on_start=on_start,
+                                     on_output=on_output, restart=True)
+            self.relays[(stream_id, dest_key)] = {
+                'relay_key': relay_key,
+                'resolution': resolution,
+                'rtmp_url': destination['rtmp_url'],
+                'name': destination.get('name')
+            }
+            logger.info(f"Started relay {relay_key} ({resolution}) to {destination['rtmp_url']}")
+            return True
+        
+        except Exception as e:
+            logger.error(f"Error starting relay for stream {stream_id}: {e}")
+            return False
+    
+    async def _attach(self, fanout, key, pipe):
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.connect_write_pipe(asyncio.Protocol, pipe)
+        fanout.attach(key, transport)
+    
+    def stop_relay(self, stream_id, dest_key):
+        with self.lock:
+            relay = self.relays.pop((stream_id, dest_key), None)
+        if not relay:
+            return False
+        process_supervisor.stop(relay['relay_key'], timeout=5)
+        logger.info(f"Stopped relay {relay['relay_key']}")
+        return True
+    
+    def sync_destinations(self, stream_id, destinations, resolve_resolution):
+        """Start relays for new destinations and stop removed ones.
+        
+        resolve_resolution(quality) maps a destination quality to a fan-out
+        rendition. Unchanged destinations keep running untouched.
+        """
+        wanted = {destination_key(dest): dest for dest in destinations if dest.get('enabled', True)}
+        
+        # Held throughout so concurrent syncs cannot start the same relay twice
+        with self.lock:
+            running = {dest_key for (relay_stream, dest_key) in self.relays if relay_stream == stream_id}
+            
+            for dest_key in running - set(wanted):
+                self.stop_relay(stream_id, dest_key)
+            
+            success = True
+            for dest_key in set(wanted) - running:
+                destination = wanted[dest_key]
+                resolution = resolve_resolution(destination.get('quality', '720p'))
+                success = self._start_relay(stream_id, destination, resolution) and success
+            return success
+    
+    def close_stream(self, stream_id):
+        """Stop every relay and fan-out point of a stream"""
+        with self.lock:
+            dest_keys = [dest_key for (relay_stream, dest_key) in self.relays if relay_stream == stream_id]
+            fanouts = [self.fanouts.pop(key) for key in [key for key in self.fanouts if key[0] == stream_id]]
+        
+        for dest_key in dest_keys:
+            self.stop_relay(stream_id, dest_key)
+        for fanout in fanouts:
+            self.loop.call_soon_threadsafe(fanout.server.close)
+    
+    def get_relays(self, stream_id):
+        """Status of a stream's relays"""
+        relays = []
+        with self.lock:
+            entries = list(self.relays.items())
+        for (relay_stream, dest_key), relay in entries:
+            if relay_stream != stream_id:
+                continue
+            info = process_supervisor.get_info(relay['relay_key']) or {}
+            relays.append({
+                'destination': dest_key,
+                'name': relay['name'],
+                'rtmp_url': relay['rtmp_url'],
+                'resolution': relay['resolution'],
+                'running': info.get('running', False),
+                'restarts': info.get('restarts', 0)
+            })
+        return relays
+
+# Global relay service instance
+relay_service = RelayService()
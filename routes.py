@@ -1,9 +1,26 @@
-from flask import render_template, request, jsonify, redirect, url_for, flash
+from flask import render_template, request, jsonify, redirect, url_for, flash, g, Response
 from app import app, db
 from models import Stream, StreamOutput, StreamStats, StreamDestination
 from stream_manager import stream_manager
-from config import QUALITY_PROFILES, PLATFORM_ENDPOINTS
+from relay_service import relay_service
+from admission_control import admission_controller
+from cluster import coordinator, authorized, outputs_within
+from media_origin import media_origin, viewer_session
+from segment_storage import segment_storage
+from dvr import dvr_service
+from recording import recorder
+from clip_export import clip_exporter
+from event_bus import event_bus
+from viewer_analytics import viewer_analytics
+from qoe import qoe_collector
+from stats_collector import stats_collector
+from metrics import metrics, request_latency
+from ffmpeg_log import ffmpeg_logs
+from stream_registry import stream_registry
+from config import QUALITY_PROFILES, PLATFORM_ENDPOINTS, CLUSTER_SETTINGS
 import logging
+import time
+from datetime import datetime, timedelta, timezone
 
 logger = logging.getLogger(__name__)
 
@@ -44,8 +61,13 @@ def save_stream():
         input_type = request.form.get('input_type')
         latency_mode = request.form.get('latency_mode', 'low')
         record_enabled = request.form.get('record_enabled') == 'on'
+        dvr_window = request.form.get('dvr_window', 0, type=int) * 60
         qualities = request.form.getlist('qualities')
         
+        if dvr_window < 0:
+            flash('DVR window cannot be negative', 'error')
+            return redirect(url_for('dashboard'))
+        
         if stream_id:
             # Update existing stream
             stream = Stream.query.get(stream_id)
@@ -55,6 +77,7 @@ def save_stream():
                 stream.input_type = input_type
                 stream.latency_mode = latency_mode
                 stream.record_enabled = record_enabled
+                stream.dvr_window = dvr_window
                 db.session.commit()
                 flash('Stream updated successfully', 'success')
         else:
@@ -65,6 +88,7 @@ def save_stream():
                 input_type=input_type,
                 latency_mode=latency_mode,
                 record_enabled=record_enabled,
+                dvr_window=dvr_window,
                 qualities=qualities
             )
             if stream:
@@ -84,7 +108,9 @@ def start_stream(stream_id):
     """Start a stream"""
     try:
         success = stream_manager.start_stream(stream_id)
-        if success:
+        if success and (admission_controller.is_queued(stream_id) or coordinator.is_pending(stream_id)):
+            return jsonify({'status': 'queued', 'message': 'Stream queued until encoder capacity is free'})
+        elif success:
             return jsonify({'status': 'success', 'message': 'Stream started'})
         else:
             return jsonify({'status': 'error', 'message': 'Failed to start stream'})
@@ -92,6 +118,150 @@ def start_stream(stream_id):
         logger.error(f"Error starting stream {stream_id}: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/admission/status')
+def admission_status():
+    """Encoder placements, queue and remaining CPU headroom"""
+    try:
+        return jsonify(admission_controller.get_status())
+    except Exception as e:
+        logger.error(f"Error getting admission status: {e}")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route('/static/streams/<path:filename>')
+def stream_media(filename):
+    """Stream segments and manifests from MEDIA_ROOT"""
+    return media_origin.serve(app.config['MEDIA_ROOT'], filename)
+
+@app.route('/storage/status')
+def storage_status():
+    """Live segment storage usage and pruning"""
+    return jsonify(segment_storage.get_status())
+
+@app.route('/origin/stats')
+def origin_stats():
+    """Media origin cache statistics"""
+    return jsonify(media_origin.get_stats())
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def observe_request_latency(response):
+    # Streamed bodies (SSE, clips) are timed up to their first byte
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        request_latency.observe(time.perf_counter() - started, (route, request.method, str(response.status_code)))
+    return response
+
+def _collect_metrics():
+    """Scrape-time values of the encoders, viewers and media origin"""
+    from ffmpeg_service import ffmpeg_service
+    
+    encoder = {'frame_rate': [], 'speed': [], 'bitrate': []}
+    for stream_id in list(stats_collector.samples):
+        sample = stats_collector.latest(stream_id)
+        if sample:
+            for field, samples in encoder.items():
+                samples.append(({'stream': stream_id}, sample[field]))
+    
+    origin = media_origin.get_stats()
+    lookups = origin['hits'] + origin['misses'] + origin['coalesced']
+    return [
+        ('stropen_streams_running', 'gauge', 'Streams encoding on this host',
+         [({}, len(ffmpeg_service.active_streams))]),
+        ('stropen_encoder_fps', 'gauge', 'Encoder frames per second', encoder['frame_rate']),
+        ('stropen_encoder_speed', 'gauge', 'Encoder speed relative to real time', encoder['speed']),
+        ('stropen_encoder_bitrate_kbps', 'gauge', 'Encoder output bitrate', encoder['bitrate']),
+        ('stropen_stream_viewers', 'gauge', 'Concurrent viewers from media requests',
+         [({'stream': stream_id}, viewer_analytics.concurrent(stream_id)) for stream_id in list(viewer_analytics.streams)]),
+        ('stropen_origin_cache_hits_total', 'counter', 'Media origin cache hits', [({}, origin['hits'])]),
+        ('stropen_origin_cache_misses_total', 'counter', 'Media origin cache misses', [({}, origin['misses'])]),
+        ('stropen_origin_cache_coalesced_total', 'counter', 'Media origin misses served by another request\'s read',
+         [({}, origin['coalesced'])]),
+        ('stropen_origin_cache_hit_ratio', 'gauge', 'Share of cached origin lookups served from memory',
+         [({}, round(origin['hits'] / lookups, 4) if lookups else 0)]),
+        ('stropen_origin_cache_bytes', 'gauge', 'Bytes held by the media origin cache', [({}, origin['bytes'])])
+    ]
+
+metrics.register_collector(_collect_metrics)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def _cluster_node(mode):
+    """Whether this process runs in a cluster mode and the caller is a peer"""
+    return CLUSTER_SETTINGS['mode'] == mode and authorized(request.headers)
+
+@app.route('/cluster/heartbeat', methods=['POST'])
+def cluster_heartbeat():
+    """Heartbeat from an encoder worker"""
+    if not _cluster_node('coordinator'):
+        return jsonify({'status': 'error', 'message': 'Not a coordinator'}), 404
+    
+    try:
+        stream_manager.start_coordinator()
+        stop = coordinator.heartbeat(request.get_json())
+        return jsonify({'status': 'success', 'stop': stop})
+    except Exception as e:
+        logger.error(f"Error handling worker heartbeat: {e}")
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+
+@app.route('/cluster/status')
+def cluster_status():
+    """Workers and stream assignments"""
+    return jsonify(dict(coordinator.get_status(), mode=CLUSTER_SETTINGS['mode']))
+
+@app.route('/worker/streams/<int:stream_id>/start', methods=['POST'])
+def worker_start_stream(stream_id):
+    """Start an encoder assigned by the coordinator"""
+    if not _cluster_node('worker'):
+        return jsonify({'status': 'error', 'message': 'Not a worker'}), 404
+    
+    try:
+        from ffmpeg_service import ffmpeg_service
+        if stream_id in ffmpeg_service.active_streams:
+            action = 'start'
+        else:
+            payload = request.get_json()
+            if not outputs_within(payload['output_configs'], app.config['MEDIA_ROOT']):
+                logger.warning(f"Refusing stream {stream_id}: outputs outside MEDIA_ROOT")
+                return jsonify({'action': 'failed', 'message': 'Output paths must be under MEDIA_ROOT'}), 400
+            action = stream_manager.launch_encoder(
+                stream_id,
+                payload['input_url'],
+                payload['output_configs'],
+                payload['destinations'],
+                payload['probe_key'],
+                queueable=False
+            )
+        placement = admission_controller.placement(stream_id) or {}
+        return jsonify({'action': action, 'cost': placement.get('cost', 0)})
+    except Exception as e:
+        logger.error(f"Error starting assigned stream {stream_id}: {e}")
+        return jsonify({'action': 'failed', 'message': str(e)}), 500
+
+@app.route('/worker/streams/<int:stream_id>/stop', methods=['POST'])
+def worker_stop_stream(stream_id):
+    """Stop an encoder the coordinator released"""
+    if not _cluster_node('worker'):
+        return jsonify({'status': 'error', 'message': 'Not a worker'}), 404
+    
+    success = stream_manager.stop_encoder(stream_id)
+    return jsonify({'status': 'success' if success else 'error'})
+
+@app.route('/worker/streams/<int:stream_id>/destinations', methods=['POST'])
+def worker_stream_destinations(stream_id):
+    """Swap the relays of an encoder on this worker"""
+    if not _cluster_node('worker'):
+        return jsonify({'status': 'error', 'message': 'Not a worker'}), 404
+    
+    result = stream_manager.sync_encoder_destinations(stream_id, request.get_json()['destinations'])
+    return jsonify({'status': 'success', 'result': result})
+
 @app.route('/stream/<int:stream_id>/stop', methods=['POST'])
 def stop_stream(stream_id):
     """Stop a stream"""
@@ -105,35 +275,281 @@ def stop_stream(stream_id):
         logger.error(f"Error stopping stream {stream_id}: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
 
+def _stream_status(stream):
+    from ffmpeg_service import ffmpeg_service
+    
+    return {
+        'id': stream.id,
+        'name': stream.name,
+        'status': stream.status,
+        'ffmpeg_status': ffmpeg_service.get_stream_status(stream.id),
+        'relays': relay_service.get_relays(stream.id),
+        'worker_id': stream.worker_id,
+        'recording': recorder.get_status(stream.id),
+        # Master playlist for previews; its path depends on the packaging
+        'hls_url': stream_manager.manifest_urls(stream)[0],
+        'updated_at': stream.updated_at.isoformat()
+    }
+
 @app.route('/stream/<int:stream_id>/status')
 def stream_status(stream_id):
     """Get stream status"""
     try:
-        stream = Stream.query.get_or_404(stream_id)
-        from ffmpeg_service import ffmpeg_service
-        ffmpeg_status = ffmpeg_service.get_stream_status(stream_id)
-        
-        return jsonify({
-            'id': stream.id,
-            'name': stream.name,
-            'status': stream.status,
-            'ffmpeg_status': ffmpeg_status,
-            'updated_at': stream.updated_at.isoformat()
-        })
+        stream = stream_registry.get(stream_id)
+        if not stream:
+            return jsonify({'status': 'error', 'message': 'Stream not found'}), 404
+        return jsonify(_stream_status(stream))
     except Exception as e:
         logger.error(f"Error getting stream status {stream_id}: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
 
+def _parse_ids(value):
+    """Stream ids from a comma-separated list, or None when absent"""
+    if not value:
+        return None
+    return {int(stream_id) for stream_id in value.split(',') if stream_id.strip()}
+
+@app.route('/streams/status')
+def streams_status():
+    """Status of ?ids=1,2,3 (or every stream)"""
+    try:
+        ids = _parse_ids(request.args.get('ids'))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'ids must be comma-separated integers'}), 400
+    
+    try:
+        if ids is None:
+            streams = stream_registry.all()
+        else:
+            streams = filter(None, (stream_registry.get(stream_id) for stream_id in ids))
+        return jsonify({'streams': {stream.id: _stream_status(stream) for stream in streams}})
+    except Exception as e:
+        logger.error(f"Error getting stream statuses: {e}")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route('/events')
+def events():
+    """Server-Sent Events feed of status changes and stats deltas.
+    
+    ?streams=1,2,3 limits the feed to those streams. Events are 'status'
+    ({stream_id, status, ...}) and 'stats' (the stats fields that changed).
+    """
+    try:
+        stream_ids = _parse_ids(request.args.get('streams'))
+        last_event_id = request.headers.get('Last-Event-ID', type=int)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'streams must be comma-separated integers'}), 400
+    
+    response = app.response_class(event_bus.subscribe(stream_ids, last_event_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Keep reverse proxies from buffering the feed
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def _parse_utc(value):
+    """Parse an ISO 8601 time into a naive UTC datetime"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
 @app.route('/stream/<int:stream_id>/stats')
 def stream_stats(stream_id):
-    """Get stream statistics"""
+    """Get stream statistics.
+    
+    With ?start=&end= (ISO 8601 UTC, end defaults to now) or ?window=<seconds>
+    the range is served at a resolution picked for its length.
+    """
     try:
+        start = request.args.get('start')
+        window = request.args.get('window', type=int)
+        if start or window:
+            try:
+                end = request.args.get('end')
+                end = _parse_utc(end) if end else datetime.utcnow()
+                start = _parse_utc(start) if start else end - timedelta(seconds=window)
+            except ValueError:
+                return jsonify({'status': 'error', 'message': 'Invalid start/end time'}), 400
+            
+            resolution, stats = stream_manager.get_stream_stats_range(stream_id, start, end)
+            return jsonify({'stats': stats, 'resolution': resolution})
+        
         stats = stream_manager.get_stream_stats(stream_id)
         return jsonify({'stats': stats})
     except Exception as e:
         logger.error(f"Error getting stream stats {stream_id}: {e}")
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/stream/<int:stream_id>/logs')
+def stream_logs(stream_id):
+    """Recent ffmpeg output of a stream, ?level=warning to filter, ?limit=N"""
+    level = logging.getLevelName(request.args.get('level', 'debug').upper())
+    if not isinstance(level, int):
+        return jsonify({'status': 'error', 'message': 'level must be debug, info, warning or error'}), 400
+    
+    lines = ffmpeg_logs.get_lines(stream_id, level, request.args.get('limit', type=int))
+    if lines is None:
+        return jsonify({'status': 'error', 'message': 'No ffmpeg output for this stream'}), 404
+    return jsonify({'lines': lines, 'counts': ffmpeg_logs.get_counts(stream_id)})
+
+@app.route('/stream/<int:stream_id>/viewers')
+def stream_viewers(stream_id):
+    """Concurrent viewers, their renditions and egress of a stream"""
+    return jsonify(viewer_analytics.get_stats(stream_id))
+
+@app.route('/stream/<int:stream_id>/qoe', methods=['POST'])
+def qoe_beacon(stream_id):
+    """Batch of player QoE events; aggregated in memory, stored periodically"""
+    if not stream_registry.get(stream_id):
+        return jsonify({'status': 'error', 'message': 'Stream not found'}), 404
+    
+    # sendBeacon posts without a JSON content type
+    beacon = request.get_json(force=True, silent=True)
+    try:
+        qoe_collector.ingest(stream_id, beacon)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    
+    qoe_collector.start(app)
+    return '', 204
+
+@app.route('/stream/<int:stream_id>/qoe')
+def qoe_summary(stream_id):
+    """Player QoE percentiles over ?start=&end= (ISO 8601 UTC) or the last ?window=<seconds>"""
+    try:
+        end = request.args.get('end')
+        end = _parse_utc(end) if end else None
+        start = request.args.get('start')
+        window = request.args.get('window', 3600, type=int)
+        start = _parse_utc(start) if start else (end or datetime.utcnow()) - timedelta(seconds=window)
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid start/end time'}), 400
+    
+    try:
+        return jsonify(qoe_collector.get_summary(stream_id, start, end))
+    except Exception as e:
+        logger.error(f"Error getting QoE of stream {stream_id}: {e}")
+        return jsonify({'status': 'error', 'message': str(e)})
+
+@app.route('/qoe/stats')
+def qoe_stats():
+    """QoE beacon counters"""
+    return jsonify(qoe_collector.get_stats())
+
+@app.route('/stream/<int:stream_id>/ll/<int:representation>.m3u8')
+def ll_hls_playlist(stream_id, representation):
+    """LL-HLS media playlist with _HLS_msn/_HLS_part blocking reload"""
+    from llhls import ll_hls_service
+    
+    msn = request.args.get('_HLS_msn', type=int)
+    part = request.args.get('_HLS_part', type=int)
+    if part is not None and msn is None:
+        return "_HLS_part requires _HLS_msn", 400
+    
+    status, playlist = ll_hls_service.get_playlist(stream_id, representation, msn, part)
+    if status != 200:
+        return "", status
+    
+    # LL-HLS is served here rather than by the media origin, so count viewers here too
+    viewer_analytics.record_stream(stream_id, str(representation), viewer_session(), len(playlist))
+    response = app.response_class(playlist, mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/stream/<int:stream_id>/ll/<int:representation>/<int:msn>.<int:part>.m4s')
+def ll_hls_part(stream_id, representation, msn, part):
+    """LL-HLS partial segment, held until a preload-hinted part is complete"""
+    from llhls import ll_hls_service
+    
+    data = ll_hls_service.get_part(stream_id, representation, msn, part)
+    if data is None:
+        return "", 404
+    
+    viewer_analytics.record_stream(stream_id, str(representation), viewer_session(), len(data))
+    response = app.response_class(data, mimetype='video/iso.segment')
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response
+
+def _parse_dvr_time(value):
+    """Unix time from epoch seconds or an ISO 8601 UTC time"""
+    try:
+        return float(value)
+    except ValueError:
+        return (_parse_utc(value) - datetime(1970, 1, 1)).total_seconds()
+
+@app.route('/stream/<int:stream_id>/dvr.m3u8')
+def dvr_master_playlist(stream_id):
+    """DVR master playlist; ?start=&end= are passed on to the media playlists"""
+    query = request.query_string.decode()
+    playlist = dvr_service.get_master_playlist(stream_id, f'/stream/{stream_id}/dvr',
+                                               f'?{query}' if query else '')
+    if playlist is None:
+        return "", 404
+    
+    response = app.response_class(playlist, mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/stream/<int:stream_id>/dvr/<int:rendition>.m3u8')
+def dvr_playlist(stream_id, rendition):
+    """DVR media playlist.
+    
+    Without parameters this is the whole DVR window, sliding with the live
+    edge. ?start= (and optionally ?end=), as epoch seconds or ISO 8601 UTC,
+    select a range: an EVENT playlist while it reaches the live edge, a VOD
+    playlist once it has passed.
+    """
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = _parse_dvr_time(start) if start else None
+        end = _parse_dvr_time(end) if end else None
+    except ValueError:
+        return "Invalid start/end time", 400
+    
+    status, playlist = dvr_service.get_playlist(stream_id, rendition, start, end)
+    if status != 200:
+        return "", status
+    
+    response = app.response_class(playlist, mimetype='application/vnd.apple.mpegurl')
+    # A closed range never changes; live ones change every segment
+    if end is not None and '#EXT-X-ENDLIST' in playlist:
+        response.headers['Cache-Control'] = 'public, max-age=3600'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/stream/<int:stream_id>/dvr/status')
+def dvr_status(stream_id):
+    """Indexed DVR range per rendition"""
+    status = dvr_service.get_status(stream_id)
+    if status is None:
+        return jsonify({'status': 'error', 'message': 'DVR is not enabled for this stream'}), 404
+    return jsonify(status)
+
+@app.route('/stream/<int:stream_id>/clip.mp4')
+def export_clip(stream_id):
+    """Download ?start=&end= (epoch seconds or ISO 8601 UTC) of the DVR buffer as MP4"""
+    try:
+        start = _parse_dvr_time(request.args['start'])
+        end = _parse_dvr_time(request.args['end'])
+    except (KeyError, ValueError):
+        return jsonify({'status': 'error', 'message': 'start and end times are required'}), 400
+    
+    status, body = stream_manager.export_clip(stream_id, start, end)
+    if status != 200:
+        return jsonify({'status': 'error', 'message': body}), status
+    
+    # Chunks are sent as ffmpeg writes them; the clip is never held in memory
+    response = app.response_class(body, mimetype='video/mp4')
+    response.headers['Content-Disposition'] = f'attachment; filename="stream_{stream_id}_{int(start)}.mp4"'
+    return response
+
+@app.route('/clips/stats')
+def clip_stats():
+    """Clip export workers and counters"""
+    return jsonify(clip_exporter.get_stats())
+
 @app.route('/stream/<int:stream_id>/destinations', methods=['POST'])
 def update_destinations(stream_id):
     """Update stream destinations"""
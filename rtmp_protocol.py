@@ -0,0 +1,260 @@
+import os
+import struct
+import time
+
+# RTMP message type ids
+MSG_SET_CHUNK_SIZE = 1
+MSG_ABORT = 2
+MSG_ACKNOWLEDGEMENT = 3
+MSG_USER_CONTROL = 4
+MSG_WINDOW_ACK_SIZE = 5
+MSG_SET_PEER_BANDWIDTH = 6
+MSG_AUDIO = 8
+MSG_VIDEO = 9
+MSG_DATA_AMF3 = 15
+MSG_COMMAND_AMF3 = 17
+MSG_DATA_AMF0 = 18
+MSG_COMMAND_AMF0 = 20
+
+HANDSHAKE_SIZE = 1536
+DEFAULT_CHUNK_SIZE = 128
+EXTENDED_TIMESTAMP = 0xFFFFFF
+
+# AMF0 type markers
+AMF0_NUMBER = 0x00
+AMF0_BOOLEAN = 0x01
+AMF0_STRING = 0x02
+AMF0_OBJECT = 0x03
+AMF0_NULL = 0x05
+AMF0_UNDEFINED = 0x06
+AMF0_ECMA_ARRAY = 0x08
+AMF0_OBJECT_END = 0x09
+AMF0_STRICT_ARRAY = 0x0A
+AMF0_DATE = 0x0B
+AMF0_LONG_STRING = 0x0C
+
+class RTMPProtocolError(Exception):
+    pass
+
+def amf0_decode(data):
+    """Decode every AMF0 value in data into a list"""
+    values = []
+    offset = 0
+    while offset < len(data):
+        value, offset = _amf0_decode_value(data, offset)
+        values.append(value)
+    return values
+
+def _amf0_decode_value(data, offset):
+    marker = data[offset]
+    offset += 1
+    
+    if marker == AMF0_NUMBER:
+        return struct.unpack_from('>d', data, offset)[0], offset + 8
+    if marker == AMF0_BOOLEAN:
+        return data[offset] != 0, offset + 1
+    if marker == AMF0_STRING:
+        return _amf0_decode_string(data, offset)
+    if marker == AMF0_LONG_STRING:
+        length = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+        return data[offset:offset + length].decode('utf-8', 'replace'), offset + length
+    if marker in (AMF0_NULL, AMF0_UNDEFINED):
+        return None, offset
+    if marker == AMF0_OBJECT:
+        return _amf0_decode_properties(data, offset)
+    if marker == AMF0_ECMA_ARRAY:
+        return _amf0_decode_properties(data, offset + 4)
+    if marker == AMF0_STRICT_ARRAY:
+        count = struct.unpack_from('>I', data, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = _amf0_decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if marker == AMF0_DATE:
+        return struct.unpack_from('>d', data, offset)[0], offset + 10
+    
+    raise RTMPProtocolError(f"Unsupported AMF0 marker {marker:#x}")
+
+def _amf0_decode_string(data, offset):
+    length = struct.unpack_from('>H', data, offset)[0]
+    offset += 2
+    return data[offset:offset + length].decode('utf-8', 'replace'), offset + length
+
+def _amf0_decode_properties(data, offset):
+    properties = {}
+    while True:
+        key, offset = _amf0_decode_string(data, offset)
+        if not key and data[offset] == AMF0_OBJECT_END:
+            return properties, offset + 1
+        properties[key], offset = _amf0_decode_value(data, offset)
+
+def amf0_encode(*values):
+    """Encode values as consecutive AMF0 items"""
+    return b''.join(_amf0_encode_value(value) for value in values)
+
+def _amf0_encode_value(value):
+    if value is None:
+        return bytes([AMF0_NULL])
+    if isinstance(value, bool):
+        return bytes([AMF0_BOOLEAN, 1 if value else 0])
+    if isinstance(value, (int, float)):
+        return bytes([AMF0_NUMBER]) + struct.pack('>d', value)
+    if isinstance(value, str):
+        encoded = value.encode('utf-8')
+        return bytes([AMF0_STRING]) + struct.pack('>H', len(encoded)) + encoded
+    if isinstance(value, dict):
+        body = b''
+        for key, item in value.items():
+            encoded = key.encode('utf-8')
+            body += struct.pack('>H', len(encoded)) + encoded + _amf0_encode_value(item)
+        return bytes([AMF0_OBJECT]) + body + b'\x00\x00' + bytes([AMF0_OBJECT_END])
+    raise RTMPProtocolError(f"Cannot encode {type(value).__name__} as AMF0")
+
+async def server_handshake(reader, writer):
+    """Perform the plain (non-digest) RTMP handshake as the server"""
+    c0c1 = await reader.readexactly(1 + HANDSHAKE_SIZE)
+    if c0c1[0] != 3:
+        raise RTMPProtocolError(f"Unsupported RTMP version {c0c1[0]}")
+    
+    s1 = struct.pack('>II', int(time.time()) & 0xFFFFFFFF, 0) + os.urandom(HANDSHAKE_SIZE - 8)
+    writer.write(b'\x03' + s1 + c0c1[1:])
+    await writer.drain()
+    
+    await reader.readexactly(HANDSHAKE_SIZE)
+
+class ChunkReader:
+    """Reassembles RTMP messages from an interleaved chunk stream"""
+    
+    def __init__(self, reader):
+        self.reader = reader
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+        self.streams = {}
+        self.bytes_read = 0
+    
+    async def _read(self, size):
+        data = await self.reader.readexactly(size)
+        self.bytes_read += size
+        return data
+    
+    async def read_message(self):
+        """Return the next complete (type_id, stream_id, timestamp, payload)"""
+        while True:
+            first = (await self._read(1))[0]
+            fmt = first >> 6
+            csid = first & 0x3F
+            if csid == 0:
+                csid = 64 + (await self._read(1))[0]
+            elif csid == 1:
+                extra = await self._read(2)
+                csid = 64 + extra[0] + extra[1] * 256
+            
+            state = self.streams.get(csid)
+            if state is None:
+                if fmt != 0:
+                    raise RTMPProtocolError(f"Chunk stream {csid} started without a type 0 header")
+                state = self.streams[csid] = {
+                    'timestamp': 0, 'delta': 0, 'length': 0, 'type_id': 0,
+                    'stream_id': 0, 'extended': False, 'payload': None
+                }
+            
+            if fmt <= 2:
+                header = await self._read((11, 7, 3)[fmt])
+                stamp = int.from_bytes(header[0:3], 'big')
+                if fmt <= 1:
+                    state['length'] = int.from_bytes(header[3:6], 'big')
+                    state['type_id'] = header[6]
+                if fmt == 0:
+                    state['stream_id'] = struct.unpack_from('<I', header, 7)[0]
+                
+                state['extended'] = stamp == EXTENDED_TIMESTAMP
+                if state['extended']:
+                    stamp = struct.unpack('>I', await self._read(4))[0]
+                
+                if fmt == 0:
+                    state['timestamp'] = stamp
+                    state['delta'] = 0
+                else:
+                    state['delta'] = stamp
+                    state['timestamp'] += stamp
+            else:
+                if state['extended']:
+                    await self._read(4)
+                if state['payload'] is None:
+                    # A type 3 chunk starting a new message repeats the delta
+                    state['timestamp'] += state['delta']
+            
+            if state['payload'] is None:
+                state['payload'] = bytearray()
+            
+            remaining = state['length'] - len(state['payload'])
+            state['payload'] += await self._read(min(self.chunk_size, remaining))
+            
+            if len(state['payload']) >= state['length']:
+                payload = bytes(state['payload'])
+                state['payload'] = None
+                return state['type_id'], state['stream_id'], state['timestamp'] & 0xFFFFFFFF, payload
+    
+    def abort(self, csid):
+        """Discard a partially received message (Abort Message)"""
+        if csid in self.streams:
+            self.streams[csid]['payload'] = None
+
+class ChunkWriter:
+    """Splits outgoing messages into type 0 / type 3 chunks"""
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.chunk_size = DEFAULT_CHUNK_SIZE
+    
+    def write_message(self, csid, type_id, stream_id, payload, timestamp=0):
+        extended = timestamp >= EXTENDED_TIMESTAMP
+        stamp = EXTENDED_TIMESTAMP if extended else timestamp
+        
+        header = bytes([csid & 0x3F])
+        header += stamp.to_bytes(3, 'big') + len(payload).to_bytes(3, 'big') + bytes([type_id])
+        header += struct.pack('<I', stream_id)
+        if extended:
+            header += struct.pack('>I', timestamp)
+        
+        continuation = bytes([0xC0 | (csid & 0x3F)])
+        if extended:
+            continuation += struct.pack('>I', timestamp)
+        
+        chunks = [header + payload[:self.chunk_size]]
+        for offset in range(self.chunk_size, len(payload), self.chunk_size):
+            chunks.append(continuation + payload[offset:offset + self.chunk_size])
+        self.writer.write(b''.join(chunks))
+    
+    def set_chunk_size(self, size):
+        self.write_message(2, MSG_SET_CHUNK_SIZE, 0, struct.pack('>I', size))
+        self.chunk_size = size
+    
+    def window_ack_size(self, size):
+        self.write_message(2, MSG_WINDOW_ACK_SIZE, 0, struct.pack('>I', size))
+    
+    def set_peer_bandwidth(self, size, limit_type=2):
+        self.write_message(2, MSG_SET_PEER_BANDWIDTH, 0, struct.pack('>IB', size, limit_type))
+    
+    def acknowledgement(self, sequence):
+        self.write_message(2, MSG_ACKNOWLEDGEMENT, 0, struct.pack('>I', sequence & 0xFFFFFFFF))
+    
+    def stream_begin(self, stream_id):
+        self.write_message(2, MSG_USER_CONTROL, 0, struct.pack('>HI', 0, stream_id))
+    
+    def command(self, stream_id, *values):
+        csid = 5 if stream_id else 3
+        self.write_message(csid, MSG_COMMAND_AMF0, stream_id, amf0_encode(*values))
+
+def flv_header():
+    """FLV file header (audio + video) followed by PreviousTagSize0"""
+    return b'FLV\x01\x05\x00\x00\x00\x09' + b'\x00\x00\x00\x00'
+
+def flv_tag(tag_type, timestamp, payload):
+    """Wrap one RTMP media/data message as an FLV tag"""
+    header = bytes([tag_type]) + len(payload).to_bytes(3, 'big')
+    header += (timestamp & 0xFFFFFF).to_bytes(3, 'big') + bytes([(timestamp >> 24) & 0xFF])
+    header += b'\x00\x00\x00'
+    return header + payload + struct.pack('>I', 11 + len(payload))
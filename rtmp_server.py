@@ -1,40 +1,337 @@
+import asyncio
 import threading
-import subprocess
 import logging
-import os
-import signal
 from datetime import datetime
 from models import Stream, db
 from stream_manager import stream_manager
+from stream_registry import stream_registry
+from ffmpeg_service import ffmpeg_service, PIPE_INPUT
+from encoder_pool import encoder_pool
+from media_probe import media_probe, same_input, FlvProbe
+from rtmp_protocol import (ChunkReader, ChunkWriter, RTMPProtocolError, server_handshake, amf0_decode,
+                           flv_header, flv_tag, MSG_SET_CHUNK_SIZE, MSG_ABORT, MSG_ACKNOWLEDGEMENT,
+                           MSG_WINDOW_ACK_SIZE, MSG_AUDIO, MSG_VIDEO, MSG_DATA_AMF0, MSG_COMMAND_AMF0,
+                           MSG_COMMAND_AMF3)
+from app import app
 
 logger = logging.getLogger(__name__)
 
+# Flow control announced to publishers
+WINDOW_ACK_SIZE = 2500000
+OUT_CHUNK_SIZE = 4096
+
+# Buffered bytes towards a transcoder before the publisher is paused
+PIPE_HIGH_WATER = 1024 * 1024
+
+class PipeSink:
+    """Writes a publisher's media as FLV into a transcoder's stdin pipe"""
+    
+    def __init__(self, writer):
+        self.writer = writer
+        self.writer.write(flv_header())
+    
+    @classmethod
+    async def open(cls, pipe):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, pipe)
+        transport.set_write_buffer_limits(high=PIPE_HIGH_WATER)
+        return cls(asyncio.StreamWriter(transport, protocol, None, loop))
+    
+    async def write(self, tag_type, timestamp, payload):
+        self.writer.write(flv_tag(tag_type, timestamp, payload))
+        # Backpressure: a slow transcoder stops us reading from the socket
+        await self.writer.drain()
+    
+    def close(self):
+        self.writer.close()
+    
+    def abort(self):
+        """Drop buffered media, releasing a write blocked on a hung transcoder"""
+        self.writer.transport.abort()
+
+class RTMPSession:
+    """One RTMP client connection: handshake, commands and media relay"""
+    
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = ChunkReader(reader)
+        self.writer = ChunkWriter(writer)
+        self.transport = writer
+        self.client_ip = (writer.get_extra_info('peername') or ('unknown',))[0]
+        self.app_name = None
+        self.stream_key = None
+        self.sink = None
+        self.probe = None
+        self.cached_probe = None
+        self.headers = {}
+        self.restarting = False
+        self.wait_keyframe = False
+        self.acknowledged = 0
+        self.ack_window = WINDOW_ACK_SIZE
+    
+    async def run(self):
+        """Serve the connection until the client goes away"""
+        try:
+            await server_handshake(self.reader.reader, self.transport)
+            
+            while True:
+                type_id, stream_id, timestamp, payload = await self.reader.read_message()
+                await self._handle_message(type_id, stream_id, timestamp, payload)
+                
+                # Acknowledge received bytes once per window
+                if self.reader.bytes_read - self.acknowledged >= self.ack_window:
+                    self.acknowledged = self.reader.bytes_read
+                    self.writer.acknowledgement(self.acknowledged)
+        
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except RTMPProtocolError as e:
+            logger.warning(f"RTMP protocol error from {self.client_ip}: {e}")
+        except Exception as e:
+            logger.error(f"Error in RTMP session from {self.client_ip}: {e}")
+        finally:
+            await self._unpublish()
+            self.transport.close()
+    
+    async def _handle_message(self, type_id, stream_id, timestamp, payload):
+        if type_id in (MSG_AUDIO, MSG_VIDEO):
+            if self.sink:
+                await self._observe(type_id, timestamp, payload)
+            if self.wait_keyframe and type_id == MSG_VIDEO:
+                # A restarted encoder starts decoding at a keyframe
+                if not payload or payload[0] >> 4 != 1:
+                    return
+                self.wait_keyframe = False
+            if self.sink:
+                await self.sink.write(type_id, timestamp, payload)
+        elif type_id == MSG_DATA_AMF0:
+            await self._handle_data(timestamp, payload)
+        elif type_id in (MSG_COMMAND_AMF0, MSG_COMMAND_AMF3):
+            # AMF3 commands carry a leading format byte before AMF0 values
+            values = amf0_decode(payload[1:] if type_id == MSG_COMMAND_AMF3 else payload)
+            await self._handle_command(stream_id, values)
+        elif type_id == MSG_SET_CHUNK_SIZE:
+            self.reader.chunk_size = int.from_bytes(payload[:4], 'big') & 0x7FFFFFFF
+        elif type_id == MSG_WINDOW_ACK_SIZE:
+            self.ack_window = int.from_bytes(payload[:4], 'big')
+        elif type_id == MSG_ABORT:
+            self.reader.abort(int.from_bytes(payload[:4], 'big'))
+        elif type_id != MSG_ACKNOWLEDGEMENT:
+            logger.debug(f"Ignoring RTMP message type {type_id}")
+    
+    async def _handle_data(self, timestamp, payload):
+        """Forward onMetaData, stripping the @setDataFrame wrapper"""
+        if not self.sink:
+            return
+        
+        values = amf0_decode(payload)
+        if values and values[0] == '@setDataFrame':
+            # Re-encode without the wrapper: string marker + length + name
+            prefix = 1 + 2 + len('@setDataFrame')
+            payload = payload[prefix:]
+        await self._observe(MSG_DATA_AMF0, timestamp, payload)
+        if self.sink:
+            await self.sink.write(MSG_DATA_AMF0, timestamp, payload)
+    
+    async def _observe(self, tag_type, timestamp, payload):
+        """Probe every publish; the cached probe is only trusted if it matches.
+        
+        The encoder is started with the previous publish's probe, so a
+        publisher that changed codec, profile, size or GOP gets its encoder
+        restarted with the fresh result once the probe completes.
+        """
+        self._remember_header(tag_type, timestamp, payload)
+        if not self.probe or not self.probe.feed(tag_type, timestamp, payload):
+            return
+        
+        result, cached = self.probe.result, self.cached_probe
+        self.probe = self.cached_probe = None
+        media_probe.store(self.server.input_url(self.stream_key), result)
+        if cached is not None and not same_input(cached, result):
+            logger.warning(f"Publish of {self.stream_key} no longer matches its cached probe, restarting its encoder")
+            await self._restart_sink()
+    
+    def _remember_header(self, tag_type, timestamp, payload):
+        """Keep metadata and codec configuration to prime a restarted encoder"""
+        if not payload:
+            return
+        if tag_type == MSG_DATA_AMF0:
+            self.headers['metadata'] = (tag_type, timestamp, payload)
+        elif tag_type == MSG_VIDEO and payload[0] & 0x0F == 7 and len(payload) > 1 and payload[1] == 0:
+            self.headers['video'] = (tag_type, timestamp, payload)
+        elif tag_type == MSG_AUDIO and payload[0] >> 4 == 10 and len(payload) > 1 and payload[1] == 0:
+            self.headers['audio'] = (tag_type, timestamp, payload)
+    
+    async def _restart_sink(self):
+        """Stop the encoder and start a new one, primed with the stream headers.
+        
+        The publisher stays connected; media read meanwhile is dropped and
+        the new encoder gets video from the next keyframe.
+        """
+        if self.restarting or not self.sink:
+            return
+        
+        stream_key = self.stream_key
+        self.restarting = True
+        try:
+            sink, self.sink = self.sink, None
+            sink.abort()
+            await self.server.close_sink(stream_key)
+            if self.stream_key != stream_key:
+                return
+            
+            sink = await self.server.open_sink(stream_key, self.client_ip)
+            if self.stream_key != stream_key:
+                # The publisher left while the encoder was starting
+                if sink:
+                    sink.close()
+                    await self.server.close_sink(stream_key)
+                return
+            if not sink:
+                logger.error(f"Could not restart the encoder of {stream_key}")
+                return
+            for tag_type, timestamp, payload in self.headers.values():
+                await sink.write(tag_type, timestamp, payload)
+            self.sink = sink
+            self.wait_keyframe = True
+        finally:
+            self.restarting = False
+    
+    async def _handle_command(self, stream_id, values):
+        if not values:
+            return
+        
+        name = values[0]
+        transaction_id = values[1] if len(values) > 1 else 0
+        
+        if name == 'connect':
+            properties = values[2] if len(values) > 2 and isinstance(values[2], dict) else {}
+            self.app_name = properties.get('app', '')
+            
+            self.writer.window_ack_size(WINDOW_ACK_SIZE)
+            self.writer.set_peer_bandwidth(WINDOW_ACK_SIZE)
+            self.writer.set_chunk_size(OUT_CHUNK_SIZE)
+            self.writer.command(0, '_result', transaction_id,
+                                {'fmsVer': 'FMS/3,0,1,123', 'capabilities': 31},
+                                {'level': 'status', 'code': 'NetConnection.Connect.Success',
+                                 'description': 'Connection succeeded.', 'objectEncoding': 0})
+        
+        elif name == 'createStream':
+            self.writer.command(0, '_result', transaction_id, None, 1)
+        
+        elif name == 'publish':
+            key = values[3] if len(values) > 3 else None
+            await self._publish(stream_id or 1, transaction_id, key)
+        
+        elif name in ('FCUnpublish', 'deleteStream', 'closeStream'):
+            await self._unpublish()
+        
+        elif name in ('releaseStream', 'FCPublish', '_checkbw'):
+            self.writer.command(0, '_result', transaction_id, None)
+        
+        elif name == 'play':
+            self._status(stream_id, 'error', 'NetStream.Play.Failed', 'Playback is not supported.')
+        
+        await self.transport.drain()
+    
+    async def _publish(self, stream_id, transaction_id, key):
+        if not key or self.sink:
+            self._status(stream_id, 'error', 'NetStream.Publish.BadName', 'Invalid stream key.')
+            return
+        
+        # Tokens may be appended to the key as a query string
+        stream_key = key.split('?', 1)[0]
+        if stream_key in self.server.publishers:
+            # A second publisher would share the live encoder's input pipe
+            logger.warning(f"Rejected publish of {stream_key} from {self.client_ip}: already published")
+            self._status(stream_id, 'error', 'NetStream.Publish.BadName', 'Stream key is already publishing.')
+            return
+        
+        # Claimed before the encoder starts so concurrent publishes of the key are refused
+        self.stream_key = stream_key
+        self.server.publishers[stream_key] = self
+        
+        self.sink = await self.server.open_sink(self.stream_key, self.client_ip)
+        if not self.sink:
+            self._status(stream_id, 'error', 'NetStream.Publish.BadName', 'Stream could not be started.')
+            del self.server.publishers[stream_key]
+            self.stream_key = None
+            return
+        
+        self.cached_probe = media_probe.get_cached(self.server.input_url(self.stream_key))
+        self.probe = FlvProbe()
+        self.headers = {}
+        
+        self.writer.stream_begin(stream_id)
+        self._status(stream_id, 'status', 'NetStream.Publish.Start', f'{self.stream_key} is now published.')
+        logger.info(f"RTMP publish started for {self.stream_key} from {self.client_ip}")
+    
+    async def _unpublish(self):
+        if not self.stream_key:
+            return
+        
+        stream_key, sink = self.stream_key, self.sink
+        self.stream_key = self.sink = self.probe = self.cached_probe = None
+        if self.server.publishers.get(stream_key) is not self:
+            return
+        
+        if sink:
+            sink.close()
+        await self.server.close_sink(stream_key)
+        # Released only once the encoder is stopped, so a new publish starts a fresh one
+        del self.server.publishers[stream_key]
+        logger.info(f"RTMP publish ended for {stream_key}")
+    
+    def _status(self, stream_id, level, code, description):
+        self.writer.command(stream_id, 'onStatus', 0, None,
+                            {'level': level, 'code': code, 'description': description})
+
 class RTMPServer:
-    def __init__(self, port=1935):
+    """Native RTMP ingest server running on its own asyncio event loop.
+    
+    Publishers are accepted directly on self.port; each published stream is
+    started through handle_stream_publish and its media is piped as FLV into
+    the transcoder's stdin.
+    """
+    
+    def __init__(self, port=1935, host='0.0.0.0'):
         self.port = port
-        self.server_process = None
+        self.host = host
         self.is_running = False
         self.streams = {}
-        
+        self.loop = None
+        self.server = None
+        self.server_thread = None
+        self.sessions = set()
+        self.publishers = {}
+    
     def start_server(self):
-        """Start the RTMP server using FFmpeg"""
+        """Start the RTMP listener on a background event loop"""
         if self.is_running:
             logger.warning("RTMP server is already running")
             return True
-            
+        
         try:
-            # Create RTMP server using FFmpeg (simple implementation)
-            # In production, you'd use nginx-rtmp-module or similar
-            self.is_running = True
-            logger.info(f"RTMP server started on port {self.port}")
+            started = threading.Event()
+            errors = []
             
-            # Start monitoring thread for incoming streams
-            monitor_thread = threading.Thread(target=self._monitor_incoming_streams)
-            monitor_thread.daemon = True
-            monitor_thread.start()
+            self.server_thread = threading.Thread(
+                target=self._run_loop,
+                args=(started, errors),
+                name='rtmp-server'
+            )
+            self.server_thread.daemon = True
+            self.server_thread.start()
+            started.wait(timeout=10)
             
-            return True
+            if errors or not self.is_running:
+                raise errors[0] if errors else RuntimeError("listener did not start")
             
+            logger.info(f"RTMP server started on port {self.port}")
+            ffmpeg_service.pipe_restarter = self.restart_publish
+            ffmpeg_service.start_pool()
+            return True
+        
         except Exception as e:
             logger.error(f"Failed to start RTMP server: {e}")
             return False
@@ -42,48 +339,124 @@ class RTMPServer:
     def stop_server(self):
         """Stop the RTMP server"""
         try:
-            if self.server_process:
-                self.server_process.terminate()
-                self.server_process.wait(timeout=5)
+            if self.loop and self.is_running:
+                future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+                future.result(timeout=10)
+                self.loop.call_soon_threadsafe(self.loop.stop)
+            
+            if self.server_thread:
+                self.server_thread.join(timeout=5)
             
             self.is_running = False
+            ffmpeg_service.stop_pool()
             logger.info("RTMP server stopped")
             return True
-            
-        except subprocess.TimeoutExpired:
-            if self.server_process:
-                self.server_process.kill()
-            return True
+        
         except Exception as e:
             logger.error(f"Error stopping RTMP server: {e}")
             return False
     
-    def _monitor_incoming_streams(self):
-        """Monitor for incoming RTMP streams"""
-        # This is a simplified implementation
-        # In production, you'd integrate with nginx-rtmp-module callbacks
-        while self.is_running:
-            try:
-                # Check for new streams every 5 seconds
-                threading.Event().wait(5)
-                # Implementation would monitor RTMP connections
-                
-            except Exception as e:
-                logger.error(f"Error monitoring RTMP streams: {e}")
+    def _run_loop(self, started, errors):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self._accept, self.host, self.port, reuse_address=True)
+            )
+            self.is_running = True
+        except Exception as e:
+            errors.append(e)
+            started.set()
+            self.loop.close()
+            return
+        
+        started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            self.loop = None
+    
+    async def _shutdown(self):
+        self.server.close()
+        await self.server.wait_closed()
+        
+        for task in list(self.sessions):
+            task.cancel()
+        if self.sessions:
+            await asyncio.gather(*self.sessions, return_exceptions=True)
     
-    def handle_stream_publish(self, stream_key, client_ip=None):
-        """Handle new stream publication"""
+    async def _accept(self, reader, writer):
+        task = asyncio.current_task()
+        self.sessions.add(task)
+        try:
+            await RTMPSession(self, reader, writer).run()
+        finally:
+            self.sessions.discard(task)
+    
+    def restart_publish(self, stream_id):
+        """Restart the encoder of a native publish, keeping the publisher connected"""
+        stream_key = next((key for key, info in list(self.streams.items())
+                           if info['stream_id'] == stream_id and info['native']), None)
+        session = self.publishers.get(stream_key)
+        if not session or not self.loop or session.restarting:
+            return False
+        
+        logger.info(f"Restarting the encoder of native publish {stream_key}")
+        asyncio.run_coroutine_threadsafe(session._restart_sink(), self.loop)
+        return True
+    
+    def input_url(self, stream_key):
+        """Stored input URL of streams published under stream_key"""
+        return f"rtmp://localhost:{self.port}/live/{stream_key}"
+    
+    async def open_sink(self, stream_key, client_ip):
+        """Start the transcoder for a publish and return its media sink"""
+        loop = asyncio.get_running_loop()
+        stream_id = await loop.run_in_executor(
+            None, self._in_app_context, self.handle_stream_publish, stream_key, client_ip, True
+        )
+        if not stream_id:
+            return None
+        
+        pipe = ffmpeg_service.get_input_pipe(stream_id)
+        if not pipe:
+            logger.error(f"Stream {stream_id} has no input pipe for {stream_key}")
+            await self.close_sink(stream_key)
+            return None
+        
+        return await PipeSink.open(pipe)
+    
+    async def close_sink(self, stream_key):
+        """Stop the transcoder behind a publish"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._in_app_context, self.handle_stream_unpublish, stream_key)
+    
+    def _in_app_context(self, func, *args):
+        with app.app_context():
+            return func(*args)
+    
+    def handle_stream_publish(self, stream_key, client_ip=None, native=False):
+        """Handle new stream publication.
+        
+        native publishes come from this server and feed the transcoder over
+        its stdin; otherwise the transcoder pulls from input_url (e.g. an
+        external nginx-rtmp calling /rtmp/publish).
+        """
         try:
             # Check if stream already exists
-            stream = Stream.query.filter_by(input_url=f"rtmp://localhost:{self.port}/live/{stream_key}").first()
+            stream = stream_registry.get_by_stream_key(stream_key)
+            if stream and stream.input_url != self.input_url(stream_key):
+                stream = None
             
             if not stream:
                 # Auto-create stream for new stream key
                 stream = Stream(
                     name=f"RTMP Stream - {stream_key}",
-                    input_url=f"rtmp://localhost:{self.port}/live/{stream_key}",
+                    input_url=self.input_url(stream_key),
                     input_type="rtmp",
-                    status="running",
+                    status="stopped",
                     latency_mode="low",
                     record_enabled=False,
                     video_codec="h264",
@@ -104,14 +477,17 @@ class RTMPServer:
             self.streams[stream_key] = {
                 'stream_id': stream.id,
                 'start_time': datetime.utcnow(),
-                'client_ip': client_ip
+                'client_ip': client_ip,
+                'native': native
             }
             
             # Start stream processing
-            stream_manager.start_stream(stream.id)
+            if not stream_manager.start_stream(stream.id, PIPE_INPUT if native else None):
+                del self.streams[stream_key]
+                return None
             
             return stream.id
-            
+        
         except Exception as e:
             logger.error(f"Error handling stream publish for key {stream_key}: {e}")
             return None
@@ -127,14 +503,15 @@ class RTMPServer:
                 stream_manager.stop_stream(stream_id)
                 
                 # Update stream status
-                stream = Stream.query.get(stream_id)
-                if stream:
+                record = stream_registry.get(stream_id)
+                if record and record.status != 'stopped':
+                    stream = Stream.query.get(stream_id)
                     stream.status = 'stopped'
                     db.session.commit()
                 
                 del self.streams[stream_key]
                 logger.info(f"Stream {stream_key} unpublished")
-                
+        
         except Exception as e:
             logger.error(f"Error handling stream unpublish for key {stream_key}: {e}")
     
@@ -148,8 +525,10 @@ class RTMPServer:
             'running': self.is_running,
             'port': self.port,
             'active_streams': len(self.streams),
-            'streams': self.streams
+            'connections': len(self.sessions),
+            'streams': self.streams,
+            'encoder_pool': encoder_pool.get_stats()
         }
 
 # Global RTMP server instance
-rtmp_server = RTMPServer()
\ No newline at end of file
+rtmp_server = RTMPServer()
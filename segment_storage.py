@@ -0,0 +1,249 @@
+import os
+import re
+import time
+import threading
+import logging
+from config import STORAGE_SETTINGS, DVR_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Every live output is named after its stream: hls/stream_1_720p.m3u8,
+# dash/stream_1-chunk-0-00001.m4s, cmaf/stream_1/...
+STREAM_NAME = re.compile(r'^stream_(\d+)(?!\d)')
+
+SEGMENT_EXTENSIONS = ('.ts', '.m4s', '.mp4', '.m4a', '.m4v', '.aac', '.vtt')
+TEMPORARY_EXTENSIONS = ('.tmp',)
+
+def filesystem_type(path):
+    """Filesystem type of the mount holding path, e.g. 'tmpfs'"""
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) > len(best):
+                    best, fstype = mount, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+def is_segment(name):
+    # Init segments are needed for the whole life of a stream
+    return name.endswith(SEGMENT_EXTENSIONS) and 'init' not in name
+
+class SegmentStorage:
+    """Live segment storage under MEDIA_ROOT with active pruning.
+    
+    MEDIA_ROOT can be a tmpfs such as /dev/shm so live origin I/O stays in
+    RAM. A janitor thread enforces, per stream:
+    - segments older than segment_ttl are removed even if the muxer
+      failed to delete them;
+    - segment bytes over stream_budget are removed oldest first, never
+      touching files newer than min_age;
+    - everything of a stream that is not live is removed once it is
+      older than orphan_grace, including empty package directories.
+    Streams with a DVR window keep segments for that window on top of
+    segment_ttl, up to dvr_budget bytes.
+    """
+    
+    def __init__(self):
+        self.roots = []
+        self.media_root = None
+        self.live_streams = None
+        self.usage = {}
+        self.retention = {}
+        self.pruned = {'expired': 0, 'budget': 0, 'orphaned': 0}
+        self.pruned_bytes = 0
+        self.last_run = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.app = None
+    
+    def start(self, app, live_streams):
+        """Start the janitor; live_streams() returns ids whose files are kept"""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            
+            self.app = app
+            self.live_streams = live_streams
+            self.media_root = app.config['MEDIA_ROOT']
+            self.roots = [app.config['HLS_OUTPUT_DIR'], app.config['DASH_OUTPUT_DIR'],
+                          app.config['CMAF_OUTPUT_DIR']]
+            self.thread = threading.Thread(target=self._janitor_loop, name='segment-janitor')
+            self.thread.daemon = True
+            self.thread.start()
+        
+        fstype = filesystem_type(self.media_root)
+        if fstype != 'tmpfs':
+            logger.info(f"Live segments are stored on {fstype or 'unknown'} at {self.media_root}; "
+                        f"set MEDIA_ROOT to a tmpfs path (e.g. /dev/shm) to keep them in RAM")
+    
+    def set_retention(self, stream_id, seconds):
+        """Keep a live stream's segments for a DVR window of seconds"""
+        with self.lock:
+            self.retention[stream_id] = seconds
+    
+    def clear_retention(self, stream_id):
+        with self.lock:
+            self.retention.pop(stream_id, None)
+    
+    def _janitor_loop(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    live = set(self.live_streams())
+                self.run_once(live)
+            except Exception as e:
+                logger.error(f"Error pruning live segments: {e}")
+            time.sleep(STORAGE_SETTINGS['janitor_interval'])
+    
+    def scan(self):
+        """Files per stream id: [(path, size, mtime, name)]; directories separately"""
+        files = {}
+        directories = {}
+        for root in self.roots:
+            try:
+                entries = list(os.scandir(root))
+            except OSError:
+                continue
+            
+            for entry in entries:
+                match = STREAM_NAME.match(entry.name)
+                if not match:
+                    continue
+                stream_id = int(match.group(1))
+                
+                if entry.is_dir(follow_symlinks=False):
+                    directories.setdefault(stream_id, []).append(entry.path)
+                    try:
+                        targets = list(os.scandir(entry.path))
+                    except OSError:
+                        continue
+                else:
+                    targets = [entry]
+                
+                for target in targets:
+                    try:
+                        stat = target.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if target.is_file(follow_symlinks=False):
+                        files.setdefault(stream_id, []).append(
+                            (target.path, stat.st_size, stat.st_mtime, target.name)
+                        )
+        return files, directories
+    
+    def run_once(self, live, now=None):
+        """Prune every stream once; returns bytes removed"""
+        now = now or time.time()
+        files, directories = self.scan()
+        removed = 0
+        usage = {}
+        
+        with self.lock:
+            retention = dict(self.retention)
+        
+        for stream_id, stream_files in files.items():
+            if stream_id in live:
+                kept, freed = self._prune_live(stream_files, now, retention.get(stream_id))
+                removed += freed
+                usage[stream_id] = {
+                    'files': len(kept),
+                    'bytes': sum(size for _, size, _, _ in kept)
+                }
+            else:
+                for path, size, mtime, _ in stream_files:
+                    if now - mtime >= STORAGE_SETTINGS['orphan_grace']:
+                        removed += self._remove(path, size, 'orphaned')
+        
+        for stream_id, paths in directories.items():
+            if stream_id in live:
+                continue
+            for path in paths:
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+        
+        with self.lock:
+            self.usage = usage
+            self.last_run = now
+        return removed
+    
+    def _prune_live(self, stream_files, now, dvr_window=None):
+        ttl = STORAGE_SETTINGS['segment_ttl'] + (dvr_window or 0)
+        budget = DVR_SETTINGS['dvr_budget'] if dvr_window else STORAGE_SETTINGS['stream_budget']
+        removed = 0
+        kept = []
+        segments = []
+        
+        for item in stream_files:
+            path, size, mtime, name = item
+            age = now - mtime
+            # Leftover .tmp files of an interrupted write expire like segments
+            if (is_segment(name) or name.endswith(TEMPORARY_EXTENSIONS)) and age >= ttl:
+                removed += self._remove(path, size, 'expired')
+            else:
+                kept.append(item)
+                if is_segment(name):
+                    segments.append(item)
+        
+        # Oldest first until the stream fits its budget
+        excess = sum(size for _, size, _, _ in segments) - budget
+        for item in sorted(segments, key=lambda segment: segment[2]):
+            if excess <= 0:
+                break
+            path, size, mtime, _ = item
+            if now - mtime < STORAGE_SETTINGS['min_age']:
+                break
+            removed += self._remove(path, size, 'budget')
+            excess -= size
+            kept.remove(item)
+        
+        return kept, removed
+    
+    def _remove(self, path, size, reason):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        except OSError as e:
+            logger.warning(f"Could not remove {path}: {e}")
+            return 0
+        
+        with self.lock:
+            self.pruned[reason] += 1
+            self.pruned_bytes += size
+        return size
+    
+    def get_status(self):
+        """Per-stream usage, pruning counters and filesystem capacity"""
+        status = {
+            'media_root': self.media_root,
+            'filesystem': filesystem_type(self.media_root) if self.media_root else None,
+            'stream_budget': STORAGE_SETTINGS['stream_budget'],
+            'dvr_budget': DVR_SETTINGS['dvr_budget']
+        }
+        try:
+            stats = os.statvfs(self.media_root)
+            status['total_bytes'] = stats.f_blocks * stats.f_frsize
+            status['free_bytes'] = stats.f_bavail * stats.f_frsize
+        except (OSError, TypeError):
+            pass
+        
+        with self.lock:
+            status.update({
+                'used_bytes': sum(usage['bytes'] for usage in self.usage.values()),
+                'streams': {stream_id: dict(usage, dvr_window=self.retention.get(stream_id))
+                            for stream_id, usage in self.usage.items()},
+                'pruned_files': dict(self.pruned),
+                'pruned_bytes': self.pruned_bytes,
+                'last_run': self.last_run
+            })
+        return status
+
+# Global segment storage instance
+segment_storage = SegmentStorage()
@@ -0,0 +1,343 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+import logging
+from segment_storage import STREAM_NAME, is_segment
+from process_supervisor import process_supervisor
+from stats_collector import stats_collector
+from event_bus import event_bus
+from metrics import metrics, segment_latency
+from config import WATCHDOG_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+EVENT_HEADER = struct.Struct('iIII')
+
+PLAYLIST_EXTENSIONS = ('.m3u8', '.mpd')
+# Closed segments remembered per stream until a playlist write lists them
+MAX_UNLISTED = 64
+
+recoveries_total = metrics.counter('stropen_watchdog_recoveries_total',
+                                   'Encoders restarted by the stall watchdog', ('stream',))
+
+class Inotify:
+    """Minimal inotify(7) binding over libc"""
+    
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        return wd
+    
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+    
+    def read(self):
+        """Pending events as (wd, mask, name)"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+class StallWatchdog:
+    """Restarts encoders that are alive but no longer produce output.
+    
+    Segment writes are reported by inotify on the output directories
+    (close-after-write, or the rename of a CMAF .tmp segment) and encode
+    progress by the -progress out_time the supervisor already reads, so
+    detecting a stall costs no directory scans. A stalled encoder is
+    killed and restarted by the process supervisor; recoveries back off
+    per stream and a circuit breaker stops restarting an encoder that
+    keeps stalling. The same events time every stream's segment
+    publish delay: segments closed since the last playlist write are
+    listed by the next one. Encoders fed over a pipe (native RTMP publishes)
+    cannot be respawned by the supervisor; their owner passes a restart
+    callable instead, and since that restarts the whole stream the
+    recovery history outlives unwatch() for breaker_window seconds.
+    """
+    
+    def __init__(self):
+        self.streams = {}
+        self.history = {}
+        self.directories = {}
+        self.watches = {}
+        self.lock = threading.Lock()
+        self.inotify = None
+        self.thread = None
+    
+    def watch(self, stream_id, directories, segment_duration, restart=None):
+        """Start watching a stream's encoder and its segment directories.
+        
+        restart(stream_id) recovers a stalled encoder the process supervisor
+        cannot restart itself; it returns False if nothing was restarted.
+        """
+        if not WATCHDOG_SETTINGS['enabled']:
+            return
+        
+        with self.lock:
+            self._ensure_running()
+            recoveries, retry_at = self._recent_history(stream_id)
+            self.streams[stream_id] = {
+                'directories': list(directories) if self.inotify else [],
+                'threshold': WATCHDOG_SETTINGS['stall_segments'] * segment_duration,
+                'out_time': None,
+                'stalled': False,
+                'breaker_open': False,
+                'retry_at': retry_at,
+                'recoveries': recoveries,
+                'unlisted': [],
+                'restart': restart or process_supervisor.restart,
+                'keep_history': restart is not None
+            }
+            self._reset_timers(self.streams[stream_id])
+            
+            for directory in self.streams[stream_id]['directories']:
+                self._add_directory(directory, stream_id)
+    
+    def unwatch(self, stream_id):
+        with self.lock:
+            stream = self.streams.pop(stream_id, None)
+            if not stream:
+                return
+            if stream['keep_history'] and stream['recoveries']:
+                self.history[stream_id] = (stream['recoveries'], stream['retry_at'])
+            for directory in stream['directories']:
+                self._remove_directory(directory, stream_id)
+    
+    def started(self, stream_id):
+        """The stream's encoder (re)started; give it startup_grace to produce output"""
+        with self.lock:
+            stream = self.streams.get(stream_id)
+            if stream:
+                self._reset_timers(stream)
+    
+    def _recent_history(self, stream_id):
+        """Recoveries within breaker_window and the retry time of a re-watched stream"""
+        now = time.monotonic()
+        recoveries, retry_at = self.history.pop(stream_id, ([], 0))
+        self.history = {key: entry for key, entry in self.history.items()
+                        if now - max(entry[0]) < WATCHDOG_SETTINGS['breaker_window']}
+        return [at for at in recoveries if now - at < WATCHDOG_SETTINGS['breaker_window']], retry_at
+    
+    def _reset_timers(self, stream):
+        # Output timestamps start in the future so a fresh encoder is not stalled
+        now = time.monotonic()
+        stream['started_at'] = now
+        stream['segment_at'] = stream['progress_at'] = now + WATCHDOG_SETTINGS['startup_grace']
+        stream['output_seen'] = False
+    
+    def _ensure_running(self):
+        """Start inotify and the watchdog thread (lock held)"""
+        if self.thread and self.thread.is_alive():
+            return
+        
+        if self.inotify is None:
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError, TypeError) as e:
+                logger.warning(f"inotify is unavailable ({e}), watching encode progress only")
+        
+        self.thread = threading.Thread(target=self._watch_loop, name='stall-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def _add_directory(self, directory, stream_id):
+        users = self.directories.get(directory)
+        if users is None:
+            try:
+                wd = self.inotify.add_watch(directory, IN_CLOSE_WRITE | IN_MOVED_TO)
+            except OSError as e:
+                logger.warning(f"Cannot watch {directory} for segments: {e}")
+                return
+            users = self.directories[directory] = {'wd': wd, 'streams': set()}
+            self.watches[wd] = directory
+        users['streams'].add(stream_id)
+    
+    def _remove_directory(self, directory, stream_id):
+        users = self.directories.get(directory)
+        if not users:
+            return
+        users['streams'].discard(stream_id)
+        if not users['streams']:
+            del self.directories[directory]
+            self.watches.pop(users['wd'], None)
+            self.inotify.rm_watch(users['wd'])
+    
+    def _watch_loop(self):
+        while True:
+            try:
+                if self.inotify:
+                    readable, _, _ = select.select([self.inotify.fd], [], [], WATCHDOG_SETTINGS['check_interval'])
+                    if readable:
+                        self._handle_events(self.inotify.read())
+                else:
+                    time.sleep(WATCHDOG_SETTINGS['check_interval'])
+                self.check()
+            except Exception as e:
+                logger.error(f"Stall watchdog error: {e}")
+                time.sleep(WATCHDOG_SETTINGS['check_interval'])
+    
+    def measures_segments(self, stream_id):
+        """Whether segment publish delays of a stream are observed here"""
+        stream = self.streams.get(stream_id)
+        return bool(stream and stream['directories'])
+    
+    def _handle_events(self, events):
+        now = time.monotonic()
+        listed = []
+        with self.lock:
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost; count every watched stream as writing
+                    for stream in self.streams.values():
+                        stream['segment_at'] = max(stream['segment_at'], now)
+                    continue
+                if mask & IN_IGNORED:
+                    # The directory was removed
+                    directory = self.watches.pop(wd, None)
+                    self.directories.pop(directory, None)
+                    continue
+                playlist = name.endswith(PLAYLIST_EXTENSIONS)
+                if not playlist and not is_segment(name):
+                    continue
+                
+                # Shared directories name files after the stream, package
+                # directories are named after it
+                directory = self.watches.get(wd)
+                match = STREAM_NAME.match(name) or (directory and STREAM_NAME.match(os.path.basename(directory)))
+                stream_id = int(match.group(1)) if match else None
+                stream = self.streams.get(stream_id)
+                if not stream or not directory:
+                    continue
+                
+                path = os.path.join(directory, name)
+                if playlist:
+                    if stream['unlisted']:
+                        listed.append((stream_id, path, stream['unlisted']))
+                        stream['unlisted'] = []
+                    continue
+                
+                stream['segment_at'] = now
+                stream['output_seen'] = True
+                stream['unlisted'].append(path)
+                del stream['unlisted'][:-MAX_UNLISTED]
+        
+        # Delay between each segment's last write and the playlist listing it
+        for stream_id, playlist_path, segments in listed:
+            try:
+                listed_at = os.stat(playlist_path).st_mtime_ns
+            except OSError:
+                continue
+            for path in segments:
+                try:
+                    written = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                segment_latency.observe(max(0, listed_at - written) / 1e9, (str(stream_id),))
+    
+    def check(self, now=None):
+        """Look for stalled encoders and recover them"""
+        now = now or time.monotonic()
+        with self.lock:
+            streams = list(self.streams.items())
+        
+        for stream_id, stream in streams:
+            info = process_supervisor.get_info(stream_id)
+            if not info or not info['running']:
+                continue
+            
+            sample = stats_collector.latest(stream_id)
+            if sample and sample['out_time'] != stream['out_time']:
+                stream['out_time'] = sample['out_time']
+                stream['progress_at'] = max(stream['progress_at'], now)
+                stream['output_seen'] = True
+            
+            stalled = now - stream['progress_at'] > stream['threshold']
+            if stream['directories'] and now - stream['segment_at'] > stream['threshold']:
+                stalled = True
+            
+            if stalled:
+                self._recover(stream_id, stream, now)
+            elif stream['stalled'] and stream['output_seen']:
+                stream['stalled'] = False
+                stream['breaker_open'] = False
+                logger.info(f"Stream {stream_id} is producing output again")
+                event_bus.publish_status(stream_id, 'running')
+    
+    def _recover(self, stream_id, stream, now):
+        if not stream['stalled']:
+            stream['stalled'] = True
+            logger.warning(f"Stream {stream_id} stalled: no output for {stream['threshold']}s")
+            event_bus.publish_status(stream_id, 'stalled')
+        
+        if now < stream['retry_at']:
+            return
+        
+        stream['recoveries'] = [at for at in stream['recoveries'] if now - at < WATCHDOG_SETTINGS['breaker_window']]
+        if len(stream['recoveries']) >= WATCHDOG_SETTINGS['max_recoveries'] and not stream['breaker_open']:
+            stream['breaker_open'] = True
+            stream['retry_at'] = now + WATCHDOG_SETTINGS['breaker_cooldown']
+            logger.error(f"Stream {stream_id} stalled {len(stream['recoveries'])} times in "
+                         f"{WATCHDOG_SETTINGS['breaker_window']}s, not restarting it for "
+                         f"{WATCHDOG_SETTINGS['breaker_cooldown']}s")
+            event_bus.publish_status(stream_id, 'error', reason='stalled')
+            return
+        
+        # An open breaker lets one attempt through per cooldown
+        if not stream['restart'](stream_id):
+            return
+        logger.warning(f"Restarting stalled encoder of stream {stream_id}")
+        recoveries_total.inc((str(stream_id),))
+        stream['recoveries'].append(now)
+        if stream['breaker_open']:
+            stream['retry_at'] = now + WATCHDOG_SETTINGS['breaker_cooldown']
+        else:
+            backoff = WATCHDOG_SETTINGS['initial_backoff'] * 2 ** (len(stream['recoveries']) - 1)
+            stream['retry_at'] = now + min(backoff, WATCHDOG_SETTINGS['max_backoff'])
+    
+    def is_stalled(self, stream_id):
+        stream = self.streams.get(stream_id)
+        return bool(stream and stream['stalled'])
+    
+    def get_status(self, stream_id):
+        """Watchdog state of a stream, or None"""
+        stream = self.streams.get(stream_id)
+        if not stream:
+            return None
+        
+        now = time.monotonic()
+        return {
+            'stalled': stream['stalled'],
+            'breaker_open': stream['breaker_open'],
+            'threshold': stream['threshold'],
+            'segment_age': round(max(0, now - stream['segment_at']), 1) if stream['directories'] else None,
+            'progress_age': round(max(0, now - stream['progress_at']), 1),
+            'recoveries': len(stream['recoveries'])
+        }
+
+# Global stall watchdog instance
+stall_watchdog = StallWatchdog()
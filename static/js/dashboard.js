@@ -80,26 +80,38 @@ class StreamDashboard {
     }
 
     startStatusUpdates() {
-        // Update stream statuses every 30 seconds
+        // Status changes are pushed over Server-Sent Events; browsers
+        // without EventSource poll all cards in one batch request instead
+        if (window.EventSource) {
+            this.eventSource = new EventSource('/events');
+            this.eventSource.addEventListener('status', (event) => {
+                const status = JSON.parse(event.data);
+                this.updateStreamCard(status.stream_id, status);
+            });
+        }
+
         setInterval(() => {
-            this.updateStreamStatuses();
+            if (!this.eventSource || this.eventSource.readyState === EventSource.CLOSED) {
+                this.updateStreamStatuses();
+            }
             this.updateLivePreviews();
         }, 30000);
     }
 
     async updateStreamStatuses() {
         const streamCards = document.querySelectorAll('[data-stream-id]');
-        
-        for (const card of streamCards) {
-            const streamId = card.dataset.streamId;
-            try {
-                const response = await fetch(`/stream/${streamId}/status`);
-                const status = await response.json();
-                
+        const ids = [...new Set([...streamCards].map(card => card.dataset.streamId))];
+        if (ids.length === 0) return;
+
+        try {
+            const response = await fetch(`/streams/status?ids=${ids.join(',')}`);
+            const result = await response.json();
+
+            for (const [streamId, status] of Object.entries(result.streams || {})) {
                 this.updateStreamCard(streamId, status);
-            } catch (error) {
-                console.error(`Error updating status for stream ${streamId}:`, error);
             }
+        } catch (error) {
+            console.error('Error updating stream statuses:', error);
         }
     }
 
@@ -297,8 +309,8 @@ class StreamDashboard {
             const response = await fetch(`/stream/${streamId}/status`);
             const streamData = await response.json();
 
-            if (streamData.status === 'running') {
-                this.loadLivePreview(streamId);
+            if (streamData.status === 'running' && streamData.hls_url) {
+                this.loadLivePreview(streamId, streamData.hls_url);
             } else {
                 this.showOfflinePreview(streamId);
             }
@@ -308,7 +320,7 @@ class StreamDashboard {
         }
     }
 
-    async loadLivePreview(streamId) {
+    async loadLivePreview(streamId, hlsUrl) {
         const video = document.getElementById(`preview-${streamId}`);
         const liveIndicator = document.querySelector(`[data-stream-id="${streamId}"] .live-indicator`);
         const offlineMessage = document.querySelector(`[data-stream-id="${streamId}"] .stream-offline-message`);
@@ -316,9 +328,8 @@ class StreamDashboard {
         if (!video) return;
 
         try {
-            // Try to load HLS stream for preview
-            const hlsUrl = `/static/streams/hls/stream_${streamId}_720p.m3u8`;
-            
+            // Master playlist comes from the stream's outputs, as CMAF and
+            // separate packaging write it to different paths
             if (Hls.isSupported()) {
                 let hls = this.livePreviewPlayers.get(streamId);
                 if (hls) {
@@ -4,10 +4,12 @@ class StreamPlayer {
     constructor() {
         this.player = null;
         this.currentFormat = 'hls';
-        this.currentQuality = '';
+        this.currentQuality = 'auto';
         this.embedInfo = null;
         this.statsChart = null;
         this.statsInterval = null;
+        this.qoe = null;
+        this.qoeInterval = null;
     }
 
     initialize(embedInfo) {
@@ -40,6 +42,7 @@ class StreamPlayer {
 
         this.player.ready(() => {
             console.log('Player is ready');
+            this.startQoEReporting();
             this.loadInitialStream();
             this.setupEventListeners();
         });
@@ -91,32 +94,30 @@ class StreamPlayer {
         const hlsUrls = this.embedInfo.hls_urls;
         if (hlsUrls.length === 0) return;
 
-        // Start with highest quality available
-        const selectedUrl = hlsUrls.find(url => url.quality === this.currentQuality) || hlsUrls[0];
-        this.currentQuality = selectedUrl.quality;
+        // The master playlist lists every rendition; the player picks one
+        const selectedUrl = hlsUrls[0];
 
         this.player.src({
             src: selectedUrl.url,
             type: 'application/x-mpegURL'
         });
 
-        console.log(`Loading HLS stream: ${selectedUrl.url} (${selectedUrl.quality})`);
+        console.log(`Loading HLS stream: ${selectedUrl.url}`);
     }
 
     loadDASHStream() {
         const dashUrls = this.embedInfo.dash_urls;
         if (dashUrls.length === 0) return;
 
-        // Start with highest quality available
-        const selectedUrl = dashUrls.find(url => url.quality === this.currentQuality) || dashUrls[0];
-        this.currentQuality = selectedUrl.quality;
+        // The MPD carries every representation; the player picks one
+        const selectedUrl = dashUrls[0];
 
         this.player.src({
             src: selectedUrl.url,
             type: 'application/dash+xml'
         });
 
-        console.log(`Loading DASH stream: ${selectedUrl.url} (${selectedUrl.quality})`);
+        console.log(`Loading DASH stream: ${selectedUrl.url}`);
     }
 
     updateFormatSelector() {
@@ -148,17 +149,29 @@ class StreamPlayer {
 
         qualitySelect.innerHTML = '';
 
-        const urls = this.currentFormat === 'hls' ? this.embedInfo.hls_urls : this.embedInfo.dash_urls;
-        
-        urls.forEach(url => {
+        const qualities = ['auto'].concat((this.embedInfo.renditions || []).map(rendition => rendition.quality));
+
+        qualities.forEach(quality => {
             const option = document.createElement('option');
-            option.value = url.quality;
-            option.textContent = url.quality;
-            option.selected = url.quality === this.currentQuality;
+            option.value = quality;
+            option.textContent = quality === 'auto' ? 'Auto' : quality;
+            option.selected = quality === this.currentQuality;
             qualitySelect.appendChild(option);
         });
     }
 
+    applyQuality() {
+        // Restrict adaptive switching to one rendition, or allow all for auto
+        if (typeof this.player.qualityLevels !== 'function') return;
+
+        const rendition = (this.embedInfo.renditions || []).find(r => r.quality === this.currentQuality);
+        const levels = this.player.qualityLevels();
+
+        for (let i = 0; i < levels.length; i++) {
+            levels[i].enabled = !rendition || levels[i].height === rendition.height;
+        }
+    }
+
     switchFormat() {
         const formatSelect = document.getElementById('formatSelect');
         const newFormat = formatSelect.value;
@@ -193,24 +206,9 @@ class StreamPlayer {
 
         if (newQuality === this.currentQuality) return;
 
-        const currentTime = this.player.currentTime();
-        const wasPlaying = !this.player.paused();
-
+        // Renditions live in one manifest, so switching needs no reload
         this.currentQuality = newQuality;
-
-        if (this.currentFormat === 'hls') {
-            this.loadHLSStream();
-        } else if (this.currentFormat === 'dash') {
-            this.loadDASHStream();
-        }
-
-        // Restore playback position
-        this.player.ready(() => {
-            this.player.currentTime(currentTime);
-            if (wasPlaying) {
-                this.player.play();
-            }
-        });
+        this.applyQuality();
     }
 
     toggleFullscreen() {
@@ -249,6 +247,13 @@ class StreamPlayer {
             console.log('Quality changed');
         });
 
+        // Re-apply a pinned quality when a new manifest loads its levels
+        if (typeof this.player.qualityLevels === 'function') {
+            this.player.qualityLevels().on('addqualitylevel', () => {
+                this.applyQuality();
+            });
+        }
+
         // Network state changes
         this.player.on('waiting', () => {
             console.log('Player is waiting for data');
@@ -259,6 +264,101 @@ class StreamPlayer {
         });
     }
 
+    startQoEReporting() {
+        // Playback events are batched and beaconed to the server every 10 seconds
+        this.qoe = {
+            events: [],
+            loadStart: performance.now(),
+            started: false,
+            waitingSince: null,
+            playingSince: null,
+            droppedFrames: 0
+        };
+
+        this.player.on('playing', () => {
+            const now = performance.now();
+            if (!this.qoe.started) {
+                this.qoe.started = true;
+                this.queueQoEEvent('startup', now - this.qoe.loadStart);
+            } else if (this.qoe.waitingSince !== null) {
+                this.queueQoEEvent('rebuffer', now - this.qoe.waitingSince);
+            }
+            this.qoe.waitingSince = null;
+            this.qoe.playingSince = now;
+        });
+
+        // Waiting after a seek is not a stall
+        this.player.on('waiting', () => {
+            if (!this.qoe.started || this.qoe.waitingSince !== null || this.player.seeking()) return;
+            this.recordPlayTime();
+            this.qoe.waitingSince = performance.now();
+        });
+
+        this.player.on('pause', () => {
+            this.recordPlayTime();
+        });
+
+        if (typeof this.player.qualityLevels === 'function') {
+            this.player.qualityLevels().on('change', () => {
+                this.queueQoEEvent('switch', 1);
+            });
+        }
+
+        this.qoeInterval = setInterval(() => {
+            this.sendQoE();
+        }, 10000);
+    }
+
+    currentRendition() {
+        if (typeof this.player.qualityLevels !== 'function') return null;
+
+        const levels = this.player.qualityLevels();
+        const level = levels[levels.selectedIndex];
+        return level && level.height ? `${level.height}p` : null;
+    }
+
+    queueQoEEvent(type, value) {
+        this.qoe.events.push({type: type, value: Math.round(value), rendition: this.currentRendition()});
+    }
+
+    recordPlayTime() {
+        if (this.qoe.playingSince === null) return;
+
+        this.queueQoEEvent('play', performance.now() - this.qoe.playingSince);
+        this.qoe.playingSince = null;
+    }
+
+    sendQoE() {
+        if (!this.qoe || !this.embedInfo) return;
+
+        // Play time is reported in slices while playback continues
+        if (this.qoe.playingSince !== null) {
+            this.recordPlayTime();
+            this.qoe.playingSince = performance.now();
+        }
+
+        const video = this.player.el().querySelector('video');
+        if (video && typeof video.getVideoPlaybackQuality === 'function') {
+            const dropped = video.getVideoPlaybackQuality().droppedVideoFrames;
+            if (dropped > this.qoe.droppedFrames) {
+                this.queueQoEEvent('dropped_frames', dropped - this.qoe.droppedFrames);
+                this.qoe.droppedFrames = dropped;
+            }
+        }
+
+        if (this.qoe.events.length === 0) return;
+
+        const url = `/stream/${this.embedInfo.stream_id}/qoe`;
+        const body = JSON.stringify({events: this.qoe.events});
+        this.qoe.events = [];
+
+        if (navigator.sendBeacon) {
+            navigator.sendBeacon(url, body);
+        } else {
+            fetch(url, {method: 'POST', body: body, keepalive: true}).catch(() => {});
+        }
+    }
+
     handlePlayerError(error) {
         const errorCode = error.code || (this.player.error() && this.player.error().code);
         
@@ -316,13 +416,53 @@ class StreamPlayer {
 
     startStatsUpdates() {
         this.setupStatsChart();
-        
+        this.updateLiveStats();
+
+        if (!window.EventSource || !this.embedInfo) {
+            this.startStatsPolling();
+            return;
+        }
+
+        // Stats arrive as deltas: fields missing from an event are unchanged
+        this.lastStats = {};
+        this.eventSource = new EventSource(`/events?streams=${this.embedInfo.stream_id}`);
+        this.eventSource.addEventListener('stats', (event) => {
+            this.lastStats = Object.assign({}, this.lastStats, JSON.parse(event.data));
+            this.addStatsPoint(this.lastStats);
+        });
+        this.eventSource.onerror = () => {
+            // EventSource retries by itself unless the server refused the feed
+            if (this.eventSource.readyState !== EventSource.CLOSED) return;
+            this.eventSource = null;
+            this.startStatsPolling();
+        };
+    }
+
+    startStatsPolling() {
+        if (this.statsInterval) return;
+
         // Update stats every 10 seconds
         this.statsInterval = setInterval(() => {
             this.updateLiveStats();
         }, 10000);
     }
 
+    addStatsPoint(stat) {
+        if (!this.statsChart) return;
+
+        const data = this.statsChart.data;
+        data.labels.push(new Date(stat.timestamp + 'Z').toLocaleTimeString());
+        data.datasets[0].data.push(stat.bitrate);
+        data.datasets[1].data.push(stat.frame_rate);
+
+        // Keep the latest 20 data points
+        if (data.labels.length > 20) {
+            data.labels.shift();
+            data.datasets.forEach(dataset => dataset.data.shift());
+        }
+        this.statsChart.update('none');
+    }
+
     setupStatsChart() {
         const canvas = document.getElementById('liveStatsChart');
         if (!canvas) return;
@@ -428,6 +568,15 @@ class StreamPlayer {
         if (this.statsInterval) {
             clearInterval(this.statsInterval);
         }
+
+        if (this.eventSource) {
+            this.eventSource.close();
+        }
+
+        if (this.qoeInterval) {
+            clearInterval(this.qoeInterval);
+        }
+        this.sendQoE();
         
         if (this.statsChart) {
             this.statsChart.destroy();
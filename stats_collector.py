@@ -0,0 +1,156 @@
+import time
+import threading
+import logging
+from collections import deque
+from datetime import datetime
+from event_bus import event_bus
+from viewer_analytics import viewer_analytics
+from config import STATS_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+def parse_progress_time(value):
+    """Parse ffmpeg's out_time (HH:MM:SS.micro) into seconds"""
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return 0.0
+
+def parse_number(value, suffix=''):
+    """Parse numbers such as '2000.5kbits/s', '1.02x' or 'N/A'"""
+    value = value.strip()
+    if suffix and value.endswith(suffix):
+        value = value[:-len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+class StatsCollector:
+    """Encoder statistics from ffmpeg's -progress output.
+    
+    Every progress block becomes one sample in a per-stream ring buffer that
+    serves the live stats API. One sample per stream every persist_interval
+    seconds is queued and written to StreamStats in a single bulk insert by
+    a background flusher, so no database work happens on the output path.
+    """
+    
+    def __init__(self):
+        self.samples = {}
+        self.blocks = {}
+        self.last_persisted = {}
+        self.viewers = {}
+        self.pending = []
+        self.lock = threading.Lock()
+        self.flush_thread = None
+        self.app = None
+    
+    def start(self, app):
+        """Start the background flusher (idempotent)"""
+        with self.lock:
+            if self.flush_thread and self.flush_thread.is_alive():
+                return
+            
+            self.app = app
+            self.flush_thread = threading.Thread(target=self._flush_loop, name='stats-flush')
+            self.flush_thread.daemon = True
+            self.flush_thread.start()
+    
+    def handle_progress_line(self, stream_id, line):
+        """Feed one key=value line of ffmpeg -progress output"""
+        key, separator, value = line.partition('=')
+        if not separator:
+            return
+        
+        block = self.blocks.setdefault(stream_id, {})
+        block[key.strip()] = value.strip()
+        
+        # 'progress' terminates each block
+        if key.strip() == 'progress':
+            del self.blocks[stream_id]
+            self._record(stream_id, block)
+    
+    def _record(self, stream_id, block):
+        sample = {
+            'timestamp': datetime.utcnow(),
+            'frame': int(parse_number(block.get('frame', '0'))),
+            'frame_rate': parse_number(block.get('fps', '0')),
+            'bitrate': parse_number(block.get('bitrate', '0'), 'kbits/s'),
+            'speed': parse_number(block.get('speed', '0'), 'x'),
+            'dropped_frames': int(parse_number(block.get('drop_frames', '0'))),
+            'duplicate_frames': int(parse_number(block.get('dup_frames', '0'))),
+            'out_time': parse_progress_time(block.get('out_time', '0:0:0'))
+        }
+        
+        now = time.monotonic()
+        with self.lock:
+            persist = now - self.last_persisted.get(stream_id, 0) >= STATS_SETTINGS['persist_interval']
+            if persist:
+                self.last_persisted[stream_id] = now
+        
+        # Merging the viewer sketches takes milliseconds on the supervisor
+        # thread, so only persisted samples count viewers; the rest repeat it
+        if persist:
+            self.viewers[stream_id] = viewer_analytics.concurrent(stream_id)
+        sample['viewers'] = self.viewers.get(stream_id, 0)
+        
+        with self.lock:
+            ring = self.samples.get(stream_id)
+            if ring is None:
+                ring = self.samples[stream_id] = deque(maxlen=STATS_SETTINGS['ring_size'])
+            ring.append(sample)
+            if persist:
+                self.pending.append(dict(sample, stream_id=stream_id))
+        
+        event_bus.publish_stats(stream_id, sample)
+    
+    def latest(self, stream_id):
+        """Most recent sample of a stream, or None"""
+        ring = self.samples.get(stream_id)
+        return ring[-1] if ring else None
+    
+    def recent(self, stream_id, limit=None):
+        """Samples in the ring buffer, oldest first"""
+        with self.lock:
+            samples = list(self.samples.get(stream_id, ()))
+        return samples[-limit:] if limit else samples
+    
+    def clear(self, stream_id):
+        """Forget in-memory state of a stopped stream; queued rows are kept"""
+        with self.lock:
+            self.samples.pop(stream_id, None)
+            self.blocks.pop(stream_id, None)
+            self.last_persisted.pop(stream_id, None)
+            self.viewers.pop(stream_id, None)
+    
+    def _flush_loop(self):
+        while True:
+            time.sleep(STATS_SETTINGS['flush_interval'])
+            self.flush()
+    
+    def flush(self):
+        """Write queued samples to StreamStats in one bulk insert"""
+        # Imported here so ffmpeg_service can use the collector without
+        # pulling in the Flask app
+        from models import StreamStats, db
+        
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if not rows:
+            return 0
+        
+        for row in rows:
+            row.pop('frame', None)
+        
+        try:
+            with self.app.app_context():
+                db.session.execute(db.insert(StreamStats), rows)
+                db.session.commit()
+            return len(rows)
+        except Exception as e:
+            logger.error(f"Error writing {len(rows)} stream stats rows: {e}")
+            return 0
+
+# Global stats collector instance
+stats_collector = StatsCollector()
@@ -0,0 +1,272 @@
+import time
+import threading
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import Stream, StreamStats, StreamStatsRollup, db
+from config import STATS_RETENTION, STATS_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Metrics rolled up as min/avg/max
+ROLLUP_METRICS = ('viewers', 'bitrate', 'frame_rate', 'packet_loss')
+
+EPOCH = datetime(1970, 1, 1)
+
+def floor_time(value, resolution):
+    """Round a naive UTC datetime down to a multiple of resolution seconds"""
+    seconds = int((value - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+class StatsCompactor:
+    """Maintains StreamStats retention and min/avg/max rollups.
+    
+    Each rollup level in STATS_RETENTION is built from the level before it
+    (raw rows for the first), one closed time window at a time. A
+    per-level watermark marks how far compaction has got; source rows are
+    only pruned once they are past retention and behind the next level's
+    watermark. All queries are per stream so they stay on the
+    (stream_id, timestamp) / (stream_id, resolution, bucket_start) indexes.
+    """
+    
+    def __init__(self):
+        self.watermarks = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.app = None
+    
+    def start(self, app):
+        """Start the background compactor (idempotent)"""
+        with self.lock:
+            if self.thread and self.thread.is_alive():
+                return
+            
+            self.app = app
+            self.thread = threading.Thread(target=self._compact_loop, name='stats-compactor')
+            self.thread.daemon = True
+            self.thread.start()
+    
+    def _compact_loop(self):
+        while True:
+            time.sleep(STATS_RETENTION['compact_interval'])
+            try:
+                with self.app.app_context():
+                    self.run_once()
+            except Exception as e:
+                logger.error(f"Error compacting stream stats: {e}")
+    
+    def run_once(self, now=None):
+        """Compact every level up to now and prune expired rows"""
+        now = now or datetime.utcnow()
+        stream_ids = [stream_id for (stream_id,) in db.session.query(Stream.id)]
+        
+        with self.lock:
+            source = None
+            source_until = now - timedelta(seconds=STATS_RETENTION['settle_time'])
+            for level in STATS_RETENTION['rollups']:
+                resolution = level['resolution']
+                # Compact window by window until the level has caught up
+                while source_until is not None:
+                    watermark = self.watermarks.get(resolution)
+                    compacted = self._compact_level(resolution, source, source_until, stream_ids)
+                    if compacted is None or compacted == watermark:
+                        break
+                source = resolution
+                source_until = self.watermarks.get(resolution)
+            
+            self._prune(now, stream_ids)
+    
+    def _compact_level(self, resolution, source, source_until, stream_ids):
+        """Roll one window of source data into resolution buckets"""
+        watermark = self._watermark(resolution, source)
+        if watermark is None:
+            return None
+        
+        window_end = watermark + timedelta(seconds=STATS_RETENTION['max_window'])
+        end = floor_time(min(source_until, window_end), resolution)
+        if end <= watermark:
+            return watermark
+        
+        rows = []
+        for stream_id in stream_ids:
+            rows.extend(self._aggregate(stream_id, source, resolution, watermark, end))
+        
+        if rows:
+            db.session.execute(db.insert(StreamStatsRollup), rows)
+        db.session.commit()
+        
+        self.watermarks[resolution] = end
+        return end
+    
+    def _watermark(self, resolution, source):
+        """Start of the first bucket not compacted yet"""
+        if resolution in self.watermarks:
+            return self.watermarks[resolution]
+        
+        latest = db.session.query(func.max(StreamStatsRollup.bucket_start))\
+            .filter(StreamStatsRollup.resolution == resolution).scalar()
+        if latest:
+            watermark = latest + timedelta(seconds=resolution)
+        else:
+            if source is None:
+                earliest = db.session.query(func.min(StreamStats.timestamp)).scalar()
+            else:
+                earliest = db.session.query(func.min(StreamStatsRollup.bucket_start))\
+                    .filter(StreamStatsRollup.resolution == source).scalar()
+            if earliest is None:
+                return None
+            watermark = floor_time(earliest, resolution)
+        
+        self.watermarks[resolution] = watermark
+        return watermark
+    
+    def _aggregate(self, stream_id, source, resolution, start, end):
+        if source is None:
+            table = StreamStats
+            time_column = StreamStats.timestamp
+            columns = [func.count(StreamStats.id)]
+            for metric in ROLLUP_METRICS:
+                column = getattr(StreamStats, metric)
+                columns.extend([func.min(column), func.avg(column), func.max(column)])
+            query = db.session.query(StreamStats)
+        else:
+            table = StreamStatsRollup
+            time_column = StreamStatsRollup.bucket_start
+            samples = func.sum(StreamStatsRollup.samples)
+            columns = [samples]
+            for metric in ROLLUP_METRICS:
+                columns.extend([
+                    func.min(getattr(StreamStatsRollup, f'{metric}_min')),
+                    func.sum(getattr(StreamStatsRollup, f'{metric}_avg') * StreamStatsRollup.samples) / samples,
+                    func.max(getattr(StreamStatsRollup, f'{metric}_max'))
+                ])
+            query = db.session.query(StreamStatsRollup).filter(StreamStatsRollup.resolution == source)
+        
+        epoch = self._epoch_expression(time_column)
+        bucket = (epoch - epoch % resolution).label('bucket')
+        query = query.with_entities(bucket, *columns)\
+            .filter(table.stream_id == stream_id, time_column >= start, time_column < end)\
+            .group_by(bucket)
+        
+        rows = []
+        for result in query:
+            if not result[1]:
+                continue
+            row = {
+                'stream_id': stream_id,
+                'resolution': resolution,
+                'bucket_start': EPOCH + timedelta(seconds=int(result[0])),
+                'samples': int(result[1])
+            }
+            for index, metric in enumerate(ROLLUP_METRICS):
+                low, mean, high = result[2 + index * 3:5 + index * 3]
+                row[f'{metric}_min'] = float(low or 0)
+                row[f'{metric}_avg'] = float(mean or 0)
+                row[f'{metric}_max'] = float(high or 0)
+            rows.append(row)
+        return rows
+    
+    def _epoch_expression(self, column):
+        """SQL expression for a DateTime column as integer Unix seconds"""
+        dialect = db.engine.dialect.name
+        if dialect == 'sqlite':
+            return db.cast(func.strftime('%s', column), db.Integer)
+        if dialect == 'postgresql':
+            return db.cast(func.extract('epoch', column), db.BigInteger)
+        if dialect in ('mysql', 'mariadb'):
+            return func.unix_timestamp(column)
+        raise ValueError(f"Stats rollups are not supported on {dialect}")
+    
+    def _prune(self, now, stream_ids):
+        """Delete rows past retention that the next level already covers"""
+        levels = STATS_RETENTION['rollups']
+        raw_cutoff = now - timedelta(seconds=STATS_RETENTION['raw'])
+        raw_cutoff = min(raw_cutoff, self.watermarks.get(levels[0]['resolution']) or EPOCH)
+        
+        cutoffs = []
+        for position, level in enumerate(levels):
+            cutoff = now - timedelta(seconds=level['retention'])
+            if position + 1 < len(levels):
+                cutoff = min(cutoff, self.watermarks.get(levels[position + 1]['resolution']) or EPOCH)
+            cutoffs.append((level['resolution'], cutoff))
+        
+        for stream_id in stream_ids:
+            StreamStats.query.filter(
+                StreamStats.stream_id == stream_id,
+                StreamStats.timestamp < raw_cutoff
+            ).delete(synchronize_session=False)
+            
+            for resolution, cutoff in cutoffs:
+                StreamStatsRollup.query.filter(
+                    StreamStatsRollup.stream_id == stream_id,
+                    StreamStatsRollup.resolution == resolution,
+                    StreamStatsRollup.bucket_start < cutoff
+                ).delete(synchronize_session=False)
+        
+        db.session.commit()
+    
+    def pick_resolution(self, start, end, now=None):
+        """Finest level that still holds start and fits max_points.
+        
+        Returns None for raw samples or a rollup resolution in seconds.
+        """
+        now = now or datetime.utcnow()
+        span = (end - start).total_seconds()
+        
+        levels = [(None, STATS_SETTINGS['persist_interval'], STATS_RETENTION['raw'])]
+        levels += [(level['resolution'], level['resolution'], level['retention'])
+                   for level in STATS_RETENTION['rollups']]
+        
+        chosen = levels[-1][0]
+        for resolution, step, retention in levels:
+            if start < now - timedelta(seconds=retention):
+                continue
+            chosen = resolution
+            if span / step <= STATS_RETENTION['max_points']:
+                break
+        return chosen
+    
+    def query_range(self, stream_id, start, end):
+        """Stats between start and end at an automatically chosen resolution"""
+        resolution = self.pick_resolution(start, end)
+        limit = STATS_RETENTION['max_points'] * 2
+        
+        if resolution is None:
+            stats = StreamStats.query.filter(
+                StreamStats.stream_id == stream_id,
+                StreamStats.timestamp >= start,
+                StreamStats.timestamp < end
+            ).order_by(StreamStats.timestamp).limit(limit).all()
+            
+            points = [{
+                'timestamp': stat.timestamp,
+                'viewers': stat.viewers,
+                'bitrate': stat.bitrate,
+                'frame_rate': stat.frame_rate,
+                'packet_loss': stat.packet_loss,
+                'speed': stat.speed,
+                'dropped_frames': stat.dropped_frames,
+                'duplicate_frames': stat.duplicate_frames,
+                'out_time': stat.out_time
+            } for stat in stats]
+            return 'raw', points
+        
+        buckets = StreamStatsRollup.query.filter(
+            StreamStatsRollup.stream_id == stream_id,
+            StreamStatsRollup.resolution == resolution,
+            StreamStatsRollup.bucket_start >= floor_time(start, resolution),
+            StreamStatsRollup.bucket_start < end
+        ).order_by(StreamStatsRollup.bucket_start).limit(limit).all()
+        
+        points = []
+        for bucket in buckets:
+            point = {'timestamp': bucket.bucket_start, 'samples': bucket.samples}
+            for metric in ROLLUP_METRICS:
+                point[metric] = getattr(bucket, f'{metric}_avg')
+                point[f'{metric}_min'] = getattr(bucket, f'{metric}_min')
+                point[f'{metric}_max'] = getattr(bucket, f'{metric}_max')
+            points.append(point)
+        return resolution, points
+
+# Global stats compactor instance
+stats_compactor = StatsCompactor()
@@ -1,9 +1,26 @@
 import logging
 import json
+import math
+import os
 from datetime import datetime
 from models import Stream, StreamOutput, StreamStats, StreamDestination, db
-from ffmpeg_service import ffmpeg_service
-from config import QUALITY_PROFILES, PLATFORM_ENDPOINTS
+from ffmpeg_service import ffmpeg_service, PIPE_INPUT
+from llhls import ll_hls_service
+from dvr import dvr_service
+from recording import recorder
+from clip_export import clip_exporter
+from event_bus import event_bus
+from viewer_analytics import viewer_analytics
+from stream_registry import stream_registry
+from segment_storage import segment_storage
+from stats_collector import stats_collector
+from stats_retention import stats_compactor
+from relay_service import relay_service
+from media_probe import media_probe
+from admission_control import admission_controller
+from cluster import coordinator
+from config import (QUALITY_PROFILES, PLATFORM_ENDPOINTS, PACKAGING_MODE, LL_HLS_SETTINGS, CLUSTER_SETTINGS,
+                    DVR_SETTINGS, CLIP_SETTINGS)
 from app import app
 
 logger = logging.getLogger(__name__)
@@ -21,6 +38,7 @@ class StreamManager:
                 input_type=input_type,
                 latency_mode=kwargs.get('latency_mode', 'low'),
                 record_enabled=kwargs.get('record_enabled', False),
+                dvr_window=kwargs.get('dvr_window', 0),
                 video_codec=kwargs.get('video_codec', 'h264'),
                 audio_codec=kwargs.get('audio_codec', 'aac'),
                 bitrate_mode=kwargs.get('bitrate_mode', 'cbr'),
@@ -41,47 +59,140 @@ class StreamManager:
             db.session.rollback()
             return None
     
-    def start_stream(self, stream_id):
-        """Start streaming for a specific stream"""
+    def start_stream(self, stream_id, input_url=None):
+        """Start streaming for a specific stream.
+
+        input_url overrides the stored input, e.g. PIPE_INPUT when the
+        native RTMP server feeds the transcoder directly. Channels that do
+        not fit the encode capacity are queued (status 'queued') or
+        refused, see admission_control. In coordinator mode pulled inputs
+        are encoded on a worker, see cluster.
+        """
         try:
+            # Repeated publish callbacks are answered from the registry
+            record = stream_registry.get(stream_id)
+            if not record:
+                logger.error(f"Stream {stream_id} not found")
+                return False
+            
+            # A stream left 'running' by an encoder that exited for good (or
+            # by a previous run of the app) is started again
+            if record.status == 'running':
+                if self._has_encoder(stream_id):
+                    logger.warning(f"Stream {stream_id} is already running")
+                    return True
+                logger.warning(f"Stream {stream_id} is marked running but has no encoder, starting it")
+            
             stream = Stream.query.get(stream_id)
             if not stream:
                 logger.error(f"Stream {stream_id} not found")
                 return False
             
-            if stream.status == 'running':
-                logger.warning(f"Stream {stream_id} is already running")
-                return True
-            
             # Build output configurations
             output_configs = self._build_output_configs(stream)
+            input_url = input_url or stream.input_url
             
-            # Start FFmpeg process
-            success = ffmpeg_service.start_stream(
-                stream_id,
-                stream.input_url,
-                output_configs
-            )
+            if CLUSTER_SETTINGS['mode'] == 'coordinator' and input_url != PIPE_INPUT:
+                self.start_coordinator()
+                stream.worker_id = coordinator.assign(stream_id, {
+                    'input_url': input_url,
+                    'output_configs': output_configs,
+                    'destinations': stream.get_destinations(),
+                    'probe_key': stream.input_url
+                })
+                if stream.worker_id:
+                    result = 'start'
+                else:
+                    result = 'queue' if coordinator.is_pending(stream_id) else 'failed'
+            else:
+                stream.worker_id = None
+                result = self.launch_encoder(
+                    stream_id,
+                    input_url,
+                    output_configs,
+                    stream.get_destinations(),
+                    stream.input_url,
+                    queueable=input_url != PIPE_INPUT
+                )
             
-            if success:
+            if result == 'start':
                 stream.status = 'running'
                 stream.updated_at = datetime.utcnow()
                 db.session.commit()
+                event_bus.publish_status(stream_id, 'running', worker_id=stream.worker_id)
                 
-                # Start statistics collection
-                self._start_stats_collection(stream_id)
+                stats_compactor.start(app)
+                self._start_ll_hls(stream_id, stream, output_configs)
+                self._start_dvr(stream_id, stream, output_configs)
+                self._start_recording(stream_id, stream, output_configs)
+                self._start_analytics(stream_id, output_configs)
                 
                 logger.info(f"Started stream {stream_id}")
                 return True
             else:
-                stream.status = 'error'
+                stream.status = 'queued' if result == 'queue' else 'error'
                 db.session.commit()
-                return False
+                event_bus.publish_status(stream_id, stream.status)
+                return result == 'queue'
                 
         except Exception as e:
             logger.error(f"Error starting stream {stream_id}: {e}")
             return False
     
+    def _has_encoder(self, stream_id):
+        """Whether this host or a cluster worker runs the stream's encoder"""
+        if stream_id in ffmpeg_service.active_streams:
+            return True
+        return CLUSTER_SETTINGS['mode'] == 'coordinator' and coordinator.is_assigned(stream_id)
+    
+    def launch_encoder(self, stream_id, input_url, output_configs, destinations, probe_key, queueable=True):
+        """Start a stream's encoder, fan-outs and relays on this host.
+        
+        Used for local streams and by worker agents. probe_key caches the
+        input probe. Returns 'start', 'queue', 'reject' or 'failed'.
+        """
+        try:
+            output_configs = output_configs + self._open_fanouts(stream_id, destinations)
+            passthrough = self._probe_passthrough(stream_id, probe_key, input_url, output_configs)
+            
+            # Reserve encode capacity, possibly at a faster preset
+            admission_controller.start(app, self.start_stream)
+            decision = admission_controller.admit(
+                stream_id,
+                ffmpeg_service._build_ladder(output_configs),
+                passthrough,
+                input_url,
+                queueable=queueable
+            )
+            if decision['action'] != 'start':
+                relay_service.close_stream(stream_id)
+                return decision['action']
+            
+            # Start FFmpeg process
+            success = ffmpeg_service.start_stream(
+                stream_id,
+                input_url,
+                output_configs,
+                passthrough,
+                decision['preset']
+            )
+            if not success:
+                relay_service.close_stream(stream_id)
+                admission_controller.release(stream_id)
+                return 'failed'
+            
+            # Start statistics collection
+            self._start_stats_collection(stream_id)
+            
+            relay_service.sync_destinations(stream_id, destinations, self._fanout_resolver(stream_id))
+            return 'start'
+            
+        except Exception as e:
+            logger.error(f"Error launching encoder for stream {stream_id}: {e}")
+            relay_service.close_stream(stream_id)
+            admission_controller.release(stream_id)
+            return 'failed'
+    
     def stop_stream(self, stream_id):
         """Stop streaming for a specific stream"""
         try:
@@ -90,13 +201,31 @@ class StreamManager:
                 logger.error(f"Stream {stream_id} not found")
                 return False
             
-            # Stop FFmpeg process
-            success = ffmpeg_service.stop_stream(stream_id)
+            # A queued stream has no encoder yet
+            if admission_controller.is_queued(stream_id) or coordinator.is_pending(stream_id):
+                admission_controller.release(stream_id)
+                coordinator.release(stream_id)
+                stream.status = 'stopped'
+                db.session.commit()
+                event_bus.publish_status(stream_id, 'stopped')
+                return True
+            
+            if stream.worker_id:
+                success = coordinator.release(stream_id)
+            else:
+                success = self.stop_encoder(stream_id)
+            ll_hls_service.unregister(stream_id)
+            dvr_service.unregister(stream_id)
+            segment_storage.clear_retention(stream_id)
+            recorder.stop(stream_id)
+            viewer_analytics.clear(stream_id)
             
             if success:
                 stream.status = 'stopped'
+                stream.worker_id = None
                 stream.updated_at = datetime.utcnow()
                 db.session.commit()
+                event_bus.publish_status(stream_id, 'stopped')
                 
                 logger.info(f"Stopped stream {stream_id}")
                 return True
@@ -107,6 +236,38 @@ class StreamManager:
             logger.error(f"Error stopping stream {stream_id}: {e}")
             return False
     
+    def stop_encoder(self, stream_id):
+        """Stop a stream's encoder and relays on this host"""
+        # Stop relays first so they are not restarted when the fan-out ends
+        relay_service.close_stream(stream_id)
+        
+        # Stop FFmpeg process
+        success = ffmpeg_service.stop_stream(stream_id)
+        stats_collector.clear(stream_id)
+        admission_controller.release(stream_id)
+        return success
+    
+    def live_stream_ids(self):
+        """Streams whose live output must be kept"""
+        ids = {stream_id for (stream_id,) in db.session.query(Stream.id)
+               .filter(Stream.status.in_(('running', 'queued')))}
+        return ids | set(ffmpeg_service.list_active_streams())
+    
+    def start_coordinator(self):
+        """Start watching workers so lost streams are reassigned"""
+        coordinator.start(app, self._reassign_stream)
+    
+    def _reassign_stream(self, stream_id):
+        """Start a stream again after its worker was lost"""
+        stream = Stream.query.get(stream_id)
+        if not stream or stream.status not in ('running', 'queued'):
+            return
+        
+        if stream.worker_id:
+            logger.info(f"Reassigning stream {stream_id} from worker {stream.worker_id}")
+        stream.status = 'stopped'
+        self.start_stream(stream_id)
+    
     def update_stream_destinations(self, stream_id, destinations):
         """Update RTMP destinations for a stream"""
         try:
@@ -117,24 +278,55 @@ class StreamManager:
             stream.set_destinations(destinations)
             db.session.commit()
             
-            # If stream is running, restart with new destinations
-            if stream.status == 'running':
-                self.stop_stream(stream_id)
-                self.start_stream(stream_id)
+            if stream.status != 'running':
+                return True
             
-            return True
+            # Relays are swapped individually; the encoder keeps running
+            if stream.worker_id:
+                result = coordinator.update_destinations(stream_id, destinations)
+            else:
+                result = self.sync_encoder_destinations(stream_id, destinations)
+            if result is not None:
+                return result
+            
+            # Started without destinations, so the encoder has no fan-out yet
+            logger.info(f"Restarting stream {stream_id} to add a relay fan-out")
+            self.stop_stream(stream_id)
+            return self.start_stream(stream_id)
             
         except Exception as e:
             logger.error(f"Error updating destinations for stream {stream_id}: {e}")
             return False
     
+    def sync_encoder_destinations(self, stream_id, destinations):
+        """Swap the relays of an encoder on this host; None if it has no fan-out"""
+        if not relay_service.fanout_resolutions(stream_id):
+            return None
+        return relay_service.sync_destinations(stream_id, destinations, self._fanout_resolver(stream_id))
+    
     def _create_default_outputs(self, stream_id, qualities):
-        """Create default HLS and DASH outputs for stream"""
+        """Create default outputs for stream.
+
+        In CMAF packaging mode every quality is a rendition of one per-stream
+        fMP4 package served by a master playlist and a multi-representation
+        MPD; otherwise separate HLS playlists and one shared DASH MPD are made.
+        """
         try:
             for quality in qualities:
                 if quality not in QUALITY_PROFILES:
                     continue
                 
+                if PACKAGING_MODE == 'cmaf':
+                    cmaf_output = StreamOutput(
+                        stream_id=stream_id,
+                        format_type='cmaf',
+                        resolution=quality,
+                        bitrate=QUALITY_PROFILES[quality]['bitrate'],
+                        output_path=f"{app.config['CMAF_OUTPUT_DIR']}/stream_{stream_id}/stream_{stream_id}.mpd"
+                    )
+                    db.session.add(cmaf_output)
+                    continue
+                
                 # Create HLS output
                 hls_output = StreamOutput(
                     stream_id=stream_id,
@@ -151,7 +343,7 @@ class StreamManager:
                     format_type='dash',
                     resolution=quality,
                     bitrate=QUALITY_PROFILES[quality]['bitrate'],
-                    output_path=f"{app.config['DASH_OUTPUT_DIR']}/stream_{stream_id}_{quality}.mpd"
+                    output_path=f"{app.config['DASH_OUTPUT_DIR']}/stream_{stream_id}.mpd"
                 )
                 db.session.add(dash_output)
             
@@ -165,85 +357,351 @@ class StreamManager:
         """Build FFmpeg output configurations for a stream"""
         configs = []
         
-        # Get stream outputs
-        outputs = StreamOutput.query.filter_by(stream_id=stream.id).all()
-        
-        for output in outputs:
+        for output in stream_registry.get(stream.id).outputs:
             config = {
                 'type': output.format_type,
                 'resolution': output.resolution,
                 'output_path': output.output_path,
                 'latency_mode': stream.latency_mode
             }
+            
+            # The muxer keeps segments for the DVR window instead of deleting them
+            if stream.dvr_window and output.format_type in ('hls', 'cmaf'):
+                config['dvr_window'] = min(stream.dvr_window, DVR_SETTINGS['max_window'])
+            
+            # Renditions sharing a master playlist are listed as its variants
+            if output.format_type == 'cmaf':
+                config['master_path'] = output.get_manifests()['hls']
+                
+                # Low-latency CMAF packages get app-served LL-HLS playlists
+                if ffmpeg_service._resolve_latency_mode(stream.latency_mode) in LL_HLS_SETTINGS:
+                    config['ll_playlist_url'] = f"/stream/{stream.id}/ll"
+            elif output.format_type == 'hls':
+                config['master_path'] = f"{app.config['HLS_OUTPUT_DIR']}/stream_{stream.id}.m3u8"
+            
             configs.append(config)
         
-        # Add RTMP destinations
-        destinations = stream.get_destinations()
+        return configs
+    
+    def _open_fanouts(self, stream_id, destinations):
+        """Fan-out outputs for the renditions the stream's destinations use.
+        
+        RTMP destinations are not encoder outputs: each is a relay fed from
+        one of these, so destinations can change while the encoder runs.
+        """
+        resolutions = set()
         for dest in destinations:
-            if dest.get('enabled', True):
-                config = {
-                    'type': 'rtmp',
-                    'rtmp_url': dest['rtmp_url'],
-                    'stream_key': dest['stream_key'],
-                    'resolution': dest.get('quality', '720p')
-                }
-                configs.append(config)
+            if not dest.get('enabled', True):
+                continue
+            quality = dest.get('quality', '720p')
+            resolutions.add(quality if quality in QUALITY_PROFILES else '720p')
         
-        return configs
+        return [{
+            'type': 'fanout',
+            'resolution': resolution,
+            'fanout_url': relay_service.open_fanout(stream_id, resolution)
+        } for resolution in sorted(resolutions)]
+    
+    def _probe_passthrough(self, stream_id, probe_key, input_url, output_configs):
+        """Decide which input tracks the top rendition can stream-copy.
+        
+        Probe results are cached per stream input. Piped native RTMP
+        publishes cannot be probed up front; they start with what the RTMP
+        server saw of the previous publish, and the server restarts the
+        encoder if its probe of the current publish disagrees.
+        """
+        ladder = ffmpeg_service._build_ladder(output_configs)
+        if not ladder:
+            return None
+        
+        result = media_probe.get_cached(probe_key)
+        if result is None and input_url != PIPE_INPUT:
+            result = media_probe.probe(input_url, cache_key=probe_key)
+        
+        passthrough = media_probe.passthrough_for(
+            result, ladder[0], ffmpeg_service._ladder_keyframe_interval(output_configs)
+        )
+        logger.info(f"Stream {stream_id} passthrough: video={passthrough['video']} audio={passthrough['audio']}")
+        return passthrough
+    
+    def _fanout_resolver(self, stream_id):
+        """Map a destination quality to the closest fan-out rendition.
+        
+        The encoder's fan-outs are fixed when it starts; a destination asking
+        for a quality it does not publish gets the closest one, with a warning.
+        """
+        available = relay_service.fanout_resolutions(stream_id)
+        
+        def resolve(quality):
+            if quality in available:
+                return quality
+            height = QUALITY_PROFILES.get(quality, QUALITY_PROFILES['720p'])['height']
+            resolution = min(available, key=lambda resolution: abs(QUALITY_PROFILES[resolution]['height'] - height))
+            logger.warning(f"Stream {stream_id} has no {quality} rendition to relay, using {resolution}; "
+                           f"restart the stream to add it")
+            return resolution
+        
+        return resolve
+    
+    def _start_ll_hls(self, stream_id, stream, output_configs):
+        """Register low-latency CMAF packages with the LL-HLS service"""
+        configs = [config for config in output_configs if config.get('ll_playlist_url')]
+        if not configs:
+            return
+        
+        package_dir = os.path.dirname(configs[0]['output_path'])
+        resolutions = {config['resolution'] for config in configs}
+        
+        # One representation per video rendition plus the shared audio
+        ll_hls_service.register(
+            stream_id,
+            package_dir,
+            len(resolutions) + 1,
+            ffmpeg_service._resolve_latency_mode(stream.latency_mode),
+            self._media_url(package_dir),
+            configs[0]['ll_playlist_url']
+        )
+    
+    def _media_playlists(self, output_configs):
+        """Media playlists the muxers write for a stream's renditions.
+        
+        Returns (variants, audio): variants are {'resolution',
+        'playlist_path', 'media_url'} ordered highest first, audio the
+        shared audio playlist of a CMAF package or None. A CMAF package is
+        used when there is one, otherwise the separate HLS playlists (audio
+        is muxed into each of those).
+        """
+        ladder = ffmpeg_service._build_ladder(output_configs)
+        
+        for package in ffmpeg_service._group_packages(ladder).values():
+            if package['config']['type'] != 'cmaf':
+                continue
+            package_dir = os.path.dirname(package['config']['output_path'])
+            media_url = self._media_url(package_dir)
+            
+            # The dash muxer writes media_N.m3u8 in package order, audio last
+            variants = [{
+                'resolution': ladder[index]['resolution'],
+                'playlist_path': os.path.join(package_dir, f'media_{position}.m3u8'),
+                'media_url': media_url
+            } for position, index in enumerate(package['indices'])]
+            audio = {
+                'playlist_path': os.path.join(package_dir, f"media_{len(package['indices'])}.m3u8"),
+                'media_url': media_url
+            }
+            return variants, audio
+        
+        variants = []
+        for rendition in ladder:
+            for config in rendition['outputs']:
+                if config['type'] == 'hls':
+                    variants.append({
+                        'resolution': rendition['resolution'],
+                        'playlist_path': config['output_path'],
+                        'media_url': self._media_url(os.path.dirname(config['output_path']))
+                    })
+                    break
+        return variants, None
+    
+    def _start_dvr(self, stream_id, stream, output_configs):
+        """Index a stream's media playlists for its DVR window"""
+        variants, audio = self._media_playlists([config for config in output_configs if config.get('dvr_window')])
+        if not variants:
+            return
+        
+        window = min(stream.dvr_window, DVR_SETTINGS['max_window'])
+        segment_storage.set_retention(stream_id, window)
+        dvr_service.register(stream_id, window, variants, audio)
+    
+    def _start_recording(self, stream_id, stream, output_configs):
+        """Record the top rendition from the segments the muxer writes"""
+        if not stream.record_enabled:
+            return
+        
+        variants, audio = self._media_playlists(output_configs)
+        if not variants:
+            logger.warning(f"Stream {stream_id} has no HLS or CMAF output to record from")
+            return
+        
+        recorder.start(
+            stream_id,
+            app.config['RECORDINGS_DIR'],
+            variants[0]['playlist_path'],
+            audio['playlist_path'] if audio else None
+        )
+    
+    def _start_analytics(self, stream_id, output_configs):
+        """Name the packaged representations viewer analytics reports on"""
+        variants, audio = self._media_playlists(output_configs)
+        viewer_analytics.set_renditions(stream_id, [variant['resolution'] for variant in variants]
+                                        + (['audio'] if audio else []))
     
     def _start_stats_collection(self, stream_id):
         """Start collecting statistics for a stream"""
-        # This would start a background task to collect stream statistics
-        # Implementation would depend on how stats are collected from FFmpeg
-        pass
+        # Samples arrive from the encoder's -progress output; this only makes
+        # sure the batched StreamStats writer is running. Rollups are built
+        # by the node that owns the Stream rows (see start_stream)
+        stats_collector.clear(stream_id)
+        stats_collector.start(app)
+    
+    def export_clip(self, stream_id, start, end):
+        """Cut start..end (Unix times) out of a stream's DVR buffer as an MP4.
+        
+        The covering segments are stream-copied, so the clip begins on the
+        keyframe at or before start. Returns (status, body): body iterates
+        over MP4 chunks on 200 and is an error message otherwise.
+        """
+        try:
+            stream = Stream.query.get(stream_id)
+            if not stream:
+                return 404, 'Stream not found'
+            if end <= start or end - start > CLIP_SETTINGS['max_duration']:
+                return 400, f"Clips must be 0-{CLIP_SETTINGS['max_duration']}s long"
+            
+            tracks = dvr_service.get_segments(stream_id, start, end)
+            if tracks is None:
+                return 409, 'Clips are cut from the DVR buffer; the stream has no DVR window'
+            empty = [index for index, (_, segments) in enumerate(tracks) if not segments]
+            if len(empty) == len(tracks):
+                return 404, 'The range is not in the DVR buffer'
+            if empty:
+                # e.g. the audio rendition lags behind, or was trimmed first
+                return 409, f"The range is only partly in the DVR buffer: track(s) {empty} have no segments in it"
+            
+            # Segments open on a keyframe and the encoder forces one every
+            # interval after that, so a copy can start on any multiple
+            interval = ffmpeg_service._ladder_keyframe_interval(self._build_output_configs(stream))
+            first_start = tracks[0][1][0][1]
+            clip_start = first_start + max(0, math.floor((start - first_start) / interval) * interval)
+            
+            inputs = []
+            for init_path, segments in tracks:
+                paths = ([init_path] if init_path else []) + [path for path, _, _ in segments]
+                inputs.append((paths, max(0.0, clip_start - segments[0][1])))
+            
+            return clip_exporter.export(inputs, end - clip_start)
+            
+        except Exception as e:
+            logger.error(f"Error exporting clip of stream {stream_id}: {e}")
+            return 500, 'Clip export failed'
     
     def get_stream_stats(self, stream_id, limit=100):
-        """Get recent statistics for a stream"""
+        """Get recent statistics for a stream, oldest first.
+        
+        Live streams are served from the in-memory ring buffer; stopped
+        streams fall back to persisted StreamStats rows.
+        """
         try:
+            samples = stats_collector.recent(stream_id, limit)
+            if samples:
+                return [self._format_stats(sample) for sample in samples]
+            
             stats = StreamStats.query.filter_by(stream_id=stream_id)\
                 .order_by(StreamStats.timestamp.desc())\
                 .limit(limit).all()
             
-            return [{
-                'timestamp': stat.timestamp.isoformat(),
+            return [self._format_stats({
+                'timestamp': stat.timestamp,
                 'viewers': stat.viewers,
                 'bitrate': stat.bitrate,
                 'frame_rate': stat.frame_rate,
-                'packet_loss': stat.packet_loss
-            } for stat in stats]
+                'packet_loss': stat.packet_loss,
+                'speed': stat.speed,
+                'dropped_frames': stat.dropped_frames,
+                'duplicate_frames': stat.duplicate_frames,
+                'out_time': stat.out_time
+            }) for stat in reversed(stats)]
             
         except Exception as e:
             logger.error(f"Error getting stats for stream {stream_id}: {e}")
             return []
     
+    def get_stream_stats_range(self, stream_id, start, end):
+        """Get statistics between start and end, oldest first.
+        
+        Returns (resolution, stats): 'raw' samples for short recent ranges,
+        otherwise min/avg/max rollups with resolution in seconds.
+        """
+        try:
+            resolution, points = stats_compactor.query_range(stream_id, start, end)
+            for point in points:
+                point['timestamp'] = point['timestamp'].isoformat()
+            return resolution, points
+            
+        except Exception as e:
+            logger.error(f"Error getting stats range for stream {stream_id}: {e}")
+            return None, []
+    
+    def _format_stats(self, sample):
+        return {
+            'timestamp': sample['timestamp'].isoformat(),
+            'viewers': sample.get('viewers') or 0,
+            'bitrate': sample.get('bitrate') or 0.0,
+            'frame_rate': sample.get('frame_rate') or 0.0,
+            'packet_loss': sample.get('packet_loss') or 0.0,
+            'speed': sample.get('speed') or 0.0,
+            'dropped_frames': sample.get('dropped_frames') or 0,
+            'duplicate_frames': sample.get('duplicate_frames') or 0,
+            'out_time': sample.get('out_time') or 0.0
+        }
+    
+    def _media_url(self, path):
+        """Public URL for a file under the streams output directory"""
+        return f"/static/streams/{os.path.relpath(path, app.config['MEDIA_ROOT'])}"
+    
+    def manifest_urls(self, stream):
+        """Multi-variant HLS and DASH manifest URLs of a stream, or None each"""
+        hls_url = dash_url = None
+        
+        for output in stream.outputs:
+            if output.format_type == 'cmaf':
+                manifests = output.get_manifests()
+                hls_url = hls_url or self._media_url(manifests['hls'])
+                dash_url = dash_url or self._media_url(manifests['dash'])
+            elif output.format_type == 'hls':
+                hls_url = hls_url or f"/static/streams/hls/stream_{stream.id}.m3u8"
+            elif output.format_type == 'dash':
+                dash_url = dash_url or self._media_url(output.output_path)
+        
+        return hls_url, dash_url
+    
     def get_embed_info(self, stream_id):
         """Get embed information for a stream"""
         try:
-            stream = Stream.query.get(stream_id)
+            stream = stream_registry.get(stream_id)
             if not stream:
                 return None
             
-            outputs = StreamOutput.query.filter_by(stream_id=stream_id).all()
-            
             embed_info = {
                 'stream_id': stream_id,
                 'name': stream.name,
                 'status': stream.status,
                 'hls_urls': [],
-                'dash_urls': []
+                'dash_urls': [],
+                'renditions': []
             }
             
-            for output in outputs:
-                if output.format_type == 'hls':
-                    embed_info['hls_urls'].append({
-                        'quality': output.resolution,
-                        'url': f"/static/streams/hls/stream_{stream_id}_{output.resolution}.m3u8"
-                    })
-                elif output.format_type == 'dash':
-                    embed_info['dash_urls'].append({
-                        'quality': output.resolution,
-                        'url': f"/static/streams/dash/stream_{stream_id}_{output.resolution}.mpd"
-                    })
+            # Players get a single multi-variant entry per format and switch
+            # renditions themselves
+            hls_url, dash_url = self.manifest_urls(stream)
+            qualities = []
+            
+            for output in stream.outputs:
+                if output.resolution not in qualities and output.resolution in QUALITY_PROFILES:
+                    qualities.append(output.resolution)
+            
+            if hls_url:
+                embed_info['hls_urls'].append({'quality': 'auto', 'url': hls_url})
+            if dash_url:
+                embed_info['dash_urls'].append({'quality': 'auto', 'url': dash_url})
+            
+            for quality in sorted(qualities, key=lambda q: QUALITY_PROFILES[q]['height'], reverse=True):
+                embed_info['renditions'].append({
+                    'quality': quality,
+                    'width': QUALITY_PROFILES[quality]['width'],
+                    'height': QUALITY_PROFILES[quality]['height'],
+                    'bitrate': QUALITY_PROFILES[quality]['bitrate']
+                })
             
             return embed_info
             
@@ -0,0 +1,202 @@
+import json
+import time
+import threading
+import logging
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from models import Stream, StreamOutput
+from config import REGISTRY_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+STREAM_COLUMNS = tuple(column.key for column in Stream.__table__.columns)
+OUTPUT_COLUMNS = tuple(column.key for column in StreamOutput.__table__.columns)
+
+def stream_key_of(input_url):
+    """Stream key of an RTMP ingest URL such as rtmp://host:1935/live/<key>"""
+    if not input_url or not input_url.startswith('rtmp://') or '/live/' not in input_url:
+        return None
+    return input_url.rsplit('/live/', 1)[1] or None
+
+class OutputRecord:
+    """Read-only copy of a StreamOutput row"""
+    
+    get_manifests = StreamOutput.get_manifests
+    
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+class StreamRecord:
+    """Read-only copy of a Stream row with its outputs and destinations.
+    
+    Has the attributes of Stream, so it can be passed wherever a stream is
+    only read. Changes replace the record rather than modify it.
+    """
+    
+    def __init__(self, values, outputs):
+        self.__dict__.update(values)
+        self.values = values
+        self.outputs = outputs
+        self.destination_list = json.loads(values['destinations']) if values.get('destinations') else []
+        self.loaded_at = time.monotonic()
+    
+    def get_destinations(self):
+        return [dict(destination) for destination in self.destination_list]
+    
+    def updated(self, changes):
+        return StreamRecord(dict(self.values, **changes), self.outputs)
+
+class StreamRegistry:
+    """In-memory read path for streams, keyed by id and by stream key.
+    
+    Warmed from the database at startup. Column changes to Stream rows are
+    applied to the registry when their transaction commits; inserts,
+    deletes and output changes drop the affected entries, which are
+    reloaded on their next lookup. Entries older than the ttl are reloaded
+    too, for databases shared with other processes.
+    """
+    
+    def __init__(self):
+        self.streams = {}
+        self.keys = {}
+        self.complete = False
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        
+        event.listen(Session, 'after_flush', self._capture)
+        event.listen(Session, 'after_commit', self._apply)
+        event.listen(Session, 'after_rollback', self._discard)
+    
+    def warm(self):
+        """Load every stream; needs an app context"""
+        records = self._load()
+        with self.lock:
+            self.streams = records
+            self.keys = {stream_key_of(record.input_url): stream_id for stream_id, record in records.items()
+                         if stream_key_of(record.input_url)}
+            self.complete = True
+        logger.info(f"Stream registry warmed with {len(records)} streams")
+    
+    def _load(self, stream_ids=None):
+        query = Stream.query
+        outputs = StreamOutput.query
+        if stream_ids is not None:
+            query = query.filter(Stream.id.in_(stream_ids))
+            outputs = outputs.filter(StreamOutput.stream_id.in_(stream_ids))
+        
+        grouped = {}
+        for output in outputs.order_by(StreamOutput.id):
+            grouped.setdefault(output.stream_id, []).append(
+                OutputRecord({key: getattr(output, key) for key in OUTPUT_COLUMNS})
+            )
+        
+        return {stream.id: StreamRecord({key: getattr(stream, key) for key in STREAM_COLUMNS},
+                                        grouped.get(stream.id, []))
+                for stream in query}
+    
+    def _fresh(self, record):
+        return record is not None and time.monotonic() - record.loaded_at < REGISTRY_SETTINGS['ttl']
+    
+    def get(self, stream_id):
+        """StreamRecord for an id, or None if there is no such stream"""
+        record = self.streams.get(stream_id)
+        if self._fresh(record):
+            self.hits += 1
+            return record
+        
+        self.misses += 1
+        record = self._load([stream_id]).get(stream_id)
+        self._store(stream_id, record)
+        return record
+    
+    def get_by_stream_key(self, stream_key):
+        """StreamRecord of the stream ingesting stream_key, or None"""
+        stream_id = self.keys.get(stream_key)
+        if stream_id is not None:
+            record = self.get(stream_id)
+            if record is not None and stream_key_of(record.input_url) == stream_key:
+                return record
+        
+        # Unknown key: a stream created elsewhere or not at all
+        self.misses += 1
+        for record in self._load_matching(stream_key):
+            self._store(record.id, record)
+            return record
+        return None
+    
+    def _load_matching(self, stream_key):
+        ids = [stream_id for (stream_id,) in Stream.query.with_entities(Stream.id)
+               .filter(Stream.input_url.like(f'rtmp://%/live/{stream_key}'))]
+        records = self._load(ids) if ids else {}
+        return [record for record in records.values() if stream_key_of(record.input_url) == stream_key]
+    
+    def all(self):
+        """Every stream, loading them all if the registry is incomplete"""
+        if not self.complete or any(not self._fresh(record) for record in self.streams.values()):
+            self.warm()
+        return list(self.streams.values())
+    
+    def _store(self, stream_id, record):
+        with self.lock:
+            previous = self.streams.pop(stream_id, None)
+            if previous is not None and self.keys.get(stream_key_of(previous.input_url)) == stream_id:
+                del self.keys[stream_key_of(previous.input_url)]
+            if record is not None:
+                self.streams[stream_id] = record
+                key = stream_key_of(record.input_url)
+                if key:
+                    self.keys[key] = stream_id
+    
+    def invalidate(self, stream_id):
+        with self.lock:
+            self.streams.pop(stream_id, None)
+            self.complete = False
+    
+    def _capture(self, session, flush_context):
+        """Note flushed stream changes; they apply once the commit succeeds"""
+        pending = session.info.setdefault('stream_registry', {})
+        for instance in session.new:
+            if isinstance(instance, Stream):
+                pending[instance.id] = None
+            elif isinstance(instance, StreamOutput):
+                pending[instance.stream_id] = None
+        for instance in session.deleted:
+            if isinstance(instance, Stream):
+                pending[instance.id] = None
+            elif isinstance(instance, StreamOutput):
+                pending[instance.stream_id] = None
+        for instance in session.dirty:
+            if isinstance(instance, Stream) and pending.get(instance.id, {}) is not None:
+                loaded = inspect(instance).dict
+                pending.setdefault(instance.id, {}).update(
+                    {key: loaded[key] for key in STREAM_COLUMNS if key in loaded}
+                )
+            elif isinstance(instance, StreamOutput):
+                pending[instance.stream_id] = None
+    
+    def _apply(self, session):
+        pending = session.info.pop('stream_registry', None)
+        if not pending:
+            return
+        
+        for stream_id, changes in pending.items():
+            record = self.streams.get(stream_id)
+            if changes is None or record is None:
+                self.invalidate(stream_id)
+            else:
+                self._store(stream_id, record.updated(changes))
+    
+    def _discard(self, session):
+        session.info.pop('stream_registry', None)
+    
+    def get_stats(self):
+        return {
+            'streams': len(self.streams),
+            'complete': self.complete,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+# Global stream registry instance
+stream_registry = StreamRegistry()
@@ -0,0 +1,45 @@
+import os
+
+from dvr import SegmentIndex, parse_media_playlist
+
+PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:6
+#EXT-X-TARGETDURATION:2
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-PROGRAM-DATE-TIME:2026-10-17T12:00:00.000+0000
+#EXTINF:2.000000,
+stream_1_720p_007.ts
+#EXTINF:2.500000,
+stream_1_720p_008.ts
+#EXT-X-PROGRAM-DATE-TIME:2026-10-17T14:00:10.000+0200
+#EXTINF:2.000000,
+stream_1_720p_009.ts
+"""
+
+# 2026-10-17T12:00:00Z
+NOON = 1792238400.0
+
+
+def test_program_date_time_is_carried_forward():
+    sequence, map_uri, segments = parse_media_playlist(PLAYLIST)
+
+    assert sequence == 7
+    assert map_uri is None
+    assert segments == [
+        (2.0, 'stream_1_720p_007.ts', NOON),
+        (2.5, 'stream_1_720p_008.ts', NOON + 2.0),
+        (2.0, 'stream_1_720p_009.ts', NOON + 10.0)
+    ]
+
+
+def test_index_starts_at_program_date_time(tmp_path):
+    path = os.path.join(tmp_path, 'stream_1_720p.m3u8')
+    with open(path, 'w') as f:
+        f.write(PLAYLIST)
+
+    index = SegmentIndex(path, '/static/streams/hls', 3600)
+    # Polled well after the segments were written
+    assert index.poll(now=NOON + 60)
+
+    assert index.sequences == [7, 8, 9]
+    assert index.starts == [NOON, NOON + 2.0, NOON + 10.0]
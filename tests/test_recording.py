@@ -0,0 +1,82 @@
+import os
+
+from recording import TrackRecorder
+
+SEGMENT_DURATION = 2.0
+WINDOW = 3
+
+
+class LivePlaylist:
+    """A sliding-window media playlist the way the muxer rewrites it"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, 'media_0.m3u8')
+        self.segments = []
+        self.durations = []
+        with open(os.path.join(directory, 'init-stream0.m4s'), 'wb') as f:
+            f.write(b'init')
+
+    def add_segment(self, duration=SEGMENT_DURATION):
+        number = len(self.segments) + 1
+        name = f'chunk-stream0-{number:05d}.m4s'
+        with open(os.path.join(self.directory, name), 'wb') as f:
+            f.write(f'segment {number}'.encode())
+        self.segments.append(name)
+        self.durations.append(duration)
+        self._write()
+
+    def _write(self):
+        first = max(0, len(self.segments) - WINDOW)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', f'#EXT-X-TARGETDURATION:{int(SEGMENT_DURATION)}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{first + 1}', '#EXT-X-MAP:URI="init-stream0.m4s"']
+        for name, duration in zip(self.segments[first:], self.durations[first:]):
+            lines.extend([f'#EXTINF:{duration:.3f},', name])
+        # A new mtime on every rewrite, as the poller keys on it
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.utime(self.path, ns=(len(self.segments) * 10 ** 9, len(self.segments) * 10 ** 9))
+
+    @property
+    def live_duration(self):
+        return sum(self.durations)
+
+
+def test_duration_matches_live_session(tmp_path):
+    playlist = LivePlaylist(str(tmp_path))
+    recorder = TrackRecorder(playlist.path, str(tmp_path / 'video.part'))
+
+    # Polled after every segment, and sometimes after two
+    for index in range(20):
+        playlist.add_segment(SEGMENT_DURATION + (index % 3) * 0.1)
+        if index % 4 != 1:
+            recorder.poll()
+    recorder.poll()
+    recorder.close()
+
+    assert abs(recorder.duration - playlist.live_duration) <= SEGMENT_DURATION
+    assert recorder.segments == 20
+    assert recorder.missed == 0
+
+    with open(tmp_path / 'video.part', 'rb') as f:
+        data = f.read()
+    assert data.startswith(b'init')
+    assert data == b'init' + b''.join(f'segment {number}'.encode() for number in range(1, 21))
+
+
+def test_segments_missed_between_polls_are_counted(tmp_path):
+    playlist = LivePlaylist(str(tmp_path))
+    recorder = TrackRecorder(playlist.path, str(tmp_path / 'video.part'))
+
+    playlist.add_segment()
+    recorder.poll()
+
+    # The window slides past two segments before the next poll
+    for _ in range(WINDOW + 2):
+        playlist.add_segment()
+    recorder.poll()
+    recorder.close()
+
+    assert recorder.missed == 2
+    assert recorder.segments == 1 + WINDOW
+    assert abs(recorder.duration + recorder.missed * SEGMENT_DURATION - playlist.live_duration) < 1e-6
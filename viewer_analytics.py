@@ -0,0 +1,163 @@
+import hashlib
+import math
+import re
+import threading
+import time
+import logging
+from collections import deque
+from segment_storage import STREAM_NAME
+from config import VIEWER_SETTINGS
+
+logger = logging.getLogger(__name__)
+
+# Rendition of a media file: the quality of a separate HLS rendition
+# (stream_1_720p3.ts), otherwise the package position of a CMAF or DASH
+# representation (chunk-stream0-00001.m4s, media_0.m3u8, stream_1-init-0.m4s)
+RENDITION_NAME = re.compile(
+    r'stream_\d+_(\d+p)|(?:chunk|init)-stream(\d+)[-.]|media_(\d+)\.m3u8|-(?:chunk|init)-(\d+)[-.]'
+)
+
+class HyperLogLog:
+    """Cardinality sketch over 64-bit hashes"""
+    
+    def __init__(self, precision):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+    
+    def add(self, value_hash):
+        index = value_hash & (len(self.registers) - 1)
+        rank = 65 - self.precision - (value_hash >> self.precision).bit_length()
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+def session_hash(session):
+    """64-bit hash of a session, the same in every process and run"""
+    digest = hashlib.blake2b(repr(session).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+def merge_registers(sketches):
+    """Registers of the union of HyperLogLog sketches"""
+    registers = sketches[0].registers
+    for sketch in sketches[1:]:
+        registers = bytes(map(max, registers, sketch.registers))
+    return registers
+
+def estimate(registers):
+    """Distinct values counted by a set of HyperLogLog registers"""
+    count = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / count)
+    raw = alpha * count * count / sum(2.0 ** -register for register in registers)
+    
+    # Linear counting is more accurate while many registers are empty
+    empty = registers.count(0)
+    if raw <= 2.5 * count and empty:
+        return round(count * math.log(count / empty))
+    return round(raw)
+
+class ViewerAnalytics:
+    """Concurrent viewers and egress per stream, from media requests.
+    
+    The origin reports every playlist and segment it serves. Sessions are
+    added to a HyperLogLog sketch for the stream and one per rendition in
+    the current time bucket, and bytes are added to the bucket's total, so
+    a request costs a hash and a few register writes. Counts are unions of
+    the buckets in the sliding window, computed when asked for; they reach
+    the database through the stats collector's periodic samples.
+    """
+    
+    def __init__(self):
+        self.streams = {}
+        self.renditions = {}
+        self.egress = {}
+        self.lock = threading.Lock()
+    
+    def set_renditions(self, stream_id, names):
+        """Names of a stream's packaged representations, in package order"""
+        self.renditions[stream_id] = list(names)
+    
+    def record(self, filename, session, size, now=None):
+        """Count a request for filename (relative to MEDIA_ROOT) by session"""
+        parts = filename.split('/')
+        match = STREAM_NAME.match(parts[1]) if len(parts) > 1 else None
+        if not match:
+            return
+        
+        rendition = RENDITION_NAME.search(parts[-1])
+        if rendition:
+            rendition = next(group for group in rendition.groups() if group is not None)
+        self.record_stream(int(match.group(1)), rendition, session, size, now)
+    
+    def record_stream(self, stream_id, rendition, session, size, now=None):
+        """Count a request for a stream's media by session; rendition may be None"""
+        bucket_start = int((now or time.time()) // VIEWER_SETTINGS['bucket']) * VIEWER_SETTINGS['bucket']
+        value_hash = session_hash(session)
+        
+        with self.lock:
+            buckets = self.streams.get(stream_id)
+            if buckets is None:
+                buckets = self.streams[stream_id] = deque()
+            if not buckets or buckets[-1]['start'] != bucket_start:
+                buckets.append({'start': bucket_start, 'viewers': HyperLogLog(VIEWER_SETTINGS['precision']),
+                                'renditions': {}, 'bytes': 0})
+                while buckets[0]['start'] <= bucket_start - VIEWER_SETTINGS['window']:
+                    buckets.popleft()
+            
+            bucket = buckets[-1]
+            bucket['viewers'].add(value_hash)
+            bucket['bytes'] += size
+            self.egress[stream_id] = self.egress.get(stream_id, 0) + size
+            if rendition:
+                sketch = bucket['renditions'].get(rendition)
+                if sketch is None:
+                    sketch = bucket['renditions'][rendition] = HyperLogLog(VIEWER_SETTINGS['precision'])
+                sketch.add(value_hash)
+    
+    def _window(self, stream_id, now):
+        cutoff = (now or time.time()) - VIEWER_SETTINGS['window']
+        with self.lock:
+            return [bucket for bucket in self.streams.get(stream_id, ())
+                    if bucket['start'] + VIEWER_SETTINGS['bucket'] > cutoff]
+    
+    def concurrent(self, stream_id, now=None):
+        """Sessions that requested the stream's media within the window"""
+        buckets = self._window(stream_id, now)
+        if not buckets:
+            return 0
+        return estimate(merge_registers([bucket['viewers'] for bucket in buckets]))
+    
+    def get_stats(self, stream_id, now=None):
+        """Viewers, viewers per rendition and egress over the window, plus
+        the stream's egress since it started
+        """
+        buckets = self._window(stream_id, now)
+        names = self.renditions.get(stream_id, [])
+        
+        sketches = {}
+        for bucket in buckets:
+            for rendition, sketch in list(bucket['renditions'].items()):
+                sketches.setdefault(rendition, []).append(sketch)
+        
+        renditions = {}
+        for rendition, rendition_sketches in sketches.items():
+            if rendition.isdigit() and int(rendition) < len(names):
+                rendition = names[int(rendition)]
+            renditions[rendition] = estimate(merge_registers(rendition_sketches))
+        
+        egress = sum(bucket['bytes'] for bucket in buckets)
+        return {
+            'viewers': estimate(merge_registers([bucket['viewers'] for bucket in buckets])) if buckets else 0,
+            'renditions': renditions,
+            'egress_bytes': egress,
+            'egress_kbps': round(egress * 8 / 1000 / VIEWER_SETTINGS['window'], 1),
+            'egress_total_bytes': self.egress.get(stream_id, 0),
+            'window': VIEWER_SETTINGS['window']
+        }
+    
+    def clear(self, stream_id):
+        with self.lock:
+            self.streams.pop(stream_id, None)
+            self.egress.pop(stream_id, None)
+        self.renditions.pop(stream_id, None)
+
+# Global viewer analytics instance
+viewer_analytics = ViewerAnalytics()
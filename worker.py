@@ -0,0 +1,37 @@
+"""Encoder worker for cluster mode.
+
+Runs the app with CLUSTER_MODE=worker: encodes streams the coordinator
+assigns through /worker/... and sends it heartbeats. DATABASE_URL and
+MEDIA_ROOT must point at the same database and shared directory as the
+coordinator, and CLUSTER_TOKEN must be set to the coordinator's token.
+
+Usage:
+    python worker.py --port 5101 --coordinator http://127.0.0.1:5000
+"""
+import argparse
+import os
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5101)
+    parser.add_argument('--coordinator', help='coordinator base URL (default COORDINATOR_URL)')
+    parser.add_argument('--url', help='URL the coordinator reaches this worker at (default WORKER_URL)')
+    args = parser.parse_args()
+    
+    # Cluster settings are read from the environment when config is imported
+    os.environ['CLUSTER_MODE'] = 'worker'
+    if args.coordinator:
+        os.environ['COORDINATOR_URL'] = args.coordinator
+    if args.url:
+        os.environ['WORKER_URL'] = args.url
+    
+    from app import app
+    from cluster import worker_agent
+    from stream_manager import stream_manager
+    
+    worker_agent.start(stream_manager.stop_encoder, port=args.port)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == '__main__':
+    main()